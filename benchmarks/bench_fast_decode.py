@@ -0,0 +1,76 @@
+""" Latency of routing NLG requests with and without `FAST_DECODE`, vs tracker length.
+
+Usage:
+  python benchmarks/bench_fast_decode.py
+
+Each request is decoded from its raw body, then routed with the `entity`
+method. With plain decoding, the whole body is decoded by `json.loads` (as
+`request.json` does); with `FAST_DECODE`, it is parsed by `simdjson` and only
+the events needed are decoded. Trackers either have no user message at all
+(every event is scanned) or have the entity in their latest user message.
+"""
+import json
+import timeit
+import logging
+from types import SimpleNamespace
+
+from rasa_helpers.nlg import ResponseFetcher, POOLED_FLAG, DEFAULT_VALUE_FLAG
+from rasa_helpers.response_router import ResponseRouter
+
+SIZES = [100, 1000, 5000, 20000]
+REPEAT = 20
+LABELS = {'abc', 'xyz', DEFAULT_VALUE_FLAG, POOLED_FLAG}
+CONTROLS = {'METHOD': 'entity', 'NAME': 'test_entity', 'HISTORY': 5}
+
+
+def build_body(n_events, match):
+    events = [{'event': 'action', 'name': 'utter_response'} for _ in range(n_events)]
+    if match:
+        events[-2] = {
+            'event': 'user',
+            'text': 'Some user message',
+            'intent': {'name': 'affirm'},
+            'parse_data': {'entities': [
+                {'entity': 'test_entity', 'value': 'abc', 'start': 0, 'end': 0}
+            ]}
+        }
+
+    return json.dumps({
+        'tracker': {'sender_id': 'user1', 'slots': {}, 'events': events},
+        'arguments': {},
+        'response': 'utter_response'
+    }).encode()
+
+
+def measure(app, router, body):
+    request = SimpleNamespace(body=body, json=None)
+
+    def run():
+        request.json = json.loads(request.body)
+        return router.route(ResponseFetcher._decode_request(app, request))
+
+    return min(timeit.repeat(run, number=REPEAT, repeat=5)) / REPEAT * 1e3
+
+
+def main():
+    # Unmatched trackers fall back to the default group with a warning
+    logging.getLogger('sanic.root').setLevel(logging.ERROR)
+    router = ResponseRouter.compile(CONTROLS, LABELS, 'xyz', POOLED_FLAG)
+    plain = SimpleNamespace(config=SimpleNamespace(NLG_FAST_DECODE=False))
+    fast = SimpleNamespace(config=SimpleNamespace(NLG_FAST_DECODE=True))
+
+    print(f'{"events":>8} {"match":>6} {"json (ms)":>10} {"fast (ms)":>10}')
+    for size in SIZES:
+        for match in [False, True]:
+            body = build_body(size, match)
+            json_ms = measure(plain, router, body)
+            # `request.json` is never read with FAST_DECODE
+            request = SimpleNamespace(body=body)
+            fast_ms = min(timeit.repeat(
+                lambda: router.route(ResponseFetcher._decode_request(fast, request)),
+                number=REPEAT, repeat=5)) / REPEAT * 1e3
+            print(f'{size:>8} {str(match):>6} {json_ms:>10.2f} {fast_ms:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+""" Latency of group extraction from tracker events vs conversation length.
+
+Usage:
+  python benchmarks/bench_find_events.py
+
+The eager scan (first implementation) filters every event of the tracker
+before keeping the latest `HISTORY` ones; the lazy scan (previous
+implementation, see `legacy_fetcher.py`) stops as soon as it has seen enough
+events. The router, as used to answer requests, scans lazily too.
+"""
+import timeit
+
+from rasa_helpers.nlg import POOLED_FLAG, DEFAULT_VALUE_FLAG
+from rasa_helpers.response_router import ResponseRouter
+from legacy_fetcher import LegacyResponseFetcher
+
+SIZES = [10, 100, 1000, 10000]
+HISTORIES = [1, 5]
+REPEAT = 2000
+LABELS = {'abc', 'xyz', DEFAULT_VALUE_FLAG, POOLED_FLAG}
+
+
+def build_request(n_events):
+    events = []
+    for idx in range(n_events):
+        if idx % 3 == 0:
+            events.append({
+                'event': 'user',
+                'intent': {'name': 'affirm_abc'},
+                'parse_data': {'entities': [
+                    {'entity': 'test_entity', 'value': 'abc', 'start': 0, 'end': 0}
+                ]}
+            })
+        else:
+            events.append({'event': 'action', 'name': 'utter_response_abc'})
+
+    return {
+        'tracker': {'slots': {}, 'events': events},
+        'response': 'utter_response_abc'
+    }
+
+
+def eager_find_events(request, n, event_type):
+    first_event = []
+    if event_type == 'action':
+        first_event = [{'name': request['response']}]
+        n -= 1
+    return (first_event
+            + [ev for ev in reversed(request['tracker']['events'])
+               if ev['event'] == event_type][:n])
+
+
+def measure(run):
+    return min(timeit.repeat(run, number=REPEAT, repeat=5)) / REPEAT * 1e6
+
+
+def extraction(request, history, find_events):
+    def run():
+        events = find_events(request, history, 'user')
+        return LegacyResponseFetcher._extract_entities(events, 'test_entity')
+    return run
+
+
+def main():
+    print(f'{"events":>8} {"HISTORY":>8} {"eager (us)":>12} {"lazy (us)":>12} '
+          f'{"router (us)":>12}')
+    for size in SIZES:
+        request = build_request(size)
+        for history in HISTORIES:
+            router = ResponseRouter.compile(
+                {'METHOD': 'entity', 'NAME': 'test_entity', 'HISTORY': history},
+                LABELS, 'xyz', POOLED_FLAG)
+            eager = measure(extraction(request, history, eager_find_events))
+            lazy = measure(extraction(
+                request, history, LegacyResponseFetcher._find_events))
+            routed = measure(lambda: router.route(request))
+            print(f'{size:>8} {history:>8} {eager:>12.2f} {lazy:>12.2f} '
+                  f'{routed:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
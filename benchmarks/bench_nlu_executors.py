@@ -0,0 +1,96 @@
+""" NLU latency and throughput with and without executors, vs concurrent clients.
+
+Usage:
+  python benchmarks/bench_nlu_executors.py
+
+A synthetic chooser (pure Python, holds the GIL) and a synthetic model
+(hashing a large buffer, releases the GIL like TensorFlow inference) stand in
+for real ones, so that no trained model is needed. Each client sends requests
+one after the other; all clients run concurrently on the same event loop.
+"""
+import time
+import asyncio
+import hashlib
+import statistics
+from types import SimpleNamespace
+
+import sanic
+
+from rasa_helpers.nlu import NLURunner
+
+CLIENTS = [1, 8, 64]
+REQUESTS_PER_CLIENT = 20
+BUFFER = b'x' * (8 << 20)
+SETUPS = {
+    'event loop': {},
+    'inference thread': {'INFERENCE_EXECUTOR': 'thread', 'INFERENCE_WORKERS': 4},
+    'chooser process + inference thread': {
+        'CHOOSER_EXECUTOR': 'process', 'CHOOSER_WORKERS': 4,
+        'INFERENCE_EXECUTOR': 'thread', 'INFERENCE_WORKERS': 4},
+}
+
+
+def chooser(message):
+    total = 0
+    for idx in range(200000):
+        total += idx % 7
+    return ('eng', 1)
+
+
+async def predict_intent(message):
+    hashlib.sha256(BUFFER).hexdigest()
+    return {'text': message, 'intent': {'name': 'greet'}, 'entities': []}
+
+
+def build_app(controls):
+    app = sanic.Sanic('bench_nlu_executors', register=False)
+    app.config['NLU_CONTROLS'] = dict({
+        'NAME': 'detected_lang',
+        'MODEL_CHOOSER': {
+            'FILEPATH': __file__,
+            'FUNCTION': 'chooser'}
+    }, **controls)
+    app.config['NLU_EXECUTORS'] = {}
+    app.config['NLU_BATCHERS'] = {}
+    app.config['NLU_CACHE'] = None
+    app.config['NLU_GENERATION'] = None
+    app.config['NLU_CHOOSER'] = chooser
+    app.config['NLU_CHOOSER_BYPASSER'] = '/(greet)'
+    app.config['MODELS'] = {'eng': SimpleNamespace(predict_intent=predict_intent)}
+    return app
+
+
+async def client(app, latencies):
+    request = SimpleNamespace(json={'text': 'Hello world!'})
+    for _ in range(REQUESTS_PER_CLIENT):
+        start = time.perf_counter()
+        await NLURunner.run(app, request)
+        latencies.append(time.perf_counter() - start)
+
+
+async def measure(app, n_clients):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(app, latencies) for _ in range(n_clients)])
+    duration = time.perf_counter() - start
+    latencies.sort()
+    return (
+        len(latencies) / duration,
+        statistics.median(latencies) * 1e3,
+        latencies[int(len(latencies) * 0.99) - 1] * 1e3)
+
+
+def main():
+    print(f'{"setup":>36} {"clients":>8} {"req/s":>8} {"p50 (ms)":>10} {"p99 (ms)":>10}')
+    for name, controls in SETUPS.items():
+        app = build_app(controls)
+        for n_clients in CLIENTS:
+            throughput, p50, p99 = asyncio.run(measure(app, n_clients))
+            print(f'{name:>36} {n_clients:>8} {throughput:>8.1f} {p50:>10.2f} {p99:>10.2f}')
+        for executor in app.config['NLU_EXECUTORS'].values():
+            if executor is not None:
+                executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+""" Latency of response group selection: config dispatch vs compiled router.
+
+Usage:
+  python benchmarks/bench_routing.py
+
+The config dispatch (previous implementation, see `legacy_fetcher.py`) reads
+the NLG controls, builds the extractor table and goes through the
+exception-catching decorators on every request; the compiled router is built
+once by `NLGAppUpdater.configure`.
+"""
+import timeit
+
+from rasa_helpers.nlg import POOLED_FLAG, DEFAULT_VALUE_FLAG
+from rasa_helpers.response_router import ResponseRouter
+from legacy_fetcher import LegacyResponseFetcher
+
+METHODS = ['slot', 'entity', 'suffix', 'last_intent_suffix', 'pooled']
+HISTORIES = [1, 5]
+N_EVENTS = 100
+REPEAT = 20000
+LABELS = {'abc', 'xyz', DEFAULT_VALUE_FLAG, POOLED_FLAG}
+
+
+def build_request(n_events):
+    events = []
+    for idx in range(n_events):
+        if idx % 3 == 0:
+            events.append({
+                'event': 'user',
+                'intent': {'name': 'affirm_abc'},
+                'parse_data': {'entities': [
+                    {'entity': 'test_entity', 'value': 'abc', 'start': 0, 'end': 0}
+                ]}
+            })
+        else:
+            events.append({'event': 'action', 'name': 'utter_response_abc'})
+
+    return {
+        'tracker': {'slots': {'test_slot': 'abc'}, 'events': events},
+        'response': 'utter_response_abc'
+    }
+
+
+def measure(run):
+    return min(timeit.repeat(run, number=REPEAT, repeat=5)) / REPEAT * 1e6
+
+
+def main():
+    request = build_request(N_EVENTS)
+    print(f'{"METHOD":>20} {"HISTORY":>8} {"config (us)":>12} {"router (us)":>12}')
+    for method in METHODS:
+        for history in HISTORIES:
+            controls = {
+                'METHOD': method,
+                'NAME': 'test_slot' if method == 'slot' else 'test_entity',
+                'SEPARATOR': '_',
+                'HISTORY': history
+            }
+            router = ResponseRouter.compile(controls, LABELS, 'xyz', POOLED_FLAG)
+
+            def dispatch():
+                return LegacyResponseFetcher._select_response_group(
+                    LegacyResponseFetcher._extract_groups(request, controls),
+                    LABELS, 'xyz')
+
+            def route():
+                return router.route(request)
+
+            assert dispatch() == route()
+            print(f'{method:>20} {history:>8} '
+                  f'{measure(dispatch):>12.2f} {measure(route):>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
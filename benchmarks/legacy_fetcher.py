@@ -0,0 +1,227 @@
+""" Response group selection and filtering as done before the response router
+and the response index, kept as the reference the benchmarks compare against.
+
+`LegacyResponseFetcher` reads the NLG controls on every request
+(`_extract_groups`, `_select_response_group`) and filters the raw responses of
+a group (`_filter_wanted_responses`), where `ResponseFetcher` now uses the
+router compiled by `NLGAppUpdater.configure` and the response index.
+"""
+import itertools
+
+from sanic.log import logger
+
+from rasa_helpers.nlg import POOLED_FLAG
+from rasa_helpers.response_router import history_fallback
+
+
+class LegacyResponseFetcher(object):
+
+    @classmethod
+    def _find_events(cls, request, n, event_type):
+        """ Find latest events in a request.
+
+            Details:
+                Events are scanned lazily from the end of the tracker, and the
+                scan stops as soon as `n` events have been consumed, so the
+                cost does not depend on the length of the conversation.
+
+            Args:
+                request (dict): Incoming request to process
+                n (int): Number of events to select
+                event_type (str): Type of the events to select `action` or `user`
+
+            Returns:
+                iterator of dict: Latest events first
+        """
+        assert n > 0
+        events = (ev for ev in reversed(request['tracker']['events'])
+                  if ev['event'] == event_type)
+
+        # When looking at response names, we want to grab the yet-to-be-applied
+        # event information
+        if event_type == 'action':
+            return itertools.chain(
+                [{'name': request['response']}], itertools.islice(events, n - 1))
+        return itertools.islice(events, n)
+
+    # Extract group from event or request
+    @classmethod
+    def _extract_slot_from_request(cls, request, slot_name):
+        """Slot extractor"""
+        return request['tracker']['slots'].get(slot_name)
+
+    def default_to_none(function):
+        """ Decorator for extraction functions: return None if exception is raised"""
+        def inner(cls, *args, **kwargs):
+            try:
+                return function(cls, *args, **kwargs)
+            except:
+                return None
+        return inner
+
+    def vectorise(function):
+        """ Decorator for extraction functions: make output a list
+
+            Details:
+                The first argument may be a single event, or any iterable of
+                events (e.g. the iterator returned by `_find_events`)
+        """
+        def inner(cls, *args, **kwargs):
+            if isinstance(args[0], dict):
+                return [function(cls, *args, **kwargs)]
+            else:
+                events, *args = args
+                return [function(cls, e, *args, **kwargs) for e in events]
+        return inner
+
+    @classmethod
+    @vectorise
+    @default_to_none
+    def _extract_entities(cls, event, entity_name):
+        """Entity extractor"""
+        return [e['value']
+                for e in event['parse_data']['entities']
+                if e['entity'] == entity_name][0]
+
+    @classmethod
+    @vectorise
+    @default_to_none
+    def _extract_suffixes(cls, event, separator):
+        """Suffix extractor"""
+        return event['name'].split(separator)[-1]
+
+    @classmethod
+    @vectorise
+    @default_to_none
+    def _extract_last_intent_suffixes(cls, event, separator):
+        """Last intent suffix extractor"""
+        return event['intent']['name'].split(separator)[-1]
+
+    @classmethod
+    def _extract_groups(cls, request, nlg_controls):
+        """ Extract group names from the request.
+
+            Details:
+                The extraction is done according to the NLG controls defined in
+                the configuration:
+                - METHOD controls the extraction method to use
+                    `entity`, `slot`, `suffix`, `last_intent_suffix` or `pooled`
+                - HISTORY controls how far to look back in time (must be 1 or more)
+                - NAME controls the entity or slot name to look for (may be None)
+                - SEPARATOR controls the separator to use when splitting response
+                names or intent names for `suffix` or `last_intent_suffix` methods
+
+            Args:
+                request (dict): Incoming request
+                nlg_controls (dict): Extraction configuration
+
+            Returns:
+                list of dict: The groups found in previous events
+        """
+
+        method = nlg_controls['METHOD']
+        history = nlg_controls['HISTORY']
+        entity_or_slot_name = nlg_controls.get('NAME', None)
+        separator = nlg_controls.get('SEPARATOR', None)
+
+        if method == 'pooled':
+            return [POOLED_FLAG]
+        elif method == 'slot':
+            return [cls._extract_slot_from_request(
+                request, entity_or_slot_name)]
+
+        event_type, extract_from_events, arg = {
+            'entity': ('user', cls._extract_entities, entity_or_slot_name),
+            'last_intent_suffix': ('user', cls._extract_last_intent_suffixes, separator),
+            'suffix': ('action', cls._extract_suffixes, separator)
+        }[method]
+
+        events = cls._find_events(request, history, event_type)
+        return extract_from_events(events, arg)
+
+    @classmethod
+    def _history_fallback(cls, groups):
+        """ Find the likeliest group name in a list.
+
+            Details:
+                See `rasa_helpers.response_router.history_fallback`
+
+            Args:
+                groups (list of str): Group names to inspect
+
+            Returns:
+                str or None: The highest scoring group
+
+        """
+        return history_fallback(groups)
+
+    @classmethod
+    def _select_response_group(cls, groups, allowed_groups, default_group):
+        """ Find the group name likeliest to be needed to process the incoming request.
+
+            Details:
+                If the first group name in the list is valid, we pick that.
+                Otherwise, we attempt to look at the names found in older events
+                    and deduce the likeliest one.
+                If that fails, we use the default.
+
+            Args:
+                groups (list of str): Group names found by `cls._extract_groups`
+                allowed_groups (list of str): Valid group names as defined in the
+                    configuration
+                default_group (str): Default group as define in the configuration
+
+            Returns:
+                str: The chosen group
+        """
+
+        # Non allowed converted to None
+        clean_groups = [g.lower() if g in allowed_groups
+                        else None
+                        for g in groups]
+
+        group = clean_groups[0]
+        # Best effort
+        if not group:
+            group = cls._history_fallback(clean_groups)
+
+        if not group:
+            logger.warning(
+                f'Could not find usable NLG response group from: {groups}')
+            return default_group
+
+        return group
+
+    @classmethod
+    def _filter_wanted_responses(cls, responses, response_key, channel):
+        """ Find the possible responses for a given key and channel.
+
+            Args:
+                responses (dict): Response group
+                response_key (str): Response identifier
+                channel (str): Channel
+
+            Returns:
+                list of dict: Possible responses
+        """
+
+        def try_filter(c):
+            try:
+                return [res for res in responses[response_key]
+                        if res.get('channel', 'collector') == c]
+
+            except KeyError:
+                logger.warning(f'Could not find response `{response_key}`')
+                logger.warning(f'Channel: {c}')
+                return []
+
+        if response_key == 'utter_restart':
+            logger.debug('restart session')
+            return [{'text': ''}]
+
+        for c in [channel, 'collector']:
+            o = try_filter(c)
+            if o:
+                break
+
+        return o
@@ -1,9 +1,11 @@
 import os
+import hashlib
 import collections
 import ruamel.yaml as yaml
 from sanic.log import logger
 
 DEFAULT_VALUE_FLAG = 'unk'
+HASH_CHUNK_SIZE = 1 << 20
 
 class AppUpdater(object):
     @classmethod
@@ -57,20 +59,146 @@ class AppUpdater(object):
         return (entry['name'], entry['filename'], entry.get('timestamp', 0))
 
     @classmethod
-    def _lookup_file_timestamp(cls, filename):
-        return os.lstat(filename).st_mtime
+    def _hash_file(cls, filename):
+        """ Hash the contents of a file, reading it in chunks."""
+        h = hashlib.blake2b(digest_size=16)
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                h.update(chunk)
+        return h.hexdigest()
 
     @classmethod
-    def _is_stale(cls, filename, last_known_timestamp=0):
-        """ Check when a file was last updated, and determine freshness"""
-        o = cls._lookup_file_timestamp(filename)
-        return (last_known_timestamp < o, o)
+    def _is_stale(cls, filename, last_known_timestamp=0, fingerprint=None):
+        """ Check whether a file changed since it was last loaded.
+
+            Details:
+                The fingerprint of a file is (size, timestamp, content hash).
+                Size and timestamp are checked first: the file is only hashed
+                when one of them changed, and it is only considered stale if
+                the hash changed too, so that rewriting a file with the same
+                contents does not trigger a reload.
+                Without a previous fingerprint, only the timestamp is checked.
+
+            Args:
+                filename (str): File to check
+                last_known_timestamp (float): Timestamp when last loaded
+                fingerprint (tuple or None): Fingerprint when last loaded
+
+            Returns:
+                tuple: (stale: bool, fingerprint: tuple or None)
+        """
+        stat = os.lstat(filename)
+        size, timestamp = stat.st_size, stat.st_mtime
+
+        if fingerprint is None:
+            if last_known_timestamp >= timestamp:
+                return (False, None)
+            return (True, (size, timestamp, cls._hash_file(filename)))
+
+        if (size, timestamp) == tuple(fingerprint[:2]):
+            return (False, fingerprint)
+
+        latest_fingerprint = (size, timestamp, cls._hash_file(filename))
+        return (latest_fingerprint[2] != fingerprint[2], latest_fingerprint)
 
     @classmethod
     def _load_updated_data(cls, *args, **kwargs):
         raise NotImplemented(
             '`_load_updated_data` must be implemented in child classes')
 
+    @classmethod
+    def _caller_keys(cls, caller):
+        """ Find where a caller stores its data and controls in app config.
+
+            Returns:
+                tuple: (output_key: str, controls_key: str, content_type: str)
+        """
+        if caller == 'NLG':
+            return ('RESPONSES', 'NLG_CONTROLS', 'responses')
+        elif caller == 'NLU':
+            return ('MODELS', 'NLU_CONTROLS', 'model')
+
+    @classmethod
+    def _find_stale_entries(cls, app, caller, filenames=None):
+        """ Find the `VALUES` entries whose file changed since it was loaded.
+
+            Args:
+                app (sanic.Sanic): Sanic app, configured beforehand
+                caller (str): `NLG` or `NLU`
+                filenames (set of str or None): If given, only check the
+                    entries whose file is in this set of absolute paths
+
+            Details:
+                Entries whose file was rewritten with identical contents are
+                not stale, but their `TIMESTAMP` and `FINGERPRINT` are updated
+                in place.
+
+            Returns:
+                list of tuple: (idx: int, key: str, filename: str,
+                                fingerprint: tuple) for each stale entry
+        """
+        output_key, controls_key, content_type = cls._caller_keys(caller)
+        if output_key not in app.config:
+            logger.error('app was not configured before calling `refresh` method')
+            raise KeyError(output_key)
+
+        stale_entries = []
+        for idx, value in enumerate(app.config[controls_key]['VALUES']):
+            # timestamp should be 0 if loading for the first time
+            key, filename, timestamp = cls._parse_entry(value)
+            if filenames is not None and os.path.abspath(filename) not in filenames:
+                continue
+            fingerprint = value.get('FINGERPRINT')
+            stale, latest_fingerprint = cls._is_stale(filename, timestamp, fingerprint)
+            if stale:
+                stale_entries.append((idx, key, filename, latest_fingerprint))
+            elif latest_fingerprint != fingerprint:
+                logger.debug(f'{filename} was rewritten but did not change')
+                value['TIMESTAMP'] = latest_fingerprint[1]
+                value['FINGERPRINT'] = latest_fingerprint
+
+        return stale_entries
+
+    @classmethod
+    def _load_stale_entries(cls, stale_entries, content_type, first_time=False):
+        """ Load the data for stale entries.
+
+            Details:
+                Does not touch the app, so that it can run in a worker thread
+                or process.
+
+            Args:
+                stale_entries (list of tuple): As returned by `_find_stale_entries`
+                content_type (str): What is loaded, for logging
+                first_time (bool): Whether the app has no data yet, for logging
+
+            Returns:
+                dict: key -> loaded data
+        """
+        if first_time:
+            msg = 'First-time loading {content_type} for {key} from {filename}'
+        else:
+            msg = '{key} {content_type} have changed, loading new data from {filename}'
+
+        loaded = {}
+        for idx, key, filename, fingerprint in stale_entries:
+            logger.info(msg.format(
+                key=key, filename=filename, content_type=content_type))
+            loaded[key] = cls._load_updated_data(filename)
+
+        return loaded
+
+    @classmethod
+    def _mark_loaded(cls, app, caller, stale_entries):
+        """ Remember when the data for stale entries was last changed."""
+        output_key, controls_key, content_type = cls._caller_keys(caller)
+        for idx, key, filename, fingerprint in stale_entries:
+            value = app.config[controls_key]['VALUES'][idx]
+            value['TIMESTAMP'] = fingerprint[1]
+            value['FINGERPRINT'] = fingerprint
+
+        return None
+
     @classmethod
     def refresh(cls, app, caller):
         """ Update the app responses if a newer version is available.
@@ -82,46 +210,26 @@ class AppUpdater(object):
                 app (sanic.Sanic): Sanic app to configure
 
             Returns:
-                True if app was updated
+                list of str: Names of the entries which were reloaded
+                    (empty if the app was not updated)
         """
-        if caller == 'NLG':
-            output_key = 'RESPONSES'
-            controls_key = 'NLG_CONTROLS'
-            content_type = 'responses'
-        elif caller == 'NLU':
-            output_key = 'MODELS'
-            controls_key = 'NLU_CONTROLS'
-            content_type = 'model'
+        output_key, controls_key, content_type = cls._caller_keys(caller)
         default_key = f'{caller}_DEFAULT_VALUE'
 
-        try:
-            assert len(app.config[output_key]) == 0
-            msg = 'First-time loading {content_type} for {key} from {filename}'
-        except AssertionError:
-            msg = '{key} {content_type} have changed, loading new data from {filename}'
-        except KeyError:
-            logger.error('app was not configured before calling `refresh` method')
-            raise
+        stale_entries = cls._find_stale_entries(app, caller)
+        loaded = cls._load_stale_entries(
+            stale_entries, content_type,
+            first_time=len(app.config[output_key]) == 0)
 
-        updated = False
-        for idx, value in enumerate(app.config[controls_key]['VALUES']):
-            # timestamp should be 0 if loading for the first time
-            key, filename, timestamp = cls._parse_entry(value)
-            stale, latest_timestamp = cls._is_stale(filename, timestamp)
-
-            if stale:
-                logger.info(msg.format(
-                    key=key, filename=filename, content_type=content_type))
-                app.config[output_key][key] = cls._load_updated_data(filename)
-                app.config[controls_key]['VALUES'][idx]['TIMESTAMP'] = (latest_timestamp)
-                updated = True
+        app.config[output_key].update(loaded)
+        cls._mark_loaded(app, caller, stale_entries)
 
-        if updated:
+        if loaded:
             app.config[output_key][DEFAULT_VALUE_FLAG] = (
                 app.config[output_key][app.config[default_key]]
             )
 
-        return updated
+        return list(loaded)
 
     @classmethod
     def _configure_network(cls, app, config, caller):
@@ -151,6 +259,8 @@ class AppUpdater(object):
 
         app.config.HOST = config_host
         app.config.PORT = config_port
+        app.config.WORKERS = max(
+            app.config.get('WORKERS', 1), config['NETWORK'].get('WORKERS', 1))
 
         return None
 
@@ -0,0 +1,6 @@
+from rasa_helpers.nlg import NLGAppUpdater
+
+
+def run(args):
+    filename = NLGAppUpdater.compile(args['<config>'], args['--output'])
+    print(f'NLG bundle written to {filename}')
@@ -3,16 +3,22 @@ __doc__ = """Access rasa helpers CLI tools.
 
 Usage:
   rh serve (all|nlg|nlu) <config>
+  rh compile <config> [--output BUNDLE]
   rh check [<data-files>...] [--domain DOMAIN]...
 
 Details:
   serve:
     Start a NLG and/or NLU server for Rasa.
 
+  compile:
+    Compile NLG responses into a bundle, loaded by `rh serve` at startup.
+
   check:
     Find actions or intents missing from domain.
 
 Optional arguments:
+  -o, --output BUNDLE             Bundle filename (default: config filename
+                                  with a .bundle extension)
   -d, --domain DOMAIN             Domain filename or directory
   -h --help                       Show this
 """
@@ -27,4 +33,8 @@ def main():
         from rasa_helpers.cli_serve import run
         args.pop('serve')
 
+    if args['compile']:
+        from rasa_helpers.cli_compile import run
+        args.pop('compile')
+
     run(args)
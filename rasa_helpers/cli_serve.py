@@ -1,11 +1,15 @@
 from sanic import Sanic
 from sanic.log import logger
 from sanic.response import json
+from sanic.response import raw
 from sanic.response import text
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from rasa_helpers.nlg import NLGAppUpdater, ResponseFetcher
 from rasa_helpers.nlu import NLUAppUpdater, NLURunner
+from rasa_helpers.metrics import Metrics
+from rasa_helpers.file_watcher import FileWatcher, DEFAULT_DEBOUNCE
+from rasa_helpers.shared_store import SharedResponseStore
 
 # __doc__ = """Start a NLG and/or NLU server for Rasa.
 #
@@ -21,19 +25,80 @@ from rasa_helpers.nlu import NLUAppUpdater, NLURunner
 app = Sanic("NLG/NLU server")
 
 async def nlg_tick():
-    NLGAppUpdater.refresh(app)
+    await NLGAppUpdater.refresh_async(app)
+
+async def nlg_files_changed(filenames):
+    await NLGAppUpdater.refresh_async(app, filenames)
 
 async def initialize_nlg_scheduler(app, loop):
+    controls = app.config.NLG_CONTROLS
+    if FileWatcher.use_events(controls):
+        loop.create_task(FileWatcher.watch(
+            FileWatcher.watched_filenames(controls),
+            nlg_files_changed,
+            debounce=controls.get('DEBOUNCE', DEFAULT_DEBOUNCE)))
+        return None
+
     scheduler = AsyncIOScheduler({'event_loop': loop})
     scheduler.add_job(
         nlg_tick, 'interval', seconds=app.config.NLG_REFRESH)
     scheduler.start()
 
+def start_nlg_publisher(app, loop):
+    SharedResponseStore.start_publisher(app, NLGAppUpdater.refresh)
+
+async def attach_nlg_shared_store(app, loop):
+    SharedResponseStore.attach(app)
+
+async def nlu_tick():
+    await NLUAppUpdater.refresh_async(app)
+
+async def nlu_files_changed(filenames):
+    await NLUAppUpdater.refresh_async(app, filenames)
+
+async def initialize_nlu_scheduler(app, loop):
+    controls = app.config.NLU_CONTROLS
+    if FileWatcher.use_events(controls):
+        loop.create_task(FileWatcher.watch(
+            FileWatcher.watched_filenames(controls),
+            nlu_files_changed,
+            debounce=controls.get('DEBOUNCE', DEFAULT_DEBOUNCE)))
+        return None
+
+    scheduler = AsyncIOScheduler({'event_loop': loop})
+    scheduler.add_job(
+        nlu_tick, 'interval', seconds=app.config.NLU_REFRESH)
+    scheduler.start()
+
+async def start_nlu_loading(app, loop):
+    loop.create_task(NLUAppUpdater.load_async(app))
+
 async def get_response(request):
-    res = ResponseFetcher.construct_response(app, request)
-    return json(res)
+    res = ResponseFetcher.construct_response_body(app, request)
+    return raw(res, content_type='application/json')
+
+async def get_responses(request):
+    res = ResponseFetcher.construct_responses_body(app, request)
+    return raw(res, content_type='application/json')
+
+async def get_metrics(request):
+    return json(Metrics.report(app))
+
+async def get_health(request):
+    return json({'status': 'ok'})
+
+async def get_readiness(request):
+    report = {}
+    if 'NLG_CONTROLS' in app.config:
+        report['nlg'] = NLGAppUpdater.readiness(app)
+    if 'NLU_CONTROLS' in app.config:
+        report['nlu'] = NLUAppUpdater.readiness(app)
+    ready = all(r['ready'] for r in report.values())
+    return json(dict(report, ready=ready), status=200 if ready else 503)
 
 async def parse_message(request):
+    if not app.config.NLU_LOADED:
+        return json({'error': 'NLU models are still loading'}, status=503)
     res = await NLURunner.run(app, request)
     print(res)
     return json(res)
@@ -47,17 +112,39 @@ def run(args):
 
     if nlg:
         NLGAppUpdater.configure(app, config_filename)
-        app.register_listener(
-            initialize_nlg_scheduler, 'before_server_start')
+        if app.config.NLG_SHARED_STORE:
+            # A single reloader in the main process, shared by all workers
+            app.register_listener(
+                start_nlg_publisher, 'main_process_start')
+            app.register_listener(
+                attach_nlg_shared_store, 'before_server_start')
+        else:
+            app.register_listener(
+                initialize_nlg_scheduler, 'before_server_start')
         app.add_route(
             get_response, '/nlg', frozenset({'POST'}))
+        app.add_route(
+            get_responses, '/nlg/batch', frozenset({'POST'}))
 
     if nlu:
-        NLUAppUpdater.configure(app, config_filename)
+        # Models are loaded once the server runs, so that `/health` and
+        # `/ready` answer meanwhile
+        NLUAppUpdater.configure(app, config_filename, load=False)
+        app.register_listener(
+            initialize_nlu_scheduler, 'before_server_start')
+        app.register_listener(
+            start_nlu_loading, 'after_server_start')
         app.add_route(
             parse_message, '/model/parse', frozenset({'POST'}))
 
+    app.add_route(
+        get_metrics, '/metrics', frozenset({'GET'}))
+    app.add_route(
+        get_health, '/health', frozenset({'GET'}))
+    app.add_route(
+        get_readiness, '/ready', frozenset({'GET'}))
 
     app.run(
         host=app.config.HOST,
-        port=app.config.PORT)
+        port=app.config.PORT,
+        workers=app.config.WORKERS)
@@ -0,0 +1,126 @@
+import os
+from sanic.log import logger
+from .base_updater import AppUpdater
+try:
+    import watchfiles
+except ImportError:
+    watchfiles = None
+
+DEFAULT_DEBOUNCE = 500 # in milliseconds
+
+
+class FileWatcher(object):
+    """ Reload data as soon as the files listed in `VALUES` change.
+
+        Details:
+            Relies on file system events (inotify on Linux) through
+            `watchfiles`, so nothing is done while files don't change.
+            The `WATCH` control selects how changes are detected:
+            - `auto` (default): file system events if `watchfiles` is
+            installed, interval polling otherwise
+            - `events`: file system events only
+            - `poll`: check file timestamps every `REFRESH` seconds
+            Changes happening within `DEBOUNCE` milliseconds of each other
+            (editors, rsync...) trigger a single reload.
+    """
+
+    @classmethod
+    def use_events(cls, controls):
+        """ Whether changes should be detected with file system events.
+
+            Args:
+                controls (dict): NLG or NLU controls
+
+            Returns:
+                bool
+        """
+        mode = controls.get('WATCH', 'auto')
+        if mode == 'poll':
+            return False
+        if watchfiles is None:
+            if mode == 'events':
+                logger.warning(
+                    '`WATCH: events` needs `watchfiles` to be installed, '
+                    'falling back to polling')
+            return False
+        return True
+
+    @classmethod
+    def watched_filenames(cls, controls):
+        """ Absolute paths of every file listed in `VALUES`."""
+        return {
+            os.path.abspath(AppUpdater._parse_entry(value)[1])
+            for value in controls['VALUES']
+        }
+
+    @classmethod
+    async def watch(cls, filenames, callback, debounce=DEFAULT_DEBOUNCE,
+                    stop_event=None):
+        """ Call `callback` with the files changed, every time some change.
+
+            Details:
+                The parent directories are watched rather than the files
+                themselves, so that files replaced through a rename (as most
+                editors and rsync do) are still followed.
+                Errors raised by `callback` are logged, and watching goes on.
+
+            Args:
+                filenames (set of str): Absolute paths of the files to watch
+                callback (coroutine function): Called with the set of
+                    absolute paths which changed
+                debounce (int): Milliseconds to wait for further changes
+                    before calling `callback`
+                stop_event (asyncio.Event or None): Set it to stop watching
+
+            Returns:
+                None
+        """
+        directories = {os.path.dirname(filename) for filename in filenames}
+        logger.info(f'Watching for changes in {sorted(filenames)}')
+
+        async for changes in watchfiles.awatch(
+                *directories,
+                watch_filter=lambda change, path: os.path.abspath(path) in filenames,
+                debounce=debounce,
+                stop_event=stop_event,
+                recursive=False):
+            changed = {os.path.abspath(path) for _, path in changes}
+            try:
+                await callback(changed)
+            except Exception:
+                logger.exception(f'Could not reload data after changes in {changed}')
+
+        return None
+
+    @classmethod
+    def watch_sync(cls, filenames, callback, debounce=DEFAULT_DEBOUNCE,
+                   stop_event=None):
+        """ Blocking version of `watch`, for use outside of an event loop.
+
+            Args:
+                filenames (set of str): Absolute paths of the files to watch
+                callback (function): Called with the set of absolute paths
+                    which changed
+                debounce (int): Milliseconds to wait for further changes
+                    before calling `callback`
+                stop_event (threading.Event or None): Set it to stop watching
+
+            Returns:
+                None
+        """
+        directories = {os.path.dirname(filename) for filename in filenames}
+        logger.info(f'Watching for changes in {sorted(filenames)}')
+
+        for changes in watchfiles.watch(
+                *directories,
+                watch_filter=lambda change, path: os.path.abspath(path) in filenames,
+                debounce=debounce,
+                stop_event=stop_event,
+                recursive=False):
+            changed = {os.path.abspath(path) for _, path in changes}
+            try:
+                callback(changed)
+            except Exception:
+                logger.exception(f'Could not reload data after changes in {changed}')
+
+        return None
@@ -0,0 +1,47 @@
+class Metrics(object):
+    """ Minimal in-process metrics, kept in `app.config['METRICS']`.
+
+        Details:
+            Counters are plain integers.
+            Observations (durations, sizes...) keep the number of values
+            observed, their total, the last one and the largest one.
+            `rh serve` exposes all metrics as JSON on `/metrics`.
+    """
+
+    @classmethod
+    def _registry(cls, app):
+        if 'METRICS' not in app.config:
+            app.config['METRICS'] = {}
+        return app.config['METRICS']
+
+    @classmethod
+    def increment(cls, app, name, value=1):
+        """ Add `value` to the counter `name`."""
+        registry = cls._registry(app)
+        registry[name] = registry.get(name, 0) + value
+
+        return None
+
+    @classmethod
+    def observe(cls, app, name, value):
+        """ Record one observation of `name`."""
+        registry = cls._registry(app)
+        try:
+            o = registry[name]
+        except KeyError:
+            o = registry[name] = {'count': 0, 'total': 0, 'last': 0, 'max': 0}
+
+        o['count'] += 1
+        o['total'] += value
+        o['last'] = value
+        o['max'] = max(o['max'], value)
+
+        return None
+
+    @classmethod
+    def report(cls, app):
+        """ Copy of every metric, suitable for JSON encoding."""
+        return {
+            name: (dict(value) if isinstance(value, dict) else value)
+            for name, value in cls._registry(app).items()
+        }
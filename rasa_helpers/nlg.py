@@ -1,239 +1,290 @@
+import os
+import sys
+import time
+import pickle
 import random
+import asyncio
+import functools
 import collections
+import concurrent.futures
+from types import MappingProxyType
+from sanic import Sanic
 from sanic.log import logger
+from sanic.response import json_dumps
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+from . import __version__
 from .base_updater import AppUpdater, DEFAULT_VALUE_FLAG
+from .response_template import ResponseTemplate
+from .response_router import ResponseRouter
+from .metrics import Metrics
 
 POOLED_FLAG = '_pooled_'
+# 'collector' is the default channel name within Rasa
+DEFAULT_CHANNEL = 'collector'
+RESTART_RESPONSE_KEY = 'utter_restart'
+RESTART_RESPONSES = (ResponseTemplate({'text': ''}),)
+BUNDLE_EXTENSION = '.bundle'
 
 class ResponseFetcher(object):
 
-    @classmethod
-    def _find_events(cls, request, n, event_type):
-        """ Find latest events in a request.
-
-            Args:
-                request (dict): Incoming request to process
-                n (int): Number of events to select
-                event_type (str): Type of the events to select `action` or `user`
-        """
-        # When looking at response names, we want to grab the yet-to-be-applied
-        # event information
-        assert n > 0
-        first_event = []
-        if event_type == 'action':
-            first_event = [{'name': request['response']}]
-            n -= 1
-        return (first_event
-                + [ev for ev in reversed(request['tracker']['events'])
-                   if ev['event'] == event_type][:n])
-
-    # Extract group from event or request
-    @classmethod
-    def _extract_slot_from_request(cls, request, slot_name):
-        """Slot extractor"""
-        return request['tracker']['slots'].get(slot_name)
-
-    def default_to_none(function):
-        """ Decorator for extraction functions: return None if exception is raised"""
-        def inner(cls, *args, **kwargs):
-            try:
-                return function(cls, *args, **kwargs)
-            except:
-                return None
-        return inner
-
-    def vectorise(function):
-        """ Decorator for extraction functions: make output a list"""
-        def inner(cls, *args, **kwargs):
-            if isinstance(args[0], list):
-                events, *args = args
-                return [function(cls, e, *args, **kwargs) for e in events]
-            else:
-                return [function(cls, *args, **kwargs)]
-        return inner
+    # Reused across requests when `FAST_DECODE` is enabled
+    _parser = None
 
     @classmethod
-    @vectorise
-    @default_to_none
-    def _extract_entities(cls, event, entity_name):
-        """Entity extractor"""
-        return [e['value']
-                for e in event['parse_data']['entities']
-                if e['entity'] == entity_name][0]
+    def _find_response_group(cls, app, request):
+        """ Find the name of the response group appropriate for the request
 
-    @classmethod
-    @vectorise
-    @default_to_none
-    def _extract_suffixes(cls, event, separator):
-        """Suffix extractor"""
-        return event['name'].split(separator)[-1]
+            Details:
+                Uses the router compiled by `NLGAppUpdater.configure`
+                (`NLG_ROUTER`), see `rasa_helpers.response_router`.
 
-    @classmethod
-    @vectorise
-    @default_to_none
-    def _extract_last_intent_suffixes(cls, event, separator):
-        """Last intent suffix extractor"""
-        return event['intent']['name'].split(separator)[-1]
+            Args:
+                app (sanic.Sanic): Sanic app containing the NLG controls
+                request (dict): The incoming request to the server
+
+            Returns:
+                str: Name of the group identified in the request
+        """
+        return app.config.NLG_ROUTER.route(request)
 
     @classmethod
-    def _extract_groups(cls, request, nlg_controls):
-        """ Extract group names from the request.
+    def _lookup_responses(cls, index, group, response_key, channel):
+        """ Find the possible responses for a given group, key and channel.
 
             Details:
-                The extraction is done according to the NLG controls defined in
-                the configuration:
-                - METHOD controls the extraction method to use
-                    `entity`, `slot`, `suffix`, `last_intent_suffix` or `pooled`
-                - HISTORY controls how far to look back in time (must be 1 or more)
-                - NAME controls the entity or slot name to look for (may be None)
-                - SEPARATOR controls the separator to use when splitting response
-                names or intent names for `suffix` or `last_intent_suffix` methods
+                `index` is built by `NLGAppUpdater._build_response_index`, and
+                already accounts for the fallback to the default channel, so
+                this is a single lookup for any channel known at reload time.
 
             Args:
-                request (dict): Incoming request
-                nlg_controls (dict): Extraction configuration
+                index (Mapping): (group, response key, channel) -> variants
+                group (str): Response group
+                response_key (str): Response identifier
+                channel (str): Channel
 
             Returns:
-                list of dict: The groups found in previous events
+                tuple of ResponseTemplate: Possible responses (empty if none
+                    was found)
         """
+        if response_key == RESTART_RESPONSE_KEY:
+            logger.debug('restart session')
+            return RESTART_RESPONSES
 
-        method = nlg_controls['METHOD']
-        history = nlg_controls['HISTORY']
-        entity_or_slot_name = nlg_controls.get('NAME', None)
-        separator = nlg_controls.get('SEPARATOR', None)
-
-        if method == 'pooled':
-            return [POOLED_FLAG]
-        elif method == 'slot':
-            return [cls._extract_slot_from_request(
-                request, entity_or_slot_name)]
-
-        event_type, extract_from_events, arg = {
-            'entity': ('user', cls._extract_entities, entity_or_slot_name),
-            'last_intent_suffix': ('user', cls._extract_last_intent_suffixes, separator),
-            'suffix': ('action', cls._extract_suffixes, separator)
-        }[method]
+        responses = index.get((group, response_key, channel))
+        if responses is None:
+            # Channel unknown at reload time
+            responses = index.get((group, response_key, DEFAULT_CHANNEL), ())
 
-        events = cls._find_events(request, history, event_type)
-        return extract_from_events(events, arg)
+        return responses
 
     @classmethod
-    def _history_fallback(cls, groups):
-        """ Find the likeliest group name in a list.
+    def _lazy_parse(cls, body):
+        """ Parse a request body with `simdjson`.
 
             Details:
-                Assign a score to each group name in the list by counting the
-                number of times they occur, weighing the more recent names higher.
+                `simdjson` only builds Python objects for the values actually
+                accessed: the trackers stay lazy proxies, so looking up a slot
+                by name or scanning the latest events does not decode the rest
+                of the conversation. Accessing an array element by index walks
+                the array from its start, so events are mostly scanned
+                forwards (see `response_router.latest_events`).
 
             Args:
-                groups (list of str): Group names to inspect
+                body (bytes): Raw body of the incoming request
 
             Returns:
-                str or None: The highest scoring group
+                simdjson.Object or simdjson.Array: Lazily decoded body
+        """
+        if cls._parser is None:
+            cls._parser = simdjson.Parser()
+        try:
+            return cls._parser.parse(body)
+        except RuntimeError:
+            # The previous document is still referenced somewhere
+            return simdjson.Parser().parse(body)
 
+    @classmethod
+    def _select_request_fields(cls, document):
+        """ Decode only what is needed to answer an NLG request.
+
+            Args:
+                document (simdjson.Object): Lazily decoded request
+
+            Returns:
+                dict: The request, with a lazily decoded `tracker`
         """
-        groups = [g for g in groups if g]
-        if not groups:
-            return None
+        request = {
+            'tracker': document['tracker'],
+            'arguments': document['arguments'].as_dict()
+        }
+        for key in ['response', 'template']:
+            if key in document:
+                request[key] = document[key]
+        if 'channel' in document:
+            request['channel'] = document['channel'].as_dict()
+
+        return request
 
-        n = len(groups)
-        scores = collections.Counter()
+    @classmethod
+    def _decode_request(cls, app, request):
+        """ Decode the incoming request, lazily if `FAST_DECODE` is enabled.
 
-        for idx, group in enumerate(groups):
-            scores[group] += 1 - (idx/n)
-        group, score = scores.most_common(1)[0]
+            Args:
+                app (sanic.Sanic): App containing the NLG controls
+                request (sanic.request.Request or dict): Incoming request
 
-        return group
+            Returns:
+                dict: The decoded request
+        """
+        if isinstance(request, dict):
+            return request
+        if app.config.NLG_FAST_DECODE:
+            return cls._select_request_fields(cls._lazy_parse(request.body))
+        return request.json
 
     @classmethod
-    def _select_response_group(cls, groups, allowed_groups, default_group):
-        """ Find the group name likeliest to be needed to process the incoming request.
+    def _decode_requests(cls, app, requests):
+        """ Decode a batch of requests, lazily if `FAST_DECODE` is enabled.
 
             Details:
-                If the first group name in the list is valid, we pick that.
-                Otherwise, we attempt to look at the names found in older events
-                    and deduce the likeliest one.
-                If that fails, we use the default.
+                Only the list is decoded: each of its items is decoded by
+                `_decode_batch_item`, so that a bad item only fails itself.
 
             Args:
-                groups (list of str): Group names found by `cls._extract_groups`
-                allowed_groups (list of str): Valid group names as defined in the
-                    configuration
-                default_group (str): Default group as define in the configuration
+                app (sanic.Sanic): App containing the NLG controls
+                requests (sanic.request.Request or list of dict): Incoming
+                    request, whose body is a list of NLG requests
 
             Returns:
-                str: The chosen group
+                list or simdjson.Array: The requests, to be decoded one by one
         """
+        if isinstance(requests, list):
+            return requests
+        if app.config.NLG_FAST_DECODE:
+            return cls._lazy_parse(requests.body)
+        return requests.json
 
-        # Non allowed converted to None
-        clean_groups = [g.lower() if g in allowed_groups
-                        else None
-                        for g in groups]
+    @classmethod
+    def _decode_batch_item(cls, item):
+        """ Decode one of the requests returned by `_decode_requests`."""
+        if isinstance(item, dict):
+            return item
+        return cls._select_request_fields(item)
 
-        group = clean_groups[0]
-        # Best effort
-        if not group:
-            group = cls._history_fallback(clean_groups)
+    @classmethod
+    def _answer_batch(cls, app, requests, answer, default):
+        """ Answer every request of a batch, even if some of them are invalid.
 
-        if not group:
-            logger.warning(
-                f'Could not find usable NLG response group from: {groups}')
-            return default_group
+            Details:
+                The whole batch is answered from the same response index, even
+                if responses are reloaded meanwhile. A request which cannot be
+                answered (missing fields...) gets the default response, and is
+                logged and counted in the `nlg_batch_errors` metric.
 
-        return group
+            Args:
+                app (sanic.Sanic): App containing the responses to select from
+                requests (sanic.request.Request or list of dict): Incoming
+                    requests to process
+                answer (function): Takes the app, the response index and a
+                    decoded request, returns its response
+                default (function): Returns the response for invalid requests
+
+            Returns:
+                list: Responses, in the same order as the requests
+        """
+        index = app.config.NLG_STORE.index
+        responses = []
+        for idx, item in enumerate(cls._decode_requests(app, requests)):
+            try:
+                responses.append(answer(app, index, cls._decode_batch_item(item)))
+            except Exception as e:
+                Metrics.increment(app, 'nlg_batch_errors')
+                logger.error(f'Could not answer request {idx} of the batch: {e!r}')
+                responses.append(default())
+
+        return responses
 
     @classmethod
-    def _fetch_group_responses(cls, app, request):
-        """ Fetch the set of responses appropriate for the request
+    def _select_variant(cls, app, index, request):
+        """ Pick the response variant to send back for a decoded request.
 
             Args:
-                request (dict): The incoming request to the server
-                app (sanic.Sanic): Sanic app containing the responses
+                app (sanic.Sanic): App containing the NLG controls
+                index (Mapping): Response index to select from
+                request (dict): Decoded request
 
             Returns:
-                dict: Responses for the group identified in the request
+                tuple: (ResponseTemplate or None if no variant was found,
+                        arguments for the variant)
         """
-        groups = cls._extract_groups(request, app.config.NLG_CONTROLS)
-        wanted_group = cls._select_response_group(
-            groups,
-            app.config.NLG_LABELS,
-            app.config.NLG_DEFAULT_VALUE)
+        args = request['arguments']
+        try:
+            response_key = request['response']
+        except KeyError:
+            response_key = request['template']
+
+        try:
+            channel = request['channel']['name']
+        except KeyError:
+            channel = DEFAULT_CHANNEL
+
+        group = cls._find_response_group(app, request)
+        responses = cls._lookup_responses(index, group, response_key, channel)
 
-        return app.config.RESPONSES[wanted_group]
+        if not responses:
+            # Neither in the group nor in the default group: counted rather
+            # than logged, as this can happen on every request
+            Metrics.increment(app, 'nlg_missing_responses')
+            logger.debug(
+                f'Could not find response `{response_key}` for channel `{channel}`')
+            return (None, args)
+
+        return (random.choice(responses), args)
 
     @classmethod
-    def _filter_wanted_responses(cls, responses, response_key, channel):
-        """ Find the possible responses for a given key and channel.
+    def _build_response(cls, app, index, request):
+        """ Construct a response for a decoded request.
 
             Args:
-                responses (dict): Response group
-                response_key (str): Response identifier
-                channel (str): Channel
+                app (sanic.Sanic): App containing the NLG controls
+                index (Mapping): Response index to select from
+                request (dict): Decoded request
 
             Returns:
-                list of dict: Possible responses
+                dict: A response sent back to the NLG server
         """
-
-        def try_filter(c):
+        template, args = cls._select_variant(app, index, request)
+        if template is not None:
             try:
-                return [res for res in responses[response_key]
-                        if res.get('channel', 'collector') == c]
+                return template.render(args)
+            except KeyError as e:
+                logger.error(f'Could not render {template}: {e}')
 
-            except KeyError:
-                logger.warning(f'Could not find response `{response_key}`')
-                logger.warning(f'Channel: {c}')
-                return []
+        return ResponseTemplate._copy(app.config.DEFAULT_RESPONSE)
 
-        if response_key == 'utter_restart':
-            logger.debug('restart session')
-            return [{'text': ''}]
+    @classmethod
+    def _encode_response(cls, app, index, request):
+        """ Construct a JSON encoded response for a decoded request.
 
-        for c in [channel, 'collector']:
-            o = try_filter(c)
-            if o:
-                break
+            Args:
+                app (sanic.Sanic): App containing the NLG controls
+                index (Mapping): Response index to select from
+                request (dict): Decoded request
 
-        return o
+            Returns:
+                bytes: A JSON response sent back to the NLG server
+        """
+        template, args = cls._select_variant(app, index, request)
+        if template is not None:
+            try:
+                return template.encode(args)
+            except KeyError as e:
+                logger.error(f'Could not render {template}: {e}')
+
+        return app.config.DEFAULT_RESPONSE_BODY
 
     @classmethod
     def construct_response(cls, app, request):
@@ -241,41 +292,116 @@ class ResponseFetcher(object):
 
             Args:
                 app (sanic.Sanic): App containing the responses to select from
-                request (sanic.request.Request): Incoming request to process
+                request (sanic.request.Request or dict): Incoming request to process
 
             Returns:
                 dict: A response sent back to the NLG server
         """
+        return cls._build_response(
+            app, app.config.NLG_STORE.index, cls._decode_request(app, request))
 
-        try:
-            request = request.json
-        except AttributeError:
-            assert isinstance(request, dict)
+    @classmethod
+    def construct_response_body(cls, app, request):
+        """ Construct a JSON encoded response for the incoming request.
 
+            Details:
+                Variants without placeholders are encoded once when loading
+                responses, and sent as is.
 
-        args = request['arguments']
-        try:
-            response_key = request['response']
-        except KeyError:
-            response_key = request['template']
+            Args:
+                app (sanic.Sanic): App containing the responses to select from
+                request (sanic.request.Request or dict): Incoming request to process
 
-        # 'collector' is the default channel name within Rasa
-        try:
-            channel = request['channel']['name']
-        except KeyError:
-            channel = 'collector'
+            Returns:
+                bytes: A JSON response body sent back to the NLG server
+        """
+        return cls._encode_response(
+            app, app.config.NLG_STORE.index, cls._decode_request(app, request))
 
-        responses = cls._fetch_group_responses(app, request)
-        responses = cls._filter_wanted_responses(
-            responses, response_key, channel)
+    @classmethod
+    def construct_responses(cls, app, requests):
+        """ Construct responses for a batch of requests.
 
-        if responses:
-            res = dict(random.choice(responses))
-            res['text'] = res['text'].format(**args)
-        else:
-            res = app.config.DEFAULT_RESPONSE
+            Details:
+                Can be called in-process with a list of request dicts, without
+                going through the Sanic app routes. Each response is a fresh
+                dict; `/nlg/batch` uses `construct_responses_body` instead.
+                See `_answer_batch` for invalid requests.
 
-        return res
+            Args:
+                app (sanic.Sanic): App containing the responses to select from
+                requests (sanic.request.Request or list of dict): Incoming
+                    requests to process
+
+            Returns:
+                list of dict: Responses, in the same order as the requests
+        """
+        return cls._answer_batch(
+            app, requests, cls._build_response,
+            lambda: ResponseTemplate._copy(app.config.DEFAULT_RESPONSE))
+
+    @classmethod
+    def construct_responses_body(cls, app, requests):
+        """ Construct a JSON encoded list of responses for a batch of requests.
+
+            Details:
+                Responses are encoded one by one (static variants are sent as
+                is, see `construct_response_body`), then joined into a list.
+                See `_answer_batch` for invalid requests.
+
+            Args:
+                app (sanic.Sanic): App containing the responses to select from
+                requests (sanic.request.Request or list of dict): Incoming
+                    requests to process
+
+            Returns:
+                bytes: A JSON response body sent back to the NLG server
+        """
+        return b'[' + b','.join(cls._answer_batch(
+            app, requests, cls._encode_response,
+            lambda: app.config.DEFAULT_RESPONSE_BODY)) + b']'
+
+
+class ResponseStore(object):
+    """ Snapshot of every response loaded, as used to answer requests.
+
+        Details:
+            A store is never modified once built: reloading builds a new one,
+            which replaces the previous one in `app.config['NLG_STORE']`.
+            - responses: group -> raw responses
+            - group_indexes: group -> (response key, channel) -> variants
+            - index: (group, response key, channel) -> variants, with the
+            fallback to the default channel resolved
+            - pooled_owners: group providing each key of the pooled group
+            - generation: incremented by every reload
+            - stats: how many variants the last reload compiled and shared
+    """
+
+    __slots__ = (
+        'responses', 'group_indexes', 'index', 'pooled_owners', 'generation', 'stats')
+
+    def __init__(
+            self, responses, group_indexes, index,
+            pooled_owners=None, generation=0, stats=None):
+        self.responses = responses
+        self.group_indexes = group_indexes
+        self.index = index
+        self.pooled_owners = pooled_owners
+        self.generation = generation
+        self.stats = stats or {}
+
+    def __reduce__(self):
+        # Read-only mappings can't be pickled as such
+        return (self._restore, (
+            dict(self.responses), dict(self.group_indexes), dict(self.index),
+            self.pooled_owners, self.generation, self.stats))
+
+    @classmethod
+    def _restore(
+            cls, responses, group_indexes, index, pooled_owners, generation, stats):
+        return cls(
+            MappingProxyType(responses), MappingProxyType(group_indexes),
+            MappingProxyType(index), pooled_owners, generation, stats)
 
 
 class NLGAppUpdater(AppUpdater):
@@ -309,6 +435,351 @@ class NLGAppUpdater(AppUpdater):
         else:
             return r
 
+    @classmethod
+    def _merge_pooled_responses(
+            cls, responses, order, changed, pooled=None, owners=None):
+        """ Merge the responses of every group into a single pooled group.
+
+            Details:
+                When several groups define the same response key, the group
+                listed first in the config wins.
+                If a previous merge is given, only the keys the changed groups
+                provided or now provide are merged again, giving the same
+                result as a full merge.
+
+            Args:
+                responses (dict): Responses for every group
+                order (list of str): Group names, by decreasing precedence
+                changed (list of str): Groups whose responses changed since
+                    the previous merge
+                pooled (dict or None): Previous merge
+                owners (dict or None): Group providing each key of `pooled`
+
+            Returns:
+                tuple: (pooled: dict, owners: dict)
+        """
+        if pooled is None or owners is None:
+            pooled, owners, changed = {}, {}, order
+        else:
+            pooled, owners = dict(pooled), dict(owners)
+
+        # Keys of the changed groups are all resolved again, whatever the
+        # order of `changed`: a key may go to any group defining it, changed
+        # or not
+        changed = set(changed)
+        stale_keys = {}
+        for response_key in [k for k, owner in owners.items() if owner in changed]:
+            del pooled[response_key]
+            del owners[response_key]
+            stale_keys[response_key] = None
+        for group in order:
+            if group in changed:
+                stale_keys.update(dict.fromkeys(responses[group]))
+
+        for response_key in stale_keys:
+            for group in order:
+                if response_key in responses[group]:
+                    pooled[response_key] = responses[group][response_key]
+                    owners[response_key] = group
+                    break
+
+        return (pooled, owners)
+
+    @classmethod
+    def _deep_sizeof(cls, value):
+        """ Approximate memory used by a variant as parsed from YAML."""
+        size = sys.getsizeof(value)
+        if isinstance(value, dict):
+            size += sum(
+                cls._deep_sizeof(k) + cls._deep_sizeof(v) for k, v in value.items())
+        elif isinstance(value, (list, tuple)):
+            size += sum(cls._deep_sizeof(v) for v in value)
+
+        return size
+
+    @classmethod
+    def _compile_group(cls, group_responses, pool, stats=None):
+        """ Compile the variants of a group, sharing identical variants.
+
+            Details:
+                Variants are looked up in `pool` by fingerprint before being
+                compiled: identical variants, in this group or any other,
+                end up as a single `ResponseTemplate`.
+                Variants without a `channel` are filed under the default
+                `collector` channel.
+
+            Args:
+                group_responses (dict): Responses of a single group
+                pool (dict): fingerprint -> ResponseTemplate, updated in place
+                stats (dict or None): Counters updated in place: `variants`,
+                    `shared_variants` and `bytes_saved` (by sharing variants)
+
+            Returns:
+                tuple: (responses, group_index) where
+                    responses is response key -> tuple of variant payloads
+                    group_index is (response key, channel) -> tuple of
+                        ResponseTemplate
+        """
+        if stats is None:
+            stats = collections.Counter()
+
+        responses = {}
+        group_index = {}
+        for response_key, variants in group_responses.items():
+            response_key = sys.intern(response_key)
+            templates = []
+            wanted = collections.defaultdict(list)
+            for variant in variants:
+                fingerprint = ResponseTemplate.compute_fingerprint(variant)
+                template = pool.get(fingerprint)
+                if template is None:
+                    template = pool[fingerprint] = ResponseTemplate(variant, fingerprint)
+                else:
+                    stats['shared_variants'] += 1
+                    stats['bytes_saved'] += cls._deep_sizeof(variant)
+                stats['variants'] += 1
+                templates.append(template)
+                wanted[variant.get('channel', DEFAULT_CHANNEL)].append(template)
+
+            responses[response_key] = tuple(t.payload for t in templates)
+            for channel, channel_templates in wanted.items():
+                group_index[(response_key, channel)] = tuple(channel_templates)
+
+        return (responses, group_index)
+
+    @classmethod
+    def _build_group_index(cls, group_responses, pool=None):
+        """ Compile and sort by channel the variants of a group.
+
+            Args:
+                group_responses (dict): Responses of a single group
+                pool (dict or None): Templates to share, see `_compile_group`
+
+            Returns:
+                dict: (response key, channel) -> tuple of ResponseTemplate
+        """
+        return cls._compile_group(group_responses, {} if pool is None else pool)[1]
+
+    @classmethod
+    def _build_pooled_index(cls, group_indexes, owners):
+        """ Assemble the index of the pooled group from the other groups' indexes.
+
+            Args:
+                group_indexes (dict): group -> index built by `_build_group_index`
+                owners (dict): Group providing each key of the pooled group
+
+            Returns:
+                dict: (response key, channel) -> tuple of ResponseTemplate
+        """
+        pooled_index = {}
+        for group in set(owners.values()):
+            for (response_key, channel), templates in group_indexes[group].items():
+                if owners[response_key] == group:
+                    pooled_index[(response_key, channel)] = templates
+
+        return pooled_index
+
+    @classmethod
+    def _build_response_index(cls, group_indexes, default_group=None, coverage=None):
+        """ Build the lookup index used by `ResponseFetcher` to find variants.
+
+            Details:
+                The index maps (group, response key, channel) to the tuple of
+                variants to choose from, each compiled into a `ResponseTemplate`.
+                Every channel seen in any group is resolved for every key: if a
+                key has no variant for that channel, the entry points to the
+                default channel variants instead.
+                If `default_group` is given, keys (or channels) missing from a
+                group are then filled from the default group, so that the
+                default group's variants are used rather than the default
+                response.
+                Keys without any suitable variant are left out.
+
+            Args:
+                group_indexes (dict): group -> index built by `_build_group_index`
+                default_group (str or None): Group to take missing keys from
+                coverage (dict or None): Filled with group -> sorted list of
+                    the keys taken from the default group
+
+            Returns:
+                types.MappingProxyType: Read-only index
+        """
+        channels = {DEFAULT_CHANNEL}
+        for group_index in group_indexes.values():
+            channels.update(channel for _, channel in group_index)
+
+        index = {}
+        for group, group_index in group_indexes.items():
+            for (response_key, channel), templates in group_index.items():
+                index[(group, response_key, channel)] = templates
+            for response_key, channel in list(group_index):
+                if channel != DEFAULT_CHANNEL:
+                    continue
+                fallback = group_index[(response_key, DEFAULT_CHANNEL)]
+                for other_channel in channels:
+                    index.setdefault((group, response_key, other_channel), fallback)
+
+        if default_group is None:
+            return MappingProxyType(index)
+
+        default_index = group_indexes[default_group]
+        default_keys = {k for k, _ in default_index}
+        default_entries = [
+            ((response_key, channel), index[(default_group, response_key, channel)])
+            for response_key in default_keys
+            for channel in channels
+            if (default_group, response_key, channel) in index
+        ]
+        for group, group_index in group_indexes.items():
+            if group_index is default_index:
+                continue
+            own_keys = {k for k, _ in group_index}
+            for (response_key, channel), templates in default_entries:
+                index.setdefault((group, response_key, channel), templates)
+            if coverage is not None:
+                missing = sorted(default_keys.difference(own_keys))
+                if missing:
+                    coverage[group] = missing
+
+        return MappingProxyType(index)
+
+    @classmethod
+    def _build_store(cls, app, loaded):
+        """ Build a new response store from the current one and new data.
+
+            Details:
+                Only the groups in `loaded` are compiled again.
+                Neither `app` nor the current store are modified, so that this
+                can run outside of the event loop.
+
+            Args:
+                app (sanic.Sanic): Configured Sanic app
+                loaded (dict): group -> responses loaded from file
+
+            Returns:
+                ResponseStore: The new store
+        """
+        previous = app.config.get('NLG_STORE')
+        if previous is None:
+            responses, group_indexes = {}, {}
+            pooled, owners, generation = None, None, 0
+        else:
+            responses = dict(previous.responses)
+            group_indexes = dict(previous.group_indexes)
+            pooled = previous.responses.get(POOLED_FLAG)
+            owners = previous.pooled_owners
+            generation = previous.generation
+
+        # Share variants with every group already compiled
+        pool = {
+            template.fingerprint: template
+            for group_index in group_indexes.values()
+            for templates in group_index.values()
+            for template in templates
+        }
+        stats = collections.Counter()
+        for group, group_responses in loaded.items():
+            responses[group], group_indexes[group] = cls._compile_group(
+                group_responses, pool, stats)
+
+        default_group = app.config.NLG_DEFAULT_VALUE
+        responses[DEFAULT_VALUE_FLAG] = responses[default_group]
+        group_indexes[DEFAULT_VALUE_FLAG] = group_indexes[default_group]
+
+        if app.config.NLG_CONTROLS.get('METHOD') == 'pooled':
+            pooled, owners = cls._merge_pooled_responses(
+                responses,
+                [cls._parse_entry(v)[0] for v in app.config.NLG_CONTROLS['VALUES']],
+                list(loaded),
+                pooled,
+                owners)
+            responses[POOLED_FLAG] = pooled
+            group_indexes[POOLED_FLAG] = cls._build_pooled_index(
+                group_indexes, owners)
+
+        coverage = {}
+        index = cls._build_response_index(group_indexes, default_group, coverage)
+        stats = dict(stats, keys_from_default=coverage)
+
+        return ResponseStore(
+            responses=MappingProxyType(responses),
+            group_indexes=MappingProxyType(group_indexes),
+            index=index,
+            pooled_owners=owners,
+            generation=generation + 1,
+            stats=stats)
+
+    @classmethod
+    def _install_store(cls, app, store, stale_entries):
+        """ Make a new response store visible to requests."""
+        # Requests only ever read `NLG_STORE`: swapping it is atomic
+        app.config['NLG_STORE'] = store
+        app.config['RESPONSES'] = store.responses
+        app.config.NLG_ROUTER.clear()
+        cls._mark_loaded(app, 'NLG', stale_entries)
+
+        return None
+
+    @classmethod
+    def _get_reload_executor(cls, app):
+        """ Executor used to parse response files, `None` for the default one."""
+        if app.config.NLG_CONTROLS.get('RELOAD_EXECUTOR', 'thread') != 'process':
+            return None
+        if app.config.get('NLG_RELOAD_EXECUTOR') is None:
+            app.config['NLG_RELOAD_EXECUTOR'] = (
+                concurrent.futures.ProcessPoolExecutor(max_workers=1))
+        return app.config.NLG_RELOAD_EXECUTOR
+
+    @classmethod
+    def _log_reload(cls, app, stale_entries, start):
+        duration = time.perf_counter() - start
+        stats = app.config.NLG_STORE.stats
+        Metrics.observe(app, 'nlg_reload_seconds', duration)
+        Metrics.observe(app, 'nlg_shared_variants', stats.get('shared_variants', 0))
+        Metrics.observe(app, 'nlg_bytes_saved', stats.get('bytes_saved', 0))
+        logger.info(
+            f'Reloaded responses for {[e[1] for e in stale_entries]} '
+            f'in {duration:.3f}s, sharing {stats.get("shared_variants", 0)} '
+            f'of {stats.get("variants", 0)} variants '
+            f'({stats.get("bytes_saved", 0)} bytes saved)')
+        for group, missing in stats.get('keys_from_default', {}).items():
+            logger.info(
+                f'{len(missing)} responses missing from `{group}` are taken from '
+                f'`{app.config.NLG_DEFAULT_VALUE}`: {", ".join(missing[:10])}'
+                + (', ...' if len(missing) > 10 else ''))
+
+        return None
+
+    @classmethod
+    def readiness(cls, app):
+        """ Load state of the responses, as served on `/ready`.
+
+            Args:
+                app (sanic.Sanic): Configured Sanic app
+
+            Returns:
+                dict: `ready` (bool), `generation` of the response store,
+                    duration of the last reload, and the timestamp and
+                    fingerprint of each response file under `responses`
+        """
+        store = app.config.get('NLG_STORE')
+        files = {}
+        for value in app.config.NLG_CONTROLS['VALUES']:
+            name, filename, timestamp = cls._parse_entry(value)
+            fingerprint = value.get('FINGERPRINT')
+            files[name] = {
+                'filename': filename,
+                'timestamp': timestamp,
+                'fingerprint': fingerprint[2] if fingerprint else None}
+
+        return {
+            'ready': store is not None,
+            'generation': getattr(store, 'generation', None),
+            'reload_seconds': Metrics.report(app).get(
+                'nlg_reload_seconds', {}).get('last', None),
+            'responses': files
+        }
+
     @classmethod
     def refresh(cls, app):
         """ Update the app responses if a newer version is available.
@@ -316,7 +787,11 @@ class NLGAppUpdater(AppUpdater):
             Details:
                 `app` MUST have been configured once beforehand.
                 `app` is modified in-place.
-                `RESPONSES` field of app config will look like:
+                `NLG_STORE` field of app config holds a `ResponseStore`, which
+                is replaced as a whole whenever something changed.
+                Its `responses` (also in the `RESPONSES` field) hold tuples of
+                compiled variant payloads, shared between groups when identical,
+                and look like:
                     switching_value1:
                         response1:
                             - text: "text switching_value1 response 1 variant 1"
@@ -345,26 +820,173 @@ class NLGAppUpdater(AppUpdater):
             Returns:
                 None
         """
+        start = time.perf_counter()
+        stale_entries = cls._find_stale_entries(app, caller='NLG')
+        if not stale_entries:
+            return None
 
-        updated = super().refresh(app, caller='NLG')
+        loaded = cls._load_stale_entries(
+            stale_entries, 'responses',
+            first_time=app.config.get('NLG_STORE') is None)
+        cls._install_store(app, cls._build_store(app, loaded), stale_entries)
+        cls._log_reload(app, stale_entries, start)
 
-        if updated and app.config.NLG_CONTROLS['METHOD'] == 'pooled':
-            app.config['RESPONSES'][POOLED_FLAG] = (
-                collections.ChainMap(*list(app.config['RESPONSES'].values())))
+        return None
+
+    @classmethod
+    async def refresh_async(cls, app, filenames=None):
+        """ Update the app responses without blocking the event loop.
+
+            Details:
+                Files are parsed in a worker thread, or in a worker process if
+                `RELOAD_EXECUTOR: process` is set in the NLG controls.
+                The new store is built in a worker thread, then installed in
+                a single step: requests see either the old or the new responses.
+                Reload durations are recorded in the `nlg_reload_seconds` metric.
+
+            Args:
+                app (sanic.Sanic): Sanic app to update
+                filenames (set of str or None): If given, only check the
+                    response files in this set of absolute paths
+
+            Returns:
+                None
+        """
+        if app.config.get('NLG_RELOAD_LOCK') is None:
+            app.config['NLG_RELOAD_LOCK'] = asyncio.Lock()
+
+        async with app.config.NLG_RELOAD_LOCK:
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            stale_entries = await loop.run_in_executor(
+                None, functools.partial(
+                    cls._find_stale_entries, app, caller='NLG', filenames=filenames))
+            if not stale_entries:
+                return None
+
+            loaded = await loop.run_in_executor(
+                cls._get_reload_executor(app),
+                cls._load_stale_entries, stale_entries, 'responses')
+            store = await loop.run_in_executor(None, cls._build_store, app, loaded)
+            cls._install_store(app, store, stale_entries)
+            cls._log_reload(app, stale_entries, start)
 
         return None
 
     @classmethod
-    def configure(cls, app, config_filename):
+    def _bundle_filename(cls, app):
+        """ Where to find the compiled bundle for the app config.
+
+            Details:
+                `BUNDLE` in the NLG controls if set, otherwise the config
+                filename with a `.bundle` extension.
+        """
+        try:
+            return app.config.NLG_CONTROLS['BUNDLE']
+        except KeyError:
+            return os.path.splitext(app.config.NLG_CONFIG_FILENAME)[0] + BUNDLE_EXTENSION
+
+    @classmethod
+    def _load_bundle(cls, app):
+        """ Install the response store from a compiled bundle, if usable.
+
+            Details:
+                The bundle is ignored if it is older than the config or any
+                response file, or was compiled from another config or by
+                another version of rasa_helpers.
+
+            Args:
+                app (sanic.Sanic): Sanic app being configured
+
+            Returns:
+                bool: Whether the bundle was loaded
+        """
+        filename = cls._bundle_filename(app)
+        if not os.path.exists(filename):
+            return False
+
+        start = time.perf_counter()
+        sources = [app.config.NLG_CONFIG_FILENAME] + [
+            cls._parse_entry(value)[1] for value in app.config.NLG_CONTROLS['VALUES']]
+        bundle_timestamp = os.lstat(filename).st_mtime
+        if any(os.lstat(source).st_mtime > bundle_timestamp for source in sources):
+            logger.warning(f'{filename} is older than its sources, ignoring it')
+            return False
+
+        with open(filename, 'rb') as f:
+            bundle = pickle.load(f)
+
+        if (bundle['version'] != __version__
+                or bundle['config'] != app.config.NLG_CONFIG_FILENAME):
+            logger.warning(
+                f'{filename} was compiled for another config or version, ignoring it')
+            return False
+
+        for value in app.config.NLG_CONTROLS['VALUES']:
+            fingerprint = bundle['fingerprints'][cls._parse_entry(value)[0]]
+            value['TIMESTAMP'] = fingerprint[1]
+            value['FINGERPRINT'] = fingerprint
+        app.config['NLG_STORE'] = bundle['store']
+        app.config['RESPONSES'] = bundle['store'].responses
+
+        logger.info(
+            f'Loaded responses from {filename} '
+            f'in {time.perf_counter() - start:.3f}s')
+
+        return True
+
+    @classmethod
+    def compile(cls, config_filename, output=None):
+        """ Compile the responses of an NLG config into a bundle.
+
+            Details:
+                The bundle is a pickle of the whole response store, prebuilt
+                indexes and encoded variants included, which `configure` loads
+                instead of parsing response files.
+
+            Args:
+                config_filename (str): NLG config to use
+                output (str or None): Bundle filename, see `_bundle_filename`
+                    for the default
+
+            Returns:
+                str: The bundle filename
+        """
+        app = Sanic('rasa_helpers_compile', register=False)
+        cls.configure(app, config_filename, use_bundle=False)
+
+        filename = output or cls._bundle_filename(app)
+        bundle = {
+            'version': __version__,
+            'config': app.config.NLG_CONFIG_FILENAME,
+            'fingerprints': {
+                cls._parse_entry(value)[0]: value['FINGERPRINT']
+                for value in app.config.NLG_CONTROLS['VALUES']
+            },
+            'store': app.config.NLG_STORE
+        }
+        with open(f'{filename}.tmp', 'wb') as f:
+            pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{filename}.tmp', filename)
+
+        logger.info(f'Compiled responses from {config_filename} into {filename}')
+        return filename
+
+    @classmethod
+    def configure(cls, app, config_filename, use_bundle=True):
         """ Setup the app when first starting the NLG server.
 
             Details:
                 `app` is modified in-place.
                 The config settings are stored in `app.config`.
+                If a bundle compiled by `rh compile` is found, and is not older
+                than the config and response files, responses are loaded from
+                it instead of parsing every response file.
 
             Args:
                 app (sanic.Sanic): Sanic app to configure
                 config_filename (str): NLG config to use
+                use_bundle (bool): Whether to look for a compiled bundle
 
             Returns:
                 None
@@ -373,18 +995,45 @@ class NLGAppUpdater(AppUpdater):
         super().configure(app, config_filename, caller='NLG')
 
         app.config['RESPONSES'] = {}
+        app.config['NLG_STORE'] = None
 
         app.config['NLG_LABELS'] = set(
             [k['NAME'] for k in app.config.NLG_CONTROLS['VALUES']]
             + [DEFAULT_VALUE_FLAG, POOLED_FLAG]
         )
 
+        if 'HISTORY' not in app.config.NLG_CONTROLS.keys():
+            app.config.NLG_CONTROLS['HISTORY'] = 1
+
+        app.config['NLG_ROUTER'] = ResponseRouter.compile(
+            app.config.NLG_CONTROLS,
+            app.config.NLG_LABELS,
+            app.config.NLG_DEFAULT_VALUE,
+            POOLED_FLAG)
+
         app.config.DEFAULT_RESPONSE = [
             {'text': app.config.NLG_CONTROLS['DEFAULT_RESPONSE']}
         ]
+        app.config.DEFAULT_RESPONSE_BODY = (
+            json_dumps(app.config.DEFAULT_RESPONSE).encode())
 
-        if 'HISTORY' not in app.config.NLG_CONTROLS.keys():
-            app.config.NLG_CONTROLS['HISTORY'] = 1
+        app.config['NLG_FAST_DECODE'] = app.config.NLG_CONTROLS.get(
+            'FAST_DECODE', False)
+        if app.config.NLG_FAST_DECODE and simdjson is None:
+            logger.warning(
+                '`FAST_DECODE` needs `pysimdjson` to be installed, '
+                'falling back to regular JSON decoding')
+            app.config['NLG_FAST_DECODE'] = False
+
+        app.config['NLG_SHARED_STORE'] = app.config.NLG_CONTROLS.get(
+            'SHARED_STORE', None)
+        if app.config.NLG_SHARED_STORE:
+            app.config['NLG_SHARED_STORE'] = os.path.abspath(
+                app.config.NLG_SHARED_STORE)
+
+        app.config['NLG_CONFIG_FILENAME'] = os.path.abspath(config_filename)
+        if use_bundle:
+            cls._load_bundle(app)
 
         cls.refresh(app)
 
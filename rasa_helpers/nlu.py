@@ -3,6 +3,14 @@ import sys
 import importlib
 import json
 import re
+import time
+import hashlib
+import inspect
+import functools
+import asyncio
+import threading
+import collections
+import concurrent.futures
 import ruamel.yaml as yaml
 
 import rasa
@@ -11,8 +19,63 @@ RASA_MAJOR_VERSION = int(rasa.__version__[0])
 
 from sanic.log import logger
 from .base_updater import AppUpdater, DEFAULT_VALUE_FLAG
+from .metrics import Metrics
+from .parse_cache import ParseCache
+
+# Parsed by models without any intent to make warm-up messages from
+WARM_UP_MESSAGES = ['Hello']
+
+# Event loop of each inference thread, see `_parse_in_thread`
+_thread_state = threading.local()
+# Chooser of each chooser process, see `_init_chooser_process`
+_process_chooser = None
+
+
+def _parse_in_thread(predict_intent, message):
+    """ Run a model's (asynchronous) parse function in an inference thread.
+
+        Details:
+            Each thread keeps its event loop for its whole life, which suits
+            the inference executor, whose threads live as long as the app.
+    """
+    loop = getattr(_thread_state, 'loop', None)
+    if loop is None:
+        loop = _thread_state.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(predict_intent(message))
+
+
+def _init_chooser_process(filepath, fname):
+    """ Load the user chooser once in each chooser process."""
+    global _process_chooser
+    _process_chooser = NLUAppUpdater._load_chooser_code(filepath, fname)
+
+
+def _choose_in_process(message):
+    return _process_chooser(message)
+
 
 class NLUAppUpdater(AppUpdater):
+    """ Load the NLU models and the chooser code into the app.
+
+        Details:
+            By default, every model listed under `VALUES` is loaded when the
+            server starts. Models can instead be loaded on the first request
+            for their label, and evicted when they no longer fit in a memory
+            budget:
+
+            NLU_CONTROLS:
+                LAZY_LOADING: true
+                MEMORY_BUDGET: 4096  # in MB, no eviction if not given
+                PINNED:  # always loaded, the default model is always pinned
+                    - eng
+                VALUES:
+                    - NAME: fra
+                      FILENAME: ....
+                      MEMORY: 900  # in MB, the file size if not given
+
+            Least recently used models are evicted first, never while
+            requests are waiting for them or parsing with them.
+    """
 
     @classmethod
     def _build_parse_function(cls, agent):
@@ -23,6 +86,66 @@ class NLUAppUpdater(AppUpdater):
             return lambda message: agent.parse_message(
                 message_data=message)
 
+    @classmethod
+    def _build_batch_parse_function(cls, agent):
+        """ Parse several messages with a single run of the model's pipeline.
+
+            Details:
+                Only available with Rasa 3, where the NLU pipeline is a graph
+                taking a list of messages, and not when parsing is delegated
+                to a remote NLU server (`http_interpreter`).
+                Mirrors what `MessageProcessor.parse_message` does when
+                called without a tracker, for the Rasa 3 version installed:
+                the graph gets the same inputs (an empty tracker, with the
+                versions which pass one), and the results go through the same
+                post-processing (full retrieval intent names, warnings about
+                intents and entities missing from the domain). This relies on
+                private methods of the processor.
+
+            Returns:
+                function or None: Takes a list of texts, returns the list of
+                    their parse results
+        """
+        if RASA_MAJOR_VERSION != 3:
+            return None
+
+        processor = agent.processor
+        if processor is None or processor.http_interpreter is not None:
+            return None
+
+        from rasa.core.channels.channel import UserMessage
+        from rasa.engine.constants import PLACEHOLDER_MESSAGE, PLACEHOLDER_TRACKER
+        from rasa.shared.core.trackers import DialogueStateTracker
+
+        pass_tracker = 'tracker' in inspect.signature(
+            processor._parse_message_with_graph).parameters
+        update_retrieval_intent = getattr(
+            processor, '_update_full_retrieval_intent', None)
+
+        def parse_messages(messages):
+            user_messages = [UserMessage(text=m) for m in messages]
+            inputs = {PLACEHOLDER_MESSAGE: user_messages}
+            if pass_tracker:
+                inputs[PLACEHOLDER_TRACKER] = DialogueStateTracker.from_events(
+                    user_messages[0].sender_id, [])
+            target = processor.model_metadata.nlu_target
+            results = processor.graph_runner.run(inputs=inputs, targets=[target])
+
+            parsed = []
+            for message in results[target]:
+                parse_data = {
+                    'text': '',
+                    'intent': {'name': None, 'confidence': 0.0},
+                    'entities': []}
+                parse_data.update(message.as_dict(only_output_properties=True))
+                if update_retrieval_intent is not None:
+                    update_retrieval_intent(parse_data)
+                processor._check_for_unseen_features(parse_data)
+                parsed.append(parse_data)
+            return parsed
+
+        return parse_messages
+
     @classmethod
     def _load_updated_data(cls, filename):
         """Load Rasa NLU model from a file.
@@ -35,9 +158,100 @@ class NLUAppUpdater(AppUpdater):
         """
         agent = Agent.load(model_path=filename)
         agent.predict_intent = cls._build_parse_function(agent)
+        agent.predict_intents = cls._build_batch_parse_function(agent)
 
         return agent
 
+    @classmethod
+    def _warm_up_messages(cls, app, label, model):
+        """ Messages parsed by a model before it answers any request.
+
+            Details:
+                Read from `WARM_UP_FILE` (one message per line), given in the
+                `VALUES` entry of the model or in the NLU controls.
+                Otherwise made up from the model's intent names
+                (`ask_opening_hours` gives `ask opening hours`), up to
+                `WARM_UP_SIZE` of them (10 by default, 0 disables warm-up).
+
+            Returns:
+                list of str
+        """
+        controls = app.config['NLU_CONTROLS']
+        filename = cls._find_entry(app, label)[1].get(
+            'WARM_UP_FILE', controls.get('WARM_UP_FILE', None))
+        if filename:
+            with open(filename, 'r', encoding='utf-8') as f:
+                return [line.strip() for line in f if line.strip()]
+
+        size = controls.get('WARM_UP_SIZE', 10)
+        if not size:
+            return []
+        intents = sorted(cls._extract_labels_from_model(model) or [])[:size]
+        return [intent.replace('_', ' ') for intent in intents] or list(WARM_UP_MESSAGES)
+
+    @classmethod
+    def _warm_up(cls, model, messages):
+        """ Parse a few messages, so that user requests don't pay for lazy
+            initialisations (graph tracing, tokenizers...).
+
+            Details:
+                Messages are parsed one by one, then as a batch if the model
+                can parse batches.
+                Runs in the calling thread, which must not be running an
+                event loop. Loader threads come and go, so the event loop
+                used to parse is closed before returning.
+        """
+        async def parse_messages():
+            for message in messages:
+                await model.predict_intent(message)
+
+        if messages:
+            asyncio.run(parse_messages())
+
+        predict_intents = getattr(model, 'predict_intents', None)
+        if messages and predict_intents is not None:
+            predict_intents(messages)
+
+        return None
+
+    @classmethod
+    def _set_model_state(cls, app, label, state, **details):
+        """ Record the load state of a model, as reported by `readiness`.
+
+            Details:
+                `state` is one of `unloaded`, `loading`, `warming`, `ready`
+                and `failed`. A model being reloaded goes through `loading`
+                and `warming` again, while its previous version still answers.
+        """
+        states = app.config['NLU_MODEL_STATES']
+        states[label] = dict(states.get(label, {}), state=state, **details)
+
+        return None
+
+    @classmethod
+    def _load_and_warm_up(cls, app, label, filename):
+        """ Load a model and warm it up, in a worker thread."""
+        cls._set_model_state(app, label, 'loading')
+        start = time.perf_counter()
+        try:
+            model = cls._load_updated_data(filename)
+            cls._set_model_state(
+                app, label, 'warming', load_seconds=time.perf_counter() - start)
+
+            start = time.perf_counter()
+            messages = cls._warm_up_messages(app, label, model)
+            cls._warm_up(model, messages)
+        except Exception:
+            cls._set_model_state(app, label, 'failed')
+            raise
+
+        duration = time.perf_counter() - start
+        cls._set_model_state(app, label, 'warming', warm_up_seconds=duration)
+        logger.info(
+            f'Warmed up {label} model with {len(messages)} messages in {duration:.3f}s')
+
+        return model
+
     @classmethod
     def _load_chooser_code(cls, filepath, fname):
         """ Load user code to switch between NLU models.
@@ -102,6 +316,254 @@ class NLUAppUpdater(AppUpdater):
                 cls._extract_labels_from_model(loaded_model))
         return labels
 
+    @classmethod
+    def _update_labels(cls, app, labels):
+        """ Set the known intents, and the messages bypassing the chooser."""
+        app.config['NLU_LABELS'] = labels
+        l = '|'.join(labels)
+        app.config['NLU_CHOOSER_BYPASSER'] = re.compile(f'/({l})')
+
+        return None
+
+    @classmethod
+    def _is_lazy(cls, app):
+        return bool(app.config['NLU_CONTROLS'].get('LAZY_LOADING', False))
+
+    @classmethod
+    def _pinned_labels(cls, app):
+        pinned = set(app.config['NLU_CONTROLS'].get('PINNED', None) or [])
+        pinned.update({app.config['NLU_DEFAULT_VALUE'], DEFAULT_VALUE_FLAG})
+        return pinned
+
+    @classmethod
+    def _model_memory(cls, value):
+        """ Memory used by the model of a `VALUES` entry, in MB."""
+        name, filename, timestamp = cls._parse_entry(value)
+        memory = value.get('MEMORY', None)
+        if memory is None:
+            memory = os.path.getsize(filename) / (1 << 20)
+        return memory
+
+    @classmethod
+    def _find_entry(cls, app, label):
+        """ Returns: tuple (idx: int, value: dict) of the `VALUES` entry for `label`"""
+        for idx, value in enumerate(app.config['NLU_CONTROLS']['VALUES']):
+            if cls._parse_entry(value)[0] == label:
+                return (idx, value)
+        raise KeyError(label)
+
+    @classmethod
+    def _add_model(cls, app, label, model):
+        """ Make a (lazily) loaded model available, evicting others if needed."""
+        app.config['MODELS'][label] = model
+        if label == app.config['NLU_DEFAULT_VALUE']:
+            app.config['MODELS'][DEFAULT_VALUE_FLAG] = model
+
+        resident = app.config['NLU_RESIDENT']
+        resident[label] = cls._model_memory(cls._find_entry(app, label)[1])
+        resident.move_to_end(label)
+        cls._evict_models(app, keep=label)
+
+        return None
+
+    @classmethod
+    def _evict_models(cls, app, keep=None):
+        """ Unload least recently used models until they fit in the memory budget.
+
+            Args:
+                app (sanic.Sanic): Configured Sanic app
+                keep (str or None): Label of a model to keep loaded, such as
+                    the one just loaded for a request
+
+            Returns:
+                list of str: Labels of the evicted models
+        """
+        budget = app.config['NLU_CONTROLS'].get('MEMORY_BUDGET', None)
+        if budget is None:
+            return []
+
+        resident = app.config['NLU_RESIDENT']
+        in_use = app.config['NLU_IN_USE']
+        pinned = cls._pinned_labels(app)
+        evicted = []
+        for label in list(resident):
+            if sum(resident.values()) <= budget:
+                break
+            if label in pinned or in_use[label] or label == keep:
+                continue
+            logger.info(f'Unloading {label} model to stay within the memory budget')
+            del resident[label]
+            del app.config['MODELS'][label]
+            cls._set_model_state(app, label, 'unloaded')
+            evicted.append(label)
+
+        if sum(resident.values()) > budget:
+            logger.warning(
+                f'NLU models use {sum(resident.values()):.0f} MB, '
+                f'over the memory budget of {budget} MB')
+        # Evicted models are freed with their last reference: no full
+        # collection, which would stall the event loop
+
+        return evicted
+
+    @classmethod
+    async def _load_lazily(cls, app, label):
+        idx, value = cls._find_entry(app, label)
+        name, filename, timestamp = cls._parse_entry(value)
+        stale, fingerprint = cls._is_stale(filename, 0, value.get('FINGERPRINT'))
+
+        logger.info(f'Loading {label} model on demand from {filename}')
+        loop = asyncio.get_running_loop()
+        model = await loop.run_in_executor(
+            None, cls._load_and_warm_up, app, label, filename)
+
+        cls._swap_model(app, label, model, (idx, label, filename, fingerprint))
+        cls._update_labels(
+            app, app.config['NLU_LABELS'] | cls._extract_labels_from_model(model))
+        app.config['NLU_GENERATION'] = cls._models_generation(app)
+
+        return model
+
+    @classmethod
+    async def ensure_loaded(cls, app, label):
+        """ Load the model for `label` if it is not loaded yet.
+
+            Details:
+                Concurrent requests for a model being loaded all wait for
+                the same load.
+
+            Args:
+                app (sanic.Sanic): Configured Sanic app
+                label (str): Label returned by the chooser
+
+            Returns:
+                None
+        """
+        if label in app.config['MODELS']:
+            if label in app.config['NLU_RESIDENT']:
+                app.config['NLU_RESIDENT'].move_to_end(label)
+            return None
+
+        loading = app.config['NLU_LOADING']
+        task = loading.get(label, None)
+        if task is None:
+            task = loading[label] = asyncio.ensure_future(cls._load_lazily(app, label))
+            task.add_done_callback(lambda _: loading.pop(label, None))
+        await asyncio.shield(task)
+
+        return None
+
+    @classmethod
+    def _entries_to_load(cls, app, stale_entries):
+        """ Stale entries whose model must be (re)loaded now.
+
+            Details:
+                Every stale entry, unless models are loaded lazily: then only
+                the models already loaded, and the pinned ones.
+        """
+        if not cls._is_lazy(app):
+            return stale_entries
+
+        models = app.config['MODELS']
+        pinned = cls._pinned_labels(app)
+        return [e for e in stale_entries if e[1] in models or e[1] in pinned]
+
+    @classmethod
+    def _load_model(cls, app, key, filename):
+        """ Returns: tuple (model, duration: float), warm-up included"""
+        start = time.perf_counter()
+        model = cls._load_and_warm_up(app, key, filename)
+        duration = time.perf_counter() - start
+        logger.info(f'Loaded {key} model from {filename} in {duration:.3f}s')
+        return (model, duration)
+
+    @classmethod
+    def _load_models(cls, app, stale_entries, first_time=False):
+        """ Load the models for stale entries, several at a time.
+
+            Details:
+                Up to `LOAD_WORKERS` (NLU controls, 4 by default) models are
+                loaded at once, each in its own thread: most of the time goes
+                to unpacking archives and building TensorFlow graphs, which
+                release the GIL. Lower it to bound the memory used while
+                loading.
+                Each model is warmed up before this returns.
+
+            Args:
+                app (sanic.Sanic): Sanic app being configured or refreshed
+                stale_entries (list of tuple): As returned by `_find_stale_entries`
+                first_time (bool): Whether the app has no model yet, for logging
+
+            Returns:
+                dict: key -> loaded model
+        """
+        if not stale_entries:
+            return {}
+
+        workers = app.config['NLU_CONTROLS'].get('LOAD_WORKERS', 4)
+        start = time.perf_counter()
+        for idx, key, filename, fingerprint in stale_entries:
+            if first_time:
+                logger.info(f'First-time loading model for {key} from {filename}')
+            else:
+                logger.info(f'{key} model has changed, loading new data from {filename}')
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='nlu-load') as executor:
+            futures = {
+                key: executor.submit(cls._load_model, app, key, filename)
+                for idx, key, filename, fingerprint in stale_entries}
+            loaded = {key: future.result()[0] for key, future in futures.items()}
+
+        logger.info(
+            f'Loaded {len(loaded)} models in {time.perf_counter() - start:.3f}s '
+            f'({workers} at a time)')
+
+        return loaded
+
+    @classmethod
+    def _refresh_models(cls, app):
+        """ Reload the models which changed.
+
+            Details:
+                When models are loaded lazily, changed models which are not
+                loaded (nor pinned) are only marked as such: they will be
+                loaded from the new file when needed.
+
+            Returns:
+                list of str: Names of the entries which changed
+        """
+        stale_entries = cls._find_stale_entries(app, 'NLU')
+        to_load = cls._entries_to_load(app, stale_entries)
+        loaded = cls._load_models(
+            app, to_load, first_time=len(app.config['MODELS']) == 0)
+
+        for entry in to_load:
+            cls._swap_model(app, entry[1], loaded[entry[1]], entry)
+        cls._mark_loaded(
+            app, 'NLU', [e for e in stale_entries if e not in to_load])
+
+        return [e[1] for e in stale_entries]
+
+    @classmethod
+    def _models_generation(cls, app):
+        """ Identify the set of loaded models by the contents of their files.
+
+            Details:
+                Unlike a counter, this stays the same when the server restarts
+                with the same models, so that persisted parse results stay
+                valid.
+
+            Returns:
+                str: Hash of the model names and file fingerprints
+        """
+        h = hashlib.blake2b(digest_size=16)
+        for value in app.config['NLU_CONTROLS']['VALUES']:
+            name, filename, timestamp = cls._parse_entry(value)
+            fingerprint = value.get('FINGERPRINT') or (None, None, timestamp)
+            h.update(f'{name}\x1f{fingerprint[2]}\x1e'.encode('utf-8'))
+        return h.hexdigest()
+
     @classmethod
     def refresh(cls, app):
         """ Update the app responses if a newer version is available.
@@ -120,25 +582,187 @@ class NLUAppUpdater(AppUpdater):
                 None
         """
 
-        updated = super().refresh(app, caller='NLU')
+        updated = cls._refresh_models(app)
         if updated:
-            app.config['NLU_LABELS'] = cls._find_all_model_labels(app)
-            l = '|'.join(app.config['NLU_LABELS'])
-            app.config['NLU_CHOOSER_BYPASSER'] = re.compile(f'/({l})')
+            labels = cls._find_all_model_labels(app)
+            if cls._is_lazy(app):
+                # Evicted models' intents remain known
+                labels.update(app.config.get('NLU_LABELS', set()))
+            cls._update_labels(app, labels)
+            app.config['NLU_GENERATION'] = cls._models_generation(app)
+
+        return None
+
+    @classmethod
+    def _swap_model(cls, app, label, model, entry):
+        """ Replace the model for `label` in a single step.
+
+            Details:
+                Requests already parsing with the previous model keep their
+                reference to it, and finish with it.
+        """
+        if cls._is_lazy(app):
+            cls._add_model(app, label, model)
+        else:
+            app.config['MODELS'][label] = model
+            if label == app.config['NLU_DEFAULT_VALUE']:
+                app.config['MODELS'][DEFAULT_VALUE_FLAG] = model
+        cls._mark_loaded(app, 'NLU', [entry])
+        idx, key, filename, fingerprint = entry
+        cls._set_model_state(
+            app, label, 'ready', filename=filename, timestamp=fingerprint[1],
+            fingerprint=fingerprint[2], loaded_at=time.time())
+
+        return None
+
+    @classmethod
+    def readiness(cls, app):
+        """ Load state of every model, as served on `/ready`.
+
+            Details:
+                The app is ready once the first load is done (see
+                `load_async`), and every model needed to answer requests is
+                loaded and warmed up: all of them, or only the pinned ones
+                when models are loaded lazily.
+
+            Args:
+                app (sanic.Sanic): Configured Sanic app
+
+            Returns:
+                dict: `ready` (bool), `generation` (str, see
+                    `_models_generation`), and the state, file timestamp,
+                    fingerprint and load durations of each model under `models`
+        """
+        models = app.config['MODELS']
+        states = app.config['NLU_MODEL_STATES']
+        labels = [cls._parse_entry(value)[0]
+                  for value in app.config['NLU_CONTROLS']['VALUES']]
+        required = labels
+        if cls._is_lazy(app):
+            pinned = cls._pinned_labels(app)
+            required = [label for label in labels if label in pinned]
+
+        return {
+            'ready': (app.config['NLU_LOADED']
+                      and all(label in models for label in required)),
+            'generation': app.config.get('NLU_GENERATION', None),
+            'models': {
+                label: dict(
+                    states.get(label, {'state': 'unloaded'}), loaded=label in models)
+                for label in labels}
+        }
+
+    @classmethod
+    def _reload_lock(cls, app):
+        if app.config.get('NLU_RELOAD_LOCK') is None:
+            app.config['NLU_RELOAD_LOCK'] = asyncio.Lock()
+        return app.config['NLU_RELOAD_LOCK']
+
+    @classmethod
+    async def load_async(cls, app):
+        """ Load the models for the first time, without blocking the event loop.
+
+            Details:
+                Meant to run in the background once the server has started,
+                for an app configured with `load=False`: `/health` answers
+                meanwhile, `/ready` answers with 503 until every model is
+                loaded and warmed up. Models are loaded as by `refresh`, in
+                a worker thread. Model file changes are only picked up once
+                this is done.
+
+            Args:
+                app (sanic.Sanic): Sanic app configured with `load=False`
+
+            Returns:
+                None
+        """
+        async with cls._reload_lock(app):
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            try:
+                await loop.run_in_executor(None, cls.refresh, app)
+            except Exception:
+                logger.exception('Could not load the NLU models')
+                return None
+            app.config['NLU_LOADED'] = True
+            logger.info(
+                f'NLU models ready after {time.perf_counter() - start:.3f}s')
+
+        return None
+
+    @classmethod
+    async def refresh_async(cls, app, filenames=None):
+        """ Update the app models without blocking the event loop.
+
+            Details:
+                Changed models are loaded and warmed up in a worker thread,
+                one at a time, then swapped in. The previous model is
+                released before the next one is loaded, so that reloading
+                needs the memory of at most one extra model.
+                Reload durations are recorded in the `nlu_reload_seconds` metric.
+
+            Args:
+                app (sanic.Sanic): Sanic app to update
+                filenames (set of str or None): If given, only check the
+                    model files in this set of absolute paths
+
+            Returns:
+                None
+        """
+        async with cls._reload_lock(app):
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            stale_entries = await loop.run_in_executor(
+                None, functools.partial(
+                    cls._find_stale_entries, app, caller='NLU', filenames=filenames))
+            if not stale_entries:
+                return None
+
+            to_load = cls._entries_to_load(app, stale_entries)
+            for entry in to_load:
+                idx, label, filename, fingerprint = entry
+                logger.info(f'{label} model has changed, loading new model from {filename}')
+                model_start = time.perf_counter()
+                model = await loop.run_in_executor(
+                    None, cls._load_and_warm_up, app, label, filename)
+                # The previous model is freed with its last reference, once
+                # requests still parsing with it are done
+                cls._swap_model(app, label, model, entry)
+                logger.info(
+                    f'Swapped in new {label} model after '
+                    f'{time.perf_counter() - model_start:.3f}s')
+
+            # Not loaded (lazy loading): loaded from the new file when needed
+            cls._mark_loaded(
+                app, 'NLU', [e for e in stale_entries if e not in to_load])
+
+            labels = cls._find_all_model_labels(app)
+            if cls._is_lazy(app):
+                labels.update(app.config['NLU_LABELS'])
+            cls._update_labels(app, labels)
+            app.config['NLU_GENERATION'] = cls._models_generation(app)
+
+            duration = time.perf_counter() - start
+            Metrics.observe(app, 'nlu_reload_seconds', duration)
+            logger.info(
+                f'Reloaded models for {[e[1] for e in stale_entries]} in {duration:.3f}s')
 
         return None
 
     @classmethod
-    def configure(cls, app, config_filename):
+    def configure(cls, app, config_filename, load=True):
         """ Setup the app when first starting the NLU server.
 
             Details:
                 `app` is modified in-place.
                 The config settings are stored in `app.config`.
+                With `load=False`, no model is loaded yet: call `load_async`
+                once the event loop runs.
 
             Args:
                 app (sanic.Sanic): Sanic app to configure
                 config_filename (str): NLU config to use
+                load (bool): Whether to load the models right away
 
             Returns:
                 None
@@ -147,25 +771,177 @@ class NLUAppUpdater(AppUpdater):
         super().configure(app, config_filename, caller='NLU')
 
         app.config['MODELS'] = {}
+        app.config['NLU_LOADED'] = False
+        app.config['NLU_RESIDENT'] = collections.OrderedDict()
+        app.config['NLU_LOADING'] = {}
+        app.config['NLU_IN_USE'] = collections.Counter()
+        app.config['NLU_MODEL_STATES'] = {}
+        app.config['NLU_EXECUTORS'] = {}
+        app.config['NLU_BATCHERS'] = {}
+        app.config['NLU_CACHE'] = ParseCache.from_controls(app.config.NLU_CONTROLS)
         app.config.NLU_CHOOSER = cls._load_chooser_code(
             app.config.NLU_CONTROLS['MODEL_CHOOSER']['FILEPATH'],
             app.config.NLU_CONTROLS['MODEL_CHOOSER']['FUNCTION']
         )
 
-        cls.refresh(app)
+        if load:
+            cls.refresh(app)
+            app.config['NLU_LOADED'] = True
+
+        return None
+
+class NLUBatcher(object):
+    """ Queue the messages sent to a model, and parse them in batches.
+
+        Details:
+            A batch is parsed as soon as it holds `max_size` messages, or
+            `max_wait` milliseconds after its first message arrived.
+            Every caller gets its own message's result (or exception).
+
+        Args:
+            app (sanic.Sanic): Configured Sanic app
+            label (str): Label of the model to use
+            max_size (int): Maximum number of messages in a batch
+            max_wait (float): Maximum wait before parsing a batch, in milliseconds
+    """
+
+    def __init__(self, app, label, max_size, max_wait):
+        self.app = app
+        self.label = label
+        self.max_size = max_size
+        self.max_wait = max_wait / 1000
+        self.pending = []
+        self.timer = None
+
+    def submit(self, message):
+        """ Queue a message.
+
+            Returns:
+                asyncio.Future: Resolves to the parse result of the message
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((message, future))
+
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_wait, self.flush)
+
+        return future
+
+    def flush(self):
+        """ Parse the queued messages, in a background task."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.get_running_loop().create_task(self._parse(batch))
 
         return None
 
+    async def _parse(self, batch):
+        try:
+            results = await NLURunner.run_batch_classification(
+                self.app, self.label, [message for message, _ in batch])
+        except Exception as e:
+            logger.exception(f'Could not parse a batch of {len(batch)} messages')
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return None
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+        return None
+
+
 class NLURunner(object):
+    """ Answer NLU requests: pick a model with the chooser, then parse.
+
+        Details:
+            By default, the chooser and the model run on the event loop, so a
+            CPU heavy request stalls every other one. Either can be moved to
+            an executor with the NLU controls:
+
+            NLU_CONTROLS:
+                CHOOSER_EXECUTOR: process  # `thread`, `process` or `none`
+                CHOOSER_WORKERS: 2
+                INFERENCE_EXECUTOR: thread  # `thread` or `none`
+                INFERENCE_WORKERS: 4
+
+            Threads suit code releasing the GIL (e.g. TensorFlow inference);
+            each inference thread runs the models' parse coroutines in its
+            own event loop. Processes suit pure Python choosers: each one
+            loads the chooser code once, when it starts.
+            Executors are created on first use, so that each Sanic worker
+            gets its own.
+
+            Messages for the same model can also be parsed in batches:
+
+            NLU_CONTROLS:
+                BATCH_SIZE: 32  # 1 (default) disables batching
+                BATCH_WAIT: 5  # in milliseconds
+
+            With Rasa 3, a batch goes through the model's pipeline in a
+            single run (see `NLUAppUpdater._build_batch_parse_function`);
+            otherwise its messages are parsed one by one.
+            Messages starting with `/` (intents given directly) are never
+            batched.
+
+            Results for repeated messages can be cached, see `ParseCache`
+            for the `CACHE_SIZE`, `CACHE_LOWERCASE` and `CACHE_PATH`
+            controls.
+    """
 
     @classmethod
     def _unpack_request(cls, request):
         return request.json['text']
 
     @classmethod
-    async def _amend_response(cls, app, response, label, confidence):
+    def _get_executor(cls, app, kind):
+        """ Executor for `CHOOSER` or `INFERENCE`, `None` for the event loop.
+
+            Args:
+                app (sanic.Sanic): Configured Sanic app
+                kind (str): `CHOOSER` or `INFERENCE`
+
+            Returns:
+                concurrent.futures.Executor or None
+        """
+        executors = app.config['NLU_EXECUTORS']
+        try:
+            return executors[kind]
+        except KeyError:
+            pass
+
+        controls = app.config['NLU_CONTROLS']
+        mode = controls.get(f'{kind}_EXECUTOR', 'none')
+        workers = controls.get(f'{kind}_WORKERS', None)
+        if mode == 'thread':
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix=f'nlu-{kind.lower()}')
+        elif mode == 'process' and kind == 'CHOOSER':
+            chooser = controls['MODEL_CHOOSER']
+            executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_init_chooser_process,
+                initargs=(chooser['FILEPATH'], chooser['FUNCTION']))
+        else:
+            if mode != 'none':
+                logger.warning(
+                    f'Unsupported {kind}_EXECUTOR `{mode}`, running on the event loop')
+            executor = None
+
+        executors[kind] = executor
+        return executor
+
+    @classmethod
+    def _amend_response(cls, app, response, label, confidence):
         logger.debug(response)
-        response = await response
 
         response['entities'].append({
             'start': 0,
@@ -199,15 +975,110 @@ class NLURunner(object):
             #     raise AssertionError
         return o
 
+    @classmethod
+    async def run_chooser_async(cls, app, message):
+        """ `run_chooser`, in the chooser executor if there is one."""
+        executor = cls._get_executor(app, 'CHOOSER')
+        if executor is None or cls._bypass_nlu(app, message):
+            return cls.run_chooser(app, message)
+
+        loop = asyncio.get_running_loop()
+        if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+            return await loop.run_in_executor(executor, _choose_in_process, message)
+        return await loop.run_in_executor(executor, app.config['NLU_CHOOSER'], message)
+
     @classmethod
     def run_intent_classification(cls, app, label, message):
         return app.config.MODELS[label].predict_intent(message)
 
     @classmethod
-    def run(cls, app, request):
+    async def run_intent_classification_async(cls, app, label, message):
+        """ `run_intent_classification`, in the inference executor if there is one."""
+        executor = cls._get_executor(app, 'INFERENCE')
+        if executor is None:
+            return await cls.run_intent_classification(app, label, message)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, _parse_in_thread,
+            app.config.MODELS[label].predict_intent, message)
+
+    @classmethod
+    async def run_batch_classification(cls, app, label, messages):
+        """ Parse several messages with the same model.
+
+            Details:
+                Uses the model's batch parse function if it has one (in the
+                inference executor if there is one), parses the messages one
+                by one otherwise.
+
+            Returns:
+                list of dict: Parse results, in the order of `messages`
+        """
+        model = app.config.MODELS[label]
+        predict_intents = getattr(model, 'predict_intents', None)
+        if predict_intents is None:
+            return [
+                await cls.run_intent_classification_async(app, label, message)
+                for message in messages]
+
+        executor = cls._get_executor(app, 'INFERENCE')
+        if executor is None:
+            return predict_intents(messages)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, predict_intents, messages)
+
+    @classmethod
+    def _get_batcher(cls, app, label):
+        """ Batcher for a model label, `None` if batching is disabled."""
+        batchers = app.config['NLU_BATCHERS']
+        try:
+            return batchers[label]
+        except KeyError:
+            pass
+
+        controls = app.config['NLU_CONTROLS']
+        max_size = controls.get('BATCH_SIZE', 1)
+        batchers[label] = (
+            NLUBatcher(app, label, max_size, controls.get('BATCH_WAIT', 5))
+            if max_size > 1 else None)
+
+        return batchers[label]
+
+    @classmethod
+    async def run(cls, app, request):
         message = cls._unpack_request(request)
-        label, confidence = cls.run_chooser(app, message)
-        response_cl = cls.run_intent_classification(app, label, message)
-        response = cls._amend_response(app, response_cl, label, confidence)
 
-        return response
+        cache = app.config['NLU_CACHE']
+        if cache is not None:
+            generation = app.config['NLU_GENERATION']
+            hit = cache.get(message, generation)
+            Metrics.increment(
+                app, 'nlu_cache_misses' if hit is None else 'nlu_cache_hits')
+            if hit is not None:
+                return cls._amend_response(app, hit[2], hit[0], hit[1])
+
+        label, confidence = await cls.run_chooser_async(app, message)
+
+        lazy = NLUAppUpdater._is_lazy(app)
+        if lazy:
+            # Taken before waiting for the load, so that loads finishing
+            # meanwhile cannot evict the model
+            app.config['NLU_IN_USE'][label] += 1
+        try:
+            if lazy:
+                await NLUAppUpdater.ensure_loaded(app, label)
+            batcher = cls._get_batcher(app, label)
+            if batcher is None or message.strip().startswith('/'):
+                response = await cls.run_intent_classification_async(app, label, message)
+            else:
+                response = await batcher.submit(message)
+        finally:
+            if lazy:
+                app.config['NLU_IN_USE'][label] -= 1
+
+        if cache is not None:
+            cache.put(message, generation, label, confidence, response)
+
+        return cls._amend_response(app, response, label, confidence)
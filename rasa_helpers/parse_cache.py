@@ -0,0 +1,249 @@
+import json
+import asyncio
+import sqlite3
+import threading
+import collections
+import concurrent.futures
+from sanic.log import logger
+
+
+class ParseCache(object):
+    """ Bounded cache of NLU parse results, keyed by normalised message text.
+
+        Details:
+            Messages are normalised by stripping surrounding whitespace (and
+            optionally lowercasing them). Each entry holds the chooser label
+            and confidence, and the model's parse result. Entity offsets are
+            stored relative to the normalised text, and shifted back for the
+            message being answered.
+
+            The cache belongs to a single model generation (see
+            `NLUAppUpdater._models_generation`): when the generation changes,
+            every entry is dropped, and results computed with the previous
+            models are not stored.
+
+            With a `path`, entries are also kept in a SQLite file, so that
+            a restarted server starts with a warm cache. Changes to the file
+            are queued, and written every `flush_delay` seconds in a single
+            transaction, in a thread of their own: when called from the
+            event loop, `put` never waits for the disk.
+
+        Args:
+            size (int): Maximum number of entries kept in memory
+            lowercase (bool): Whether to ignore case when looking up messages
+            path (str or None): SQLite file for the persistent tier
+    """
+
+    # Seconds between writes to the SQLite file
+    flush_delay = 1.0
+
+    def __init__(self, size, lowercase=False, path=None):
+        self.size = size
+        self.lowercase = lowercase
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.generation = None
+        self.connections = threading.local()
+        # SQL statements not written yet, with their parameters
+        self.pending = []
+        self.writer = None
+        self.flushing = None
+
+    @classmethod
+    def from_controls(cls, controls):
+        """ Build the cache from the NLU controls, `None` if disabled.
+
+            Details:
+                NLU_CONTROLS:
+                    CACHE_SIZE: 10000  # 0 (default) disables the cache
+                    CACHE_LOWERCASE: false
+                    CACHE_PATH: nlu_cache.sqlite  # optional
+        """
+        size = controls.get('CACHE_SIZE', 0)
+        if not size:
+            return None
+        return cls(
+            size,
+            lowercase=controls.get('CACHE_LOWERCASE', False),
+            path=controls.get('CACHE_PATH', None))
+
+    def _normalise(self, message):
+        """ Returns: tuple (key: str, text: str, lead: int)"""
+        text = message.strip()
+        lead = len(message) - len(message.lstrip())
+        key = text.lower() if self.lowercase else text
+        return (key, text, lead)
+
+    def _db(self):
+        """ SQLite connection of the calling thread, opened on first use so
+            that each worker (and the writer thread) gets its own.
+        """
+        connection = getattr(self.connections, 'connection', None)
+        if connection is None:
+            connection = self.connections.connection = sqlite3.connect(self.path)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS parses '
+                '(key TEXT PRIMARY KEY, generation TEXT, entry TEXT)')
+        return connection
+
+    def _write(self, statements):
+        with self._db() as db:
+            for statement, parameters in statements:
+                db.execute(statement, parameters)
+
+        return None
+
+    def _queue(self, statement, parameters):
+        """ Queue a change to the SQLite file.
+
+            Details:
+                Outside of an event loop (in-process use), the change is
+                written right away.
+        """
+        self.pending.append((statement, parameters))
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return None
+
+        if self.flushing is None:
+            self.flushing = loop.call_later(self.flush_delay, self._flush_later, loop)
+        return None
+
+    def _flush_later(self, loop):
+        self.flushing = None
+        if self.writer is None:
+            self.writer = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='nlu-cache')
+        statements, self.pending = self.pending, []
+        return loop.run_in_executor(self.writer, self._write, statements)
+
+    def flush(self):
+        """ Write the queued changes to the SQLite file, in the calling thread.
+
+            Returns:
+                None
+        """
+        statements, self.pending = self.pending, []
+        if statements:
+            self._write(statements)
+
+        return None
+
+    def _switch(self, generation):
+        """ Drop every entry computed with other models than `generation`."""
+        if generation == self.generation:
+            return None
+
+        logger.debug('NLU models changed, emptying the parse cache')
+        self.entries.clear()
+        self.generation = generation
+        if self.path:
+            # Lookups check the generation, so the old rows can go later
+            self._queue('DELETE FROM parses WHERE generation != ?', (generation,))
+
+        return None
+
+    def _lookup(self, key):
+        try:
+            entry = self.entries[key]
+        except KeyError:
+            pass
+        else:
+            self.entries.move_to_end(key)
+            return entry
+
+        if not self.path:
+            return None
+
+        row = self._db().execute(
+            'SELECT entry FROM parses WHERE key = ? AND generation = ?',
+            (key, self.generation)).fetchone()
+        if row is None:
+            return None
+
+        entry = self.entries[key] = row[0]
+        self._evict()
+        return entry
+
+    def _evict(self):
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+        return None
+
+    def get(self, message, generation):
+        """ Cached (label, confidence, response) for a message, or `None`.
+
+            Args:
+                message (str): Message text, as received
+                generation (str): Current model generation
+
+            Returns:
+                tuple or None: (label: str, confidence: float, response: dict),
+                    the response being a fresh copy which can be amended
+        """
+        self._switch(generation)
+        key, text, lead = self._normalise(message)
+        entry = self._lookup(key)
+        if entry is None:
+            return None
+
+        label, confidence, cached_text, response = json.loads(entry)
+        response['text'] = message
+        for entity in response.get('entities', []):
+            start, end = entity.get('start'), entity.get('end')
+            if start is None or end is None:
+                continue
+            # Values taken verbatim from the text follow the message's case
+            if entity.get('value') == cached_text[start:end]:
+                entity['value'] = text[start:end]
+            entity['start'] = start + lead
+            entity['end'] = end + lead
+
+        return (label, confidence, response)
+
+    def put(self, message, generation, label, confidence, response):
+        """ Store the parse result of a message.
+
+            Details:
+                Ignored if the models changed while the message was parsed.
+
+            Args:
+                message (str): Message text, as received
+                generation (str): Model generation the message was parsed with
+                label (str): Label returned by the chooser
+                confidence (float): Confidence returned by the chooser
+                response (dict): Parse result, before being amended
+
+            Returns:
+                None
+        """
+        if self.generation is None:
+            self._switch(generation)
+        if generation != self.generation:
+            return None
+
+        key, text, lead = self._normalise(message)
+        response = dict(response)
+        if lead:
+            response['entities'] = [
+                dict(entity, start=entity['start'] - lead, end=entity['end'] - lead)
+                if entity.get('start') is not None and entity.get('end') is not None
+                else entity
+                for entity in response.get('entities', [])]
+        entry = json.dumps([label, confidence, text, response])
+
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self._evict()
+
+        if self.path:
+            self._queue(
+                'INSERT OR REPLACE INTO parses VALUES (?, ?, ?)',
+                (key, generation, entry))
+
+        return None
@@ -0,0 +1,623 @@
+import time
+import itertools
+import collections
+from sanic.log import logger
+
+WILDCARD = '*'
+DIMENSION_SEPARATOR = '/'
+# Events of a lazily decoded tracker accessed by index, see `latest_events`
+REVERSE_SCAN_LIMIT = 32
+
+
+def history_fallback(groups):
+    """ Find the likeliest group name in a list.
+
+        Details:
+            Assign a score to each group name in the list by counting the
+            number of times they occur, weighing the more recent names higher.
+
+        Args:
+            groups (list of str): Group names to inspect
+
+        Returns:
+            str or None: The highest scoring group
+    """
+    groups = [g for g in groups if g]
+    if not groups:
+        return None
+
+    n = len(groups)
+    scores = collections.Counter()
+
+    for idx, group in enumerate(groups):
+        scores[group] += 1 - (idx/n)
+    group, score = scores.most_common(1)[0]
+
+    return group
+
+
+def latest_events(events, event_type, n):
+    """ The latest `n` events of a given type, latest first.
+
+        Details:
+            Plain lists are scanned backwards, stopping as soon as `n` events
+            were found. Lazily decoded arrays (`FAST_DECODE`) are walked from
+            their start on every index access: only their last
+            `REVERSE_SCAN_LIMIT` events are accessed by index, backwards, and
+            if that is not enough, the rest is scanned forwards, once.
+
+        Args:
+            events (list or simdjson.Array): Tracker events
+            event_type (str): Type of the events to keep (`user`, `bot`...)
+            n (int): Maximum number of events to return
+
+        Yields:
+            dict or simdjson.Object
+    """
+    if n <= 0:
+        return
+    if events.__class__ is list:
+        yield from itertools.islice(
+            (event for event in reversed(events) if event.get('event') == event_type),
+            n)
+        return
+
+    n_events = len(events)
+    head = max(n_events - REVERSE_SCAN_LIMIT, 0)
+    for idx in range(n_events - 1, head - 1, -1):
+        event = events[idx]
+        if event.get('event') == event_type:
+            yield event
+            n -= 1
+            if not n:
+                return
+    if head:
+        yield from reversed(collections.deque(
+            (event for event in itertools.islice(events, head)
+             if event.get('event') == event_type),
+            maxlen=n))
+
+
+class ResponseRouter(object):
+    """ Pick the response group of a request, as compiled from the NLG controls.
+
+        Details:
+            Routers are built once, when the app is configured, so that
+            nothing is read from the config when a request comes in. Each
+            `METHOD` has its own router, which only looks at the parts of the
+            request it needs, and checks values instead of catching errors.
+            Event-based routers stop scanning the tracker as soon as the
+            latest event gives a valid group; older events (up to `HISTORY`)
+            are only looked at when it does not.
+
+        Args:
+            groups (iterable of str): Valid group names
+            default_group (str): Group to use if no valid group is found
+    """
+
+    __slots__ = ('groups', 'default_group')
+
+    def __init__(self, groups, default_group):
+        self.groups = {g: g.lower() for g in groups}
+        self.default_group = default_group
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(default_group={self.default_group!r})'
+
+    def _fallback(self, values):
+        """ Slow path: none of the latest values is a valid group."""
+        group = history_fallback([
+            self.groups.get(v) if v.__class__ is str else None
+            for v in values])
+        if group is None and self.default_group is not None:
+            logger.warning(
+                f'Could not find usable NLG response group from: {values}')
+            return self.default_group
+
+        return group
+
+    def route(self, request):
+        """ Find the name of the response group appropriate for the request
+
+            Args:
+                request (dict): The incoming request to the server
+
+            Returns:
+                str: Name of the group identified in the request
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Forget anything kept from previous requests."""
+        return None
+
+    @classmethod
+    def compile(cls, nlg_controls, groups, default_group, pooled_group):
+        """ Build the router matching the NLG controls.
+
+            Args:
+                nlg_controls (dict): Extraction configuration:
+                    - METHOD: `entity`, `slot`, `suffix`, `last_intent_suffix`
+                    or `pooled`
+                    - HISTORY: how many events to look back (1 or more)
+                    - NAME: entity or slot name to look for
+                    - SEPARATOR: separator splitting response or intent names
+                    for `suffix` and `last_intent_suffix`
+                    - STICKY_CACHE, STICKY_TTL, DIMENSIONS: see
+                    `StickyRouter` and `CompositeRouter`
+                groups (iterable of str): Valid group names
+                default_group (str): Group to use if no valid group is found
+                pooled_group (str): Group holding the pooled responses
+
+            Returns:
+                ResponseRouter or StickyRouter: The latter if `STICKY_CACHE`
+                    is set, for methods looking at tracker events
+
+            Raises:
+                ValueError: if `METHOD` is unknown
+        """
+        if 'DIMENSIONS' in nlg_controls:
+            return CompositeRouter.compile_dimensions(
+                nlg_controls, groups, default_group, pooled_group)
+
+        router = cls._compile_method(
+            nlg_controls, groups, default_group, pooled_group)
+
+        size = nlg_controls.get('STICKY_CACHE', 0)
+        if size and isinstance(router, EventRouter):
+            return StickyRouter(router, size, nlg_controls.get('STICKY_TTL', None))
+
+        return router
+
+    @classmethod
+    def _compile_method(cls, nlg_controls, groups, default_group, pooled_group):
+        method = nlg_controls['METHOD']
+        name = nlg_controls.get('NAME', None)
+        separator = nlg_controls.get('SEPARATOR', None)
+        history = nlg_controls.get('HISTORY', 1)
+
+        if method == 'pooled':
+            return ConstantRouter(pooled_group)
+        elif method == 'slot':
+            return SlotRouter(groups, default_group, name)
+        elif method == 'entity':
+            return EntityRouter(groups, default_group, history, name)
+        elif method == 'suffix':
+            return SuffixRouter(groups, default_group, history, separator)
+        elif method == 'last_intent_suffix':
+            return LastIntentSuffixRouter(groups, default_group, history, separator)
+
+        raise ValueError(f'Unknown NLG METHOD `{method}`')
+
+
+class ConstantRouter(ResponseRouter):
+    """ Always the same group (`pooled` method)."""
+
+    __slots__ = ('group',)
+
+    def __init__(self, group):
+        super().__init__((group,), group)
+        self.group = group
+
+    def route(self, request):
+        return self.group
+
+
+class SlotRouter(ResponseRouter):
+    """ Group named after the value of a slot (`slot` method)."""
+
+    __slots__ = ('slot_name',)
+
+    def __init__(self, groups, default_group, slot_name):
+        super().__init__(groups, default_group)
+        self.slot_name = slot_name
+
+    def route(self, request):
+        value = request['tracker']['slots'].get(self.slot_name)
+        group = self.groups.get(value) if value.__class__ is str else None
+        if group is not None:
+            return group
+
+        return self._fallback([value])
+
+
+class EventRouter(ResponseRouter):
+    """ Group found in the latest `history` events of a given type.
+
+        Details:
+            Subclasses define `event_type` and `extract`, which returns the
+            group name found in an event (a string) or None.
+    """
+
+    __slots__ = ('history',)
+
+    event_type = None
+
+    def __init__(self, groups, default_group, history):
+        super().__init__(groups, default_group)
+        assert history > 0
+        self.history = history
+
+    def extract(self, event):
+        raise NotImplementedError
+
+    def _latest_values(self, request, values):
+        """ Append the values of the latest events to `values`.
+
+            Details:
+                Stops at the first valid group if `values` is empty.
+
+            Returns:
+                str or None: The first group, if it is valid
+        """
+        groups = self.groups
+        events = latest_events(
+            request['tracker']['events'], self.event_type, self.history - len(values))
+        for event in events:
+            value = self.extract(event)
+            if not values and value.__class__ is str:
+                group = groups.get(value)
+                if group is not None:
+                    return group
+            values.append(value)
+
+        return None
+
+    def route(self, request):
+        values = []
+        group = self._latest_values(request, values)
+        if group is not None:
+            return group
+
+        return self._fallback(values)
+
+    @property
+    def event_history(self):
+        """ Number of values to keep from tracker events."""
+        return self.history
+
+    def collect(self, events, values):
+        """ Add the values found in `events` to the left of `values`.
+
+            Args:
+                events (list): New tracker events, oldest first
+                values (collections.deque): Latest values first, with
+                    `event_history` as maximum length
+
+            Returns:
+                None
+        """
+        for event in reversed(list(latest_events(events, self.event_type, values.maxlen))):
+            value = self.extract(event)
+            # Only strings can be groups, and are safe to keep around
+            values.appendleft(value if value.__class__ is str else None)
+
+        return None
+
+    def route_values(self, request, values):
+        """ Same as `route`, with the values collected from events."""
+        value = values[0] if values else None
+        group = self.groups.get(value) if value.__class__ is str else None
+        if group is not None:
+            return group
+
+        return self._fallback(list(values))
+
+
+class EntityRouter(EventRouter):
+    """ Group named after the value of an entity in user messages (`entity` method)."""
+
+    __slots__ = ('entity_name',)
+
+    event_type = 'user'
+
+    def __init__(self, groups, default_group, history, entity_name):
+        super().__init__(groups, default_group, history)
+        self.entity_name = entity_name
+
+    def extract(self, event):
+        parse_data = event.get('parse_data')
+        if not parse_data:
+            return None
+        for entity in parse_data.get('entities', ()):
+            if entity.get('entity') == self.entity_name:
+                return entity.get('value')
+
+        return None
+
+
+class LastIntentSuffixRouter(EventRouter):
+    """ Group named after the suffix of user intents (`last_intent_suffix` method)."""
+
+    __slots__ = ('separator',)
+
+    event_type = 'user'
+
+    def __init__(self, groups, default_group, history, separator):
+        super().__init__(groups, default_group, history)
+        self.separator = separator
+
+    def _suffix(self, name):
+        if name.__class__ is not str:
+            return None
+        if self.separator is None:
+            parts = name.split()
+            return parts[-1] if parts else None
+
+        return name.rpartition(self.separator)[2]
+
+    def extract(self, event):
+        intent = event.get('intent')
+        return self._suffix(intent.get('name')) if intent else None
+
+
+class SuffixRouter(LastIntentSuffixRouter):
+    """ Group named after the suffix of response names (`suffix` method).
+
+        Details:
+            The response being requested counts as the latest action event.
+    """
+
+    __slots__ = ()
+
+    event_type = 'action'
+
+    def extract(self, event):
+        return self._suffix(event.get('name'))
+
+    def route(self, request):
+        value = self._suffix(request['response'])
+        if value.__class__ is str:
+            group = self.groups.get(value)
+            if group is not None:
+                return group
+
+        values = [value]
+        self._latest_values(request, values)
+        return self._fallback(values)
+
+    @property
+    def event_history(self):
+        return self.history - 1
+
+    def route_values(self, request, values):
+        return super().route_values(
+            request, [self._suffix(request['response'])] + list(values))
+
+
+class _StickyEntry(object):
+
+    __slots__ = ('values', 'n_events', 'last_event', 'expires')
+
+    def __init__(self, history):
+        self.values = collections.deque(maxlen=history)
+        self.n_events = 0
+        self.last_event = None
+        self.expires = None
+
+
+class StickyRouter(object):
+    """ Remember what was found in the events of each conversation.
+
+        Details:
+            Wraps an event-based router. The values found in the latest events
+            are kept for each `sender_id`, so that only the events added since
+            the previous request of the same conversation are scanned: the
+            cost no longer depends on `HISTORY` or on the tracker length.
+            The tracker is assumed to only grow between requests; when it
+            does not (restart, new session...), the events are scanned again.
+            At most `size` conversations are kept, the least recently seen
+            ones are dropped first; entries older than `ttl` seconds are
+            dropped when next seen. Everything is forgotten on reload.
+
+        Args:
+            router (EventRouter): Router to wrap
+            size (int): Maximum number of conversations to keep
+            ttl (float or None): Seconds to keep a conversation for
+    """
+
+    __slots__ = ('router', 'size', 'ttl', 'entries')
+
+    def __init__(self, router, size, ttl=None):
+        self.router = router
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.router!r}, size={self.size!r}, ttl={self.ttl!r})'
+
+    def clear(self):
+        self.entries.clear()
+        return None
+
+    def _get_entry(self, sender_id, n_events):
+        """ Entry of a conversation, if still valid for a tracker of `n_events`.
+
+            Details:
+                Whether the tracker still extends the events seen before is
+                only checked by `route`, while walking the new events.
+        """
+        entry = self.entries.pop(sender_id, None)
+        if entry is None:
+            return None
+        if entry.expires is not None and entry.expires < time.monotonic():
+            return None
+        if entry.n_events > n_events:
+            return None
+
+        return entry
+
+    @staticmethod
+    def _plain(event):
+        """ Copy of a lazily decoded event (`FAST_DECODE`), safe to keep."""
+        return event if isinstance(event, dict) else event.as_dict()
+
+    @staticmethod
+    def _events_from(events, start):
+        """ `events[start:]`, walking lazily decoded arrays only once."""
+        if events.__class__ is list:
+            return events[start:]
+        return list(itertools.islice(events, start, None))
+
+    def _new_events(self, entry, events):
+        """ Events added since the entry was last updated, `None` if the
+            tracker does not extend the events seen before.
+        """
+        if not entry.n_events:
+            return self._events_from(events, 0)
+
+        # The last event already seen, then the new ones
+        new_events = self._events_from(events, entry.n_events - 1)
+        if self._plain(new_events[0]) != entry.last_event:
+            return None
+        return new_events[1:]
+
+    def route(self, request):
+        tracker = request['tracker']
+        sender_id = tracker.get('sender_id')
+        if sender_id is None:
+            return self.router.route(request)
+
+        events = tracker['events']
+        n_events = len(events)
+        entry = self._get_entry(sender_id, n_events)
+        new_events = None if entry is None else self._new_events(entry, events)
+        if new_events is None:
+            entry = _StickyEntry(self.router.event_history)
+            if self.ttl is not None:
+                entry.expires = time.monotonic() + self.ttl
+            new_events = self._events_from(events, 0)
+
+        if new_events:
+            self.router.collect(new_events, entry.values)
+            entry.n_events = n_events
+            entry.last_event = self._plain(new_events[-1])
+
+        self.entries[sender_id] = entry
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+        return self.router.route_values(request, entry.values)
+
+
+class CompositeRouter(ResponseRouter):
+    """ Group named after the values of several dimensions (`DIMENSIONS`).
+
+        Details:
+            Each dimension (language, country...) has its own router, which
+            finds its value in the request, or None. Group names join the
+            values of every dimension with `/`, and may use `*` to match any
+            value (including none): `fr/CA`, `fr/*`, `*/CA`...
+            The group of every possible combination of values is resolved
+            when the router is built, by trying the patterns with the fewest
+            wildcards first, and wildcarding the last dimensions first:
+            (fr, CA) -> fr/CA -> fr/* -> */CA -> */* -> default group.
+            Routing a request then costs one lookup per dimension, plus one
+            for the combination.
+
+        Args:
+            groups (iterable of str): Valid group names
+            default_group (str): Group to use if no pattern matches
+            dimensions (list of ResponseRouter): One router per dimension,
+                returning values as found in `patterns`, or None
+            patterns (dict): Tuple of dimension values or `*` -> group name
+    """
+
+    __slots__ = ('dimensions', 'index')
+
+    def __init__(self, groups, default_group, dimensions, patterns):
+        super().__init__(groups, default_group)
+        self.dimensions = tuple(dimensions)
+        self.index = self._build_index(patterns)
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}({list(self.dimensions)!r}, '
+                f'default_group={self.default_group!r})')
+
+    def _build_index(self, patterns):
+        """ Resolve the group of every combination of dimension values.
+
+            Args:
+                patterns (dict): Tuple of dimension values or `*` -> group name
+
+            Returns:
+                dict: Tuple of dimension values or None -> group name
+        """
+        n = len(self.dimensions)
+        known_values = [
+            sorted({p[idx] for p in patterns if p[idx] != WILDCARD}) + [None]
+            for idx in range(n)
+        ]
+        # Fewest wildcards first, then wildcard the last dimensions first
+        masks = sorted(
+            itertools.product([False, True], repeat=n),
+            key=lambda mask: (sum(mask), mask))
+
+        index = {}
+        for values in itertools.product(*known_values):
+            index[values] = self.default_group
+            for mask in masks:
+                if any(v is None and not wildcard for v, wildcard in zip(values, mask)):
+                    continue
+                pattern = tuple(
+                    WILDCARD if wildcard else v for v, wildcard in zip(values, mask))
+                if pattern in patterns:
+                    index[values] = patterns[pattern]
+                    break
+
+        logger.debug(
+            f'Resolved {len(index)} combinations of {n} dimensions '
+            f'to {len(set(index.values()))} response groups')
+
+        return index
+
+    def clear(self):
+        for dimension in self.dimensions:
+            dimension.clear()
+        return None
+
+    def route(self, request):
+        return self.index.get(
+            tuple([dimension.route(request) for dimension in self.dimensions]),
+            self.default_group)
+
+    @classmethod
+    def compile_dimensions(cls, nlg_controls, groups, default_group, pooled_group):
+        """ Build a composite router from `DIMENSIONS` controls.
+
+            Details:
+                Each dimension is a dict of NLG controls (`METHOD`, `NAME`,
+                `SEPARATOR`, `HISTORY`...), falling back to the top-level ones.
+                Group names which do not have one part per dimension (e.g. the
+                default value alias) are ignored.
+
+            Returns:
+                CompositeRouter
+        """
+        inherited = {
+            k: v for k, v in nlg_controls.items()
+            if k not in {'DIMENSIONS', 'METHOD', 'NAME'}}
+        n = len(nlg_controls['DIMENSIONS'])
+
+        patterns = {}
+        dimension_values = [set() for _ in range(n)]
+        for group in groups:
+            parts = group.split(DIMENSION_SEPARATOR)
+            if len(parts) != n:
+                continue
+            patterns[tuple(
+                p if p == WILDCARD else p.lower() for p in parts)] = group
+            for values, part in zip(dimension_values, parts):
+                if part != WILDCARD:
+                    values.add(part)
+
+        # Dimension routers return lowercased values, as patterns do
+        dimensions = [
+            ResponseRouter.compile(
+                dict(inherited, **dimension_controls), values, None, pooled_group)
+            for dimension_controls, values in zip(
+                nlg_controls['DIMENSIONS'], dimension_values)
+        ]
+
+        return cls(groups, default_group, dimensions, patterns)
@@ -0,0 +1,218 @@
+import sys
+import string
+import hashlib
+from sanic.log import logger
+from sanic.response import json_dumps
+
+
+class ResponseTemplate(object):
+    """ Response variant compiled once at load time for fast rendering.
+
+        Details:
+            Every string found in the variant (`text`, but also `buttons`,
+            `custom`, `image`...) is parsed with `string.Formatter` when the
+            template is built:
+            - strings without placeholders are stored as they will be sent
+            - strings with placeholders are recorded in `plan`, so that
+            rendering only formats (and copies) what actually needs it
+            A variant without any placeholder is static: its JSON encoding is
+            kept in `encoded`, so that encoding it costs nothing.
+            Strings are interned, and `fingerprint` identifies the variant by
+            its contents, so that identical variants can share one template.
+    """
+
+    __slots__ = ('payload', 'fields', 'plan', 'encoded', 'fingerprint')
+
+    _formatter = string.Formatter()
+
+    def __init__(self, variant, fingerprint=None):
+        self.payload, self.plan, fields = self._compile(variant)
+        self.fields = frozenset(fields)
+        self.encoded = (
+            json_dumps(self.payload).encode() if self.plan is None else None)
+        self.fingerprint = fingerprint or self.compute_fingerprint(variant)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.payload!r})'
+
+    @property
+    def is_static(self):
+        return self.plan is None
+
+    @classmethod
+    def _canonical(cls, value):
+        """ Unambiguous text representation of a variant value."""
+        if isinstance(value, dict):
+            return '{' + ','.join(
+                f'{key!r}:{cls._canonical(sub_value)}'
+                for key, sub_value in value.items()) + '}'
+        if isinstance(value, (list, tuple)):
+            return '[' + ','.join(cls._canonical(v) for v in value) + ']'
+        return f'{value.__class__.__name__}:{value!r}'
+
+    @classmethod
+    def compute_fingerprint(cls, variant):
+        """ Digest of a variant's contents, types and key order included.
+
+            Args:
+                variant (dict): Variant as found in a response file
+
+            Returns:
+                bytes
+        """
+        return hashlib.blake2b(
+            cls._canonical(variant).encode(), digest_size=16).digest()
+
+    @classmethod
+    def _parse_fields(cls, text):
+        """ Find the argument names needed to format a string.
+
+            Args:
+                text (str): String to parse
+
+            Returns:
+                set of str: Argument names
+
+            Raises:
+                ValueError: if the string is not a valid format string, or
+                    uses positional or non identifier placeholders
+        """
+        fields = set()
+        for _, field_name, format_spec, _ in cls._formatter.parse(text):
+            if field_name is None:
+                continue
+            name = field_name.split('.', 1)[0].split('[', 1)[0]
+            if not name.isidentifier():
+                raise ValueError(f'Unsupported placeholder `{field_name}`')
+            fields.add(name)
+            if format_spec:
+                fields.update(cls._parse_fields(format_spec))
+
+        return fields
+
+    @classmethod
+    def _compile(cls, value):
+        """ Compile a (possibly nested) variant value.
+
+            Returns:
+                tuple: (payload, plan, fields) where
+                    payload is the value to send (static strings pre-formatted)
+                    plan is None if nothing needs formatting, True for a string
+                        to format, or a dict of key or index -> sub-plan
+                    fields is the set of argument names needed
+        """
+        if isinstance(value, str):
+            value = sys.intern(value)
+            if '{' not in value and '}' not in value:
+                return value, None, set()
+            try:
+                fields = cls._parse_fields(value)
+            except ValueError:
+                # Literal braces, e.g. JSON in a `custom` payload
+                logger.debug(f'Not treating `{value}` as a template')
+                return value, None, set()
+            if not fields:
+                # Only escaped braces
+                return sys.intern(value.format()), None, set()
+            return value, True, fields
+
+        if isinstance(value, dict):
+            items = value.items()
+            payload = {}
+        elif isinstance(value, (list, tuple)):
+            items = enumerate(value)
+            payload = []
+        else:
+            return value, None, set()
+
+        plan = {}
+        fields = set()
+        for key, sub_value in items:
+            sub_payload, sub_plan, sub_fields = cls._compile(sub_value)
+            if isinstance(payload, dict):
+                payload[sys.intern(key) if isinstance(key, str) else key] = sub_payload
+            else:
+                payload.append(sub_payload)
+            if sub_plan is not None:
+                plan[key] = sub_plan
+                fields.update(sub_fields)
+
+        return payload, (plan or None), fields
+
+    @classmethod
+    def _copy(cls, value):
+        """ Copy the containers of a payload value, strings being immutable."""
+        if isinstance(value, dict):
+            return {key: cls._copy(sub_value) for key, sub_value in value.items()}
+        if isinstance(value, list):
+            return [cls._copy(sub_value) for sub_value in value]
+        return value
+
+    @classmethod
+    def _apply(cls, value, plan, arguments, copy):
+        """ Format the strings recorded in `plan`.
+
+            Details:
+                Only the containers leading to these strings are copied, unless
+                `copy` is set: the other values are then copied too, so that
+                the result shares nothing with the payload.
+        """
+        if plan is True:
+            return value.format(**arguments)
+
+        if copy:
+            value = cls._copy(value)
+        else:
+            value = dict(value) if isinstance(value, dict) else list(value)
+        for key, sub_plan in plan.items():
+            value[key] = cls._apply(value[key], sub_plan, arguments, False)
+
+        return value
+
+    def _check_arguments(self, arguments):
+        missing = self.fields.difference(arguments)
+        if missing:
+            raise KeyError(
+                f'Missing arguments to render response: {sorted(missing)}')
+
+        return None
+
+    def render(self, arguments):
+        """ Fill the placeholders of the variant.
+
+            Details:
+                The response is a fresh copy, which can be modified without
+                affecting the template. Use `encode` to avoid copying.
+
+            Args:
+                arguments (dict): Values for the placeholders
+
+            Returns:
+                dict: The response to send
+
+            Raises:
+                KeyError: if some placeholders have no value in `arguments`
+        """
+        if self.plan is None:
+            return self._copy(self.payload)
+
+        self._check_arguments(arguments)
+        return self._apply(self.payload, self.plan, arguments, True)
+
+    def encode(self, arguments):
+        """ Fill the placeholders of the variant and encode it to JSON.
+
+            Args:
+                arguments (dict): Values for the placeholders
+
+            Returns:
+                bytes: The response to send, JSON encoded
+
+            Raises:
+                KeyError: if some placeholders have no value in `arguments`
+        """
+        if self.encoded is not None:
+            return self.encoded
+
+        self._check_arguments(arguments)
+        return json_dumps(self._apply(self.payload, self.plan, arguments, False)).encode()
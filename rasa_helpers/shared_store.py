@@ -0,0 +1,381 @@
+import gc
+import os
+import json
+import mmap
+import glob
+import zlib
+import pickle
+import struct
+import threading
+from sanic import Sanic
+from sanic.log import logger
+from .file_watcher import FileWatcher, DEFAULT_DEBOUNCE
+
+MAGIC = b'RHNLG001'
+# Control file: magic, current generation
+CONTROL = struct.Struct('<8sQ')
+# Store file: magic, number of slots, offset of the slots table
+HEADER = struct.Struct('<8sQQ')
+# Table slot: key offset, entry offset, key length, key hash
+SLOT = struct.Struct('<QQII')
+# Entry: number of variants, followed by each variant's offset, length, kind
+COUNT = struct.Struct('<I')
+VARIANT = struct.Struct('<QII')
+
+STATIC_VARIANT = 0
+TEMPLATED_VARIANT = 1
+
+
+def _encode_key(key):
+    group, response_key, channel = key
+    return f'{group}\x1f{response_key}\x1f{channel}'.encode()
+
+
+class SharedVariant(object):
+    """ Static variant read from a shared store, without copying it first."""
+
+    __slots__ = ('buffer', 'offset', 'length')
+
+    def __init__(self, buffer, offset, length):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.encoded!r})'
+
+    @property
+    def encoded(self):
+        return self.buffer[self.offset:self.offset + self.length]
+
+    def render(self, arguments):
+        return json.loads(self.encoded)
+
+    def encode(self, arguments):
+        return self.encoded
+
+
+class SharedIndex(object):
+    """ Response index read straight from a memory-mapped store file.
+
+        Details:
+            Behaves like the read-only index of a `ResponseStore` for lookups:
+            keys are (group, response key, channel), values are tuples of
+            variants with `render` and `encode` methods.
+            The file holds an open-addressing hash table, so nothing is
+            decoded until a key is looked up. Only templated variants are
+            unpickled, once per process and generation.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        magic, self.n_slots, self.table_offset = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError('Not a rasa_helpers shared response store')
+        self._templates = {}
+
+    def _variants(self, entry_offset):
+        buffer = self.buffer
+        count, = COUNT.unpack_from(buffer, entry_offset)
+        variants = []
+        for idx in range(count):
+            offset, length, kind = VARIANT.unpack_from(
+                buffer, entry_offset + COUNT.size + idx * VARIANT.size)
+            if kind == STATIC_VARIANT:
+                variants.append(SharedVariant(buffer, offset, length))
+                continue
+            try:
+                variants.append(self._templates[offset])
+            except KeyError:
+                template = pickle.loads(buffer[offset:offset + length])
+                variants.append(self._templates.setdefault(offset, template))
+
+        return tuple(variants)
+
+    def get(self, key, default=None):
+        encoded_key = _encode_key(key)
+        key_hash = zlib.crc32(encoded_key)
+        mask = self.n_slots - 1
+        slot = key_hash & mask
+        while True:
+            key_offset, entry_offset, key_length, slot_hash = SLOT.unpack_from(
+                self.buffer, self.table_offset + slot * SLOT.size)
+            if key_length == 0:
+                return default
+            if (slot_hash == key_hash
+                    and self.buffer[key_offset:key_offset + key_length] == encoded_key):
+                return self._variants(entry_offset)
+            slot = (slot + 1) & mask
+
+    def __getitem__(self, key):
+        o = self.get(key)
+        if o is None:
+            raise KeyError(key)
+        return o
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class SharedResponseStore(object):
+    """ Response store shared by every Sanic worker through memory-mapped files.
+
+        Details:
+            A single publisher (the main Sanic process) writes each generation
+            of the response index to `<path>.<generation>`, then bumps the
+            generation number in the control file `<path>`.
+            Workers map the control file, and check the generation number
+            when a request starts: as soon as it changes, every worker maps
+            the new generation file. Variants are read zero-copy from the
+            page cache, so memory does not grow with the number of workers.
+            This object stands in for `ResponseStore` in `app.config['NLG_STORE']`.
+    """
+
+    def __init__(self, path, on_switch=None):
+        self.path = path
+        self.on_switch = on_switch
+        with open(path, 'rb') as f:
+            self._control = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.generation = 0
+        self._index = None
+
+    @property
+    def index(self):
+        magic, generation = CONTROL.unpack_from(self._control)
+        if generation != self.generation:
+            self._open(generation)
+        return self._index
+
+    def _open(self, generation):
+        try:
+            with open(f'{self.path}.{generation}', 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            # Already replaced by a newer generation: keep the current one
+            # until the next request
+            logger.warning(f'Shared response store generation {generation} vanished')
+            if self._index is None:
+                raise
+            return None
+
+        self._index = SharedIndex(buffer)
+        self.generation = generation
+        if self.on_switch is not None:
+            self.on_switch()
+        logger.debug(f'Using shared response store generation {generation}')
+
+        return None
+
+    @classmethod
+    def _serialise(cls, index):
+        """ Lay out a response index as a shared store file.
+
+            Details:
+                Identical variants and identical lists of variants (default
+                value alias, channel fallbacks...) are only written once.
+
+            Args:
+                index (Mapping): (group, response key, channel) -> variants
+
+            Returns:
+                bytes: Contents of the store file
+        """
+        n_slots = 8
+        while n_slots < 2 * len(index):
+            n_slots *= 2
+
+        table_offset = HEADER.size
+        data = bytearray(table_offset + n_slots * SLOT.size)
+        HEADER.pack_into(data, 0, MAGIC, n_slots, table_offset)
+
+        blobs = {}
+        entries = {}
+
+        def write_blob(blob):
+            try:
+                return blobs[blob]
+            except KeyError:
+                blobs[blob] = len(data)
+                data.extend(blob)
+                return blobs[blob]
+
+        for key, templates in index.items():
+            variants = []
+            for template in templates:
+                if template.encoded is not None:
+                    blob, kind = template.encoded, STATIC_VARIANT
+                else:
+                    blob, kind = pickle.dumps(template), TEMPLATED_VARIANT
+                variants.append((write_blob(blob), len(blob), kind))
+
+            variants = tuple(variants)
+            entry_offset = entries.get(variants)
+            if entry_offset is None:
+                entry_offset = entries[variants] = len(data)
+                data.extend(COUNT.pack(len(variants)))
+                for variant in variants:
+                    data.extend(VARIANT.pack(*variant))
+
+            encoded_key = _encode_key(key)
+            key_offset = len(data)
+            data.extend(encoded_key)
+
+            key_hash = zlib.crc32(encoded_key)
+            slot = key_hash & (n_slots - 1)
+            while SLOT.unpack_from(data, table_offset + slot * SLOT.size)[2]:
+                slot = (slot + 1) & (n_slots - 1)
+            SLOT.pack_into(
+                data, table_offset + slot * SLOT.size,
+                key_offset, entry_offset, len(encoded_key), key_hash)
+
+        return bytes(data)
+
+    @classmethod
+    def _read_generation(cls, path):
+        try:
+            with open(path, 'rb') as f:
+                magic, generation = CONTROL.unpack(f.read(CONTROL.size))
+            return generation
+        except (FileNotFoundError, struct.error):
+            return 0
+
+    @classmethod
+    def publish(cls, store, path):
+        """ Make a response store the current generation of a shared store.
+
+            Details:
+                Generations older than the previous one are removed: workers
+                still using them keep their mapping until they switch.
+
+            Args:
+                store (ResponseStore): Store to publish
+                path (str): Path of the control file
+
+            Returns:
+                int: The generation published
+        """
+        generation = cls._read_generation(path) + 1
+        data = cls._serialise(store.index)
+
+        with open(f'{path}.{generation}.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(f'{path}.{generation}.tmp', f'{path}.{generation}')
+
+        if generation == 1 or not os.path.exists(path):
+            with open(f'{path}.tmp', 'wb') as f:
+                f.write(CONTROL.pack(MAGIC, generation))
+            os.replace(f'{path}.tmp', path)
+        else:
+            # Workers have the control file mapped: update it in place
+            with open(path, 'r+b') as f:
+                control = mmap.mmap(f.fileno(), CONTROL.size)
+                CONTROL.pack_into(control, 0, MAGIC, generation)
+                control.close()
+
+        for filename in glob.glob(f'{glob.escape(path)}.*'):
+            suffix = filename[len(path) + 1:]
+            if suffix.isdigit() and int(suffix) < generation - 1:
+                os.remove(filename)
+
+        logger.info(
+            f'Published shared response store generation {generation} '
+            f'({len(data)} bytes)')
+
+        return generation
+
+    @classmethod
+    def run_publisher(cls, app, refresh, path, stop_event=None):
+        """ Reload responses and publish them when they change, until stopped.
+
+            Details:
+                Meant to run in a thread of the main Sanic process, which is
+                then the only process watching response files.
+
+            Args:
+                app (sanic.Sanic): Configured Sanic app
+                refresh (function): Called with `app` to reload responses
+                path (str): Path of the control file
+                stop_event (threading.Event or None): Set it to stop
+
+            Returns:
+                None
+        """
+        controls = app.config.NLG_CONTROLS
+        stop_event = stop_event or threading.Event()
+        published = app.config.NLG_STORE.generation
+
+        def reload(filenames=None):
+            nonlocal published
+            try:
+                refresh(app)
+                if app.config.NLG_STORE.generation != published:
+                    cls.publish(app.config.NLG_STORE, path)
+                    published = app.config.NLG_STORE.generation
+            except Exception:
+                logger.exception('Could not publish new responses')
+
+        if FileWatcher.use_events(controls):
+            FileWatcher.watch_sync(
+                FileWatcher.watched_filenames(controls),
+                reload,
+                debounce=controls.get('DEBOUNCE', DEFAULT_DEBOUNCE),
+                stop_event=stop_event)
+        else:
+            while not stop_event.wait(app.config.NLG_REFRESH):
+                reload()
+
+        return None
+
+    @classmethod
+    def start_publisher(cls, app, refresh):
+        """ Publish the current responses, then keep publishing in a thread.
+
+            Details:
+                Call it once, in the main Sanic process (`main_process_start`).
+                The publisher works on its own copy of `app.config`, so that
+                workers can replace `NLG_STORE` with a shared view even when
+                they run in the main process.
+
+            Args:
+                app (sanic.Sanic): Configured Sanic app
+                refresh (function): Called with the publisher app to reload
+                    responses
+
+            Returns:
+                threading.Event: Set it to stop the publisher
+        """
+        path = app.config.NLG_SHARED_STORE
+        publisher = Sanic('rasa_helpers_publisher', register=False)
+        publisher.config.update(app.config)
+
+        cls.publish(publisher.config.NLG_STORE, path)
+
+        stop_event = threading.Event()
+        threading.Thread(
+            target=cls.run_publisher,
+            args=(publisher, refresh, path, stop_event),
+            name='nlg-publisher',
+            daemon=True).start()
+
+        return stop_event
+
+    @classmethod
+    def attach(cls, app):
+        """ Serve responses from the shared store, in a Sanic worker.
+
+            Details:
+                The responses loaded before forking are dropped, so that
+                workers only keep the pages of the store they actually read.
+
+            Args:
+                app (sanic.Sanic): Configured Sanic app
+
+            Returns:
+                None
+        """
+        app.config['NLG_STORE'] = cls(
+            app.config.NLG_SHARED_STORE, on_switch=app.config.NLG_ROUTER.clear)
+        app.config['RESPONSES'] = {}
+        gc.collect()
+
+        return None
@@ -0,0 +1,54 @@
+import pytest
+import asyncio
+from pathlib import Path
+import rasa_helpers.file_watcher as file_watcher
+
+
+@pytest.mark.parametrize(
+    "controls,available,expected",
+    [
+        ({'WATCH': 'poll'}, True, False),
+        ({'WATCH': 'events'}, True, True),
+        ({}, True, True),
+        ({}, False, False),
+        ({'WATCH': 'events'}, False, False)
+    ])
+def test_use_events(monkeypatch, controls, available, expected):
+    monkeypatch.setattr(
+        file_watcher, 'watchfiles', object() if available else None)
+    assert file_watcher.FileWatcher.use_events(controls) == expected
+
+
+def test_watched_filenames():
+    controls = {'VALUES': [
+        {'NAME': 'abc', 'FILENAME': 'tests/abc_responses.yml'},
+        ['xyz', '/tmp/xyz_responses.yml']]}
+    assert file_watcher.FileWatcher.watched_filenames(controls) == {
+        str(Path('tests/abc_responses.yml').absolute()), '/tmp/xyz_responses.yml'}
+
+
+@pytest.mark.slow
+def test_watch(tmp_path):
+    pytest.importorskip('watchfiles')
+    watched = Path(tmp_path, 'watched.yml')
+    ignored = Path(tmp_path, 'ignored.yml')
+    watched.write_text('a')
+    calls = []
+
+    async def main():
+        stop_event = asyncio.Event()
+
+        async def callback(changed):
+            calls.append(changed)
+            stop_event.set()
+
+        task = asyncio.create_task(file_watcher.FileWatcher.watch(
+            {str(watched)}, callback, debounce=100, stop_event=stop_event))
+        await asyncio.sleep(0.3)
+        ignored.write_text('b')
+        for _ in range(3):
+            watched.write_text('c')
+        await asyncio.wait_for(task, timeout=5)
+
+    asyncio.run(main())
+    assert calls == [{str(watched)}]
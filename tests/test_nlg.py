@@ -4,6 +4,10 @@ import sanic
 import time
 import os
 import shutil
+import json
+import asyncio
+import random
+from types import SimpleNamespace
 from pathlib import Path
 
 
@@ -43,7 +47,7 @@ def app():
 
 @pytest.fixture
 def configured_app():
-    app = sanic.Sanic('Test NLG server 2')
+    app = sanic.Sanic('Test NLG server 2', register=False)
     nlg.NLGAppUpdater.configure(
         app,
         Path(
@@ -70,6 +74,14 @@ def test_nlg_configure(app):
         app.config.RESPONSES['abc']['utter_response_1'][0]['text'] ==
         'abc Text from response 1'
     )
+    assert (
+        app.config.NLG_STORE.index[('xyz', 'utter_response_2', 'facebook')][0].payload['text'] ==
+        'xyz Text from response 2'
+    )
+    assert (
+        app.config.NLG_STORE.index[('xyz', 'utter_response_1', 'facebook')][0].payload['text'] ==
+        'xyz Text from response 1'
+    )
 
 @pytest.mark.nlg
 def test_nlg_refresh(configured_app):
@@ -108,3 +120,482 @@ def test_nlg_refresh(configured_app):
     #     app.config.RESPONSES['abc']['utter_response_1'][0]['text'] ==
     #     'abc Text from response 1'
     # )
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+@pytest.mark.parametrize(
+    "slot,response_key,channel,expected",
+    [
+        ('xyz', 'utter_response_1', 'facebook', {'text': 'xyz Text from response 1'}),
+        ('xyz', 'utter_response_2', 'facebook', {
+            'channel': 'facebook',
+            'quick_replies': [
+                {'payload': '/affirm', 'title': 'xyz Yes'},
+                {'payload': '/deny', 'title': 'xyz No'}],
+            'text': 'xyz Text from response 2'}),
+        ('ijk', 'utter_response_1', 'collector', {'text': 'abc Text from response 1'}),
+        ('abc', 'not_a_response', 'collector', [{'text': 'default answer'}])
+    ])
+def test_construct_response(configured_app, slot, response_key, channel, expected):
+    request = {
+        'tracker': {'slots': {'test_slot': slot}, 'events': []},
+        'response': response_key,
+        'arguments': {},
+        'channel': {'name': channel}
+    }
+    assert nlg.ResponseFetcher.construct_response(configured_app, request) == expected
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+def test_construct_response_fast_decode(configured_app):
+    pytest.importorskip('simdjson')
+    configured_app.config.NLG_FAST_DECODE = True
+    events = [{'event': 'action', 'name': 'action_listen'}] * 1000
+    body = json.dumps({
+        'tracker': {'slots': {'test_slot': 'xyz'}, 'events': events},
+        'response': 'utter_response_2',
+        'arguments': {},
+        'channel': {'name': 'facebook'}
+    }).encode()
+
+    for _ in range(2):
+        res = nlg.ResponseFetcher.construct_response(
+            configured_app, SimpleNamespace(body=body))
+        assert res['text'] == 'xyz Text from response 2'
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+def test_construct_responses(configured_app):
+    requests = [
+        {
+            'tracker': {'slots': {'test_slot': slot}, 'events': []},
+            'response': 'utter_response_1',
+            'arguments': {}
+        }
+        for slot in ['abc', 'xyz', 'ijk']
+    ]
+    assert nlg.ResponseFetcher.construct_responses(configured_app, requests) == [
+        {'text': 'abc Text from response 1'},
+        {'text': 'xyz Text from response 1'},
+        {'text': 'abc Text from response 1'}
+    ]
+
+    pytest.importorskip('simdjson')
+    configured_app.config.NLG_FAST_DECODE = True
+    body = json.dumps(requests).encode()
+    assert nlg.ResponseFetcher.construct_responses(
+        configured_app, SimpleNamespace(body=body))[1] == {
+            'text': 'xyz Text from response 1'}
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+def test_construct_responses_returns_copies(configured_app):
+    requests = [
+        {
+            'tracker': {'slots': {'test_slot': 'xyz'}, 'events': []},
+            'response': response_key,
+            'arguments': {}
+        }
+        for response_key in ['utter_response_1', 'not_a_response']
+    ]
+    first = nlg.ResponseFetcher.construct_responses(configured_app, requests)
+    first[0]['text'] = 'MUTATED'
+    first[1][0]['text'] = 'MUTATED'
+
+    assert nlg.ResponseFetcher.construct_response(configured_app, requests[0]) == {
+        'text': 'xyz Text from response 1'}
+    assert nlg.ResponseFetcher.construct_responses(configured_app, requests) == [
+        {'text': 'xyz Text from response 1'},
+        [{'text': 'default answer'}]
+    ]
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+@pytest.mark.parametrize(
+    "response_key,arguments,expected",
+    [
+        ('utter_response_1', {}, {'text': 'xyz Text from response 1'}),
+        ('not_a_response', {}, [{'text': 'default answer'}])
+    ])
+def test_construct_response_body(configured_app, response_key, arguments, expected):
+    request = {
+        'tracker': {'slots': {'test_slot': 'xyz'}, 'events': []},
+        'response': response_key,
+        'arguments': arguments
+    }
+    body = nlg.ResponseFetcher.construct_response_body(configured_app, request)
+    assert isinstance(body, bytes)
+    assert json.loads(body) == expected
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+def test_construct_responses_body(configured_app):
+    requests = [
+        {
+            'tracker': {'slots': {'test_slot': slot}, 'events': []},
+            'response': response_key,
+            'arguments': {}
+        }
+        for slot, response_key in [
+            ('abc', 'utter_response_1'), ('xyz', 'not_a_response'),
+            ('xyz', 'utter_response_1')]
+    ]
+    body = nlg.ResponseFetcher.construct_responses_body(configured_app, requests)
+    assert isinstance(body, bytes)
+    assert json.loads(body) == [
+        {'text': 'abc Text from response 1'},
+        [{'text': 'default answer'}],
+        {'text': 'xyz Text from response 1'}
+    ]
+    assert nlg.ResponseFetcher.construct_responses_body(configured_app, []) == b'[]'
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+@pytest.mark.parametrize("fast_decode", [False, True])
+def test_construct_responses_mixed_batch(configured_app, fast_decode):
+    if fast_decode:
+        pytest.importorskip('simdjson')
+    configured_app.config.NLG_FAST_DECODE = fast_decode
+    valid = {
+        'tracker': {'slots': {'test_slot': 'xyz'}, 'events': []},
+        'response': 'utter_response_1',
+        'arguments': {}
+    }
+    no_arguments = {k: v for k, v in valid.items() if k != 'arguments'}
+    requests = [valid, no_arguments, 'not a request', valid]
+    expected = [
+        {'text': 'xyz Text from response 1'},
+        [{'text': 'default answer'}],
+        [{'text': 'default answer'}],
+        {'text': 'xyz Text from response 1'}
+    ]
+    request = SimpleNamespace(body=json.dumps(requests).encode(), json=requests)
+
+    assert nlg.ResponseFetcher.construct_responses(configured_app, request) == expected
+    body = nlg.ResponseFetcher.construct_responses_body(configured_app, request)
+    assert json.loads(body) == expected
+    assert nlg.Metrics.report(configured_app)['nlg_batch_errors'] == 4
+
+
+@pytest.mark.nlg
+@pytest.mark.app_updater
+def test_merge_pooled_responses():
+    responses = {
+        'abc': {'res1': ['abc1'], 'res2': ['abc2']},
+        'xyz': {'res2': ['xyz2'], 'res3': ['xyz3']},
+        'ijk': {'res3': ['ijk3'], 'res4': ['ijk4']}
+    }
+    order = ['abc', 'xyz', 'ijk']
+    pooled, owners = nlg.NLGAppUpdater._merge_pooled_responses(
+        responses, order, order)
+    assert pooled == {
+        'res1': ['abc1'], 'res2': ['abc2'], 'res3': ['xyz3'], 'res4': ['ijk4']}
+
+    responses['abc'] = {'res1': ['abc1 bis']}
+    responses['ijk'] = {'res3': ['ijk3'], 'res5': ['ijk5']}
+    pooled, owners = nlg.NLGAppUpdater._merge_pooled_responses(
+        responses, order, ['abc', 'ijk'], pooled, owners)
+    assert pooled == {
+        'res1': ['abc1 bis'], 'res2': ['xyz2'], 'res3': ['xyz3'], 'res5': ['ijk5']}
+    assert owners == {'res1': 'abc', 'res2': 'xyz', 'res3': 'xyz', 'res5': 'ijk'}
+
+
+@pytest.mark.nlg
+@pytest.mark.app_updater
+@pytest.mark.parametrize("changed", [['a', 'c'], ['c', 'a']])
+def test_merge_pooled_responses_several_changes(changed):
+    order = ['a', 'b', 'c']
+    responses = {'a': {'k': ['a']}, 'b': {'k': ['b']}, 'c': {}}
+    pooled, owners = nlg.NLGAppUpdater._merge_pooled_responses(
+        responses, order, order)
+
+    # `k` goes back to `b`, which has precedence over `c`
+    responses['a'] = {}
+    responses['c'] = {'k': ['c']}
+    pooled, owners = nlg.NLGAppUpdater._merge_pooled_responses(
+        responses, order, changed, pooled, owners)
+    assert pooled == {'k': ['b']}
+    assert owners == {'k': 'b'}
+
+
+@pytest.mark.nlg
+@pytest.mark.app_updater
+def test_merge_pooled_responses_matches_full_merge():
+    rng = random.Random(0)
+    keys = ['k1', 'k2', 'k3', 'k4']
+
+    def random_responses(groups):
+        return {g: {k: [f'{g} {k}'] for k in keys if rng.random() < 0.5}
+                for g in groups}
+
+    for _ in range(2000):
+        order = rng.sample(['a', 'b', 'c', 'd'], rng.randint(1, 4))
+        responses = random_responses(order)
+        pooled, owners = nlg.NLGAppUpdater._merge_pooled_responses(
+            responses, order, order)
+
+        changed = rng.sample(order, rng.randint(0, len(order)))
+        responses.update(random_responses(changed))
+        incremental = nlg.NLGAppUpdater._merge_pooled_responses(
+            responses, order, changed, pooled, owners)
+        assert incremental == nlg.NLGAppUpdater._merge_pooled_responses(
+            responses, order, order)
+
+
+@pytest.mark.nlg
+def test_nlg_configure_pooled(tmp_path):
+    config = Path(Path(__file__).parent, 'nlg_test_config.yml').read_text()
+    config_path = Path(tmp_path, 'pooled_config.yml')
+    config_path.write_text(config.replace('METHOD: slot', 'METHOD: pooled'))
+
+    app = sanic.Sanic('Test NLG pooled server', register=False)
+    nlg.NLGAppUpdater.configure(app, config_path)
+
+    pooled = app.config.RESPONSES[nlg.POOLED_FLAG]
+    assert isinstance(pooled, dict)
+    assert pooled['utter_response_1'] == app.config.RESPONSES['abc']['utter_response_1']
+    assert set(app.config.NLG_STORE.pooled_owners.values()) == {'abc'}
+
+
+@pytest.fixture
+def tmp_config(tmp_path):
+    """ Config using copies of the test response files, safe to modify"""
+    tests_dir = Path(__file__).parent
+    config = Path(tests_dir, 'nlg_test_config.yml').read_text()
+    for name in ['abc', 'xyz']:
+        shutil.copy(
+            Path(tests_dir, f'{name}_responses.yml'),
+            Path(tmp_path, f'{name}_responses.yml'))
+        config = config.replace(
+            f'tests/{name}_responses.yml', str(Path(tmp_path, f'{name}_responses.yml')))
+    config_path = Path(tmp_path, 'config.yml')
+    config_path.write_text(config)
+    return config_path
+
+
+@pytest.fixture
+def tmp_configured_app(tmp_config):
+    app = sanic.Sanic('Test NLG server tmp', register=False)
+    nlg.NLGAppUpdater.configure(app, tmp_config)
+    return app
+
+
+@pytest.mark.nlg
+@pytest.mark.app_updater
+@pytest.mark.parametrize("executor", ['thread', 'process'])
+def test_nlg_refresh_async(tmp_configured_app, executor):
+    app = tmp_configured_app
+    app.config.NLG_CONTROLS['RELOAD_EXECUTOR'] = executor
+    store = app.config.NLG_STORE
+
+    asyncio.run(nlg.NLGAppUpdater.refresh_async(app))
+    assert app.config.NLG_STORE is store
+
+    filename = app.config.NLG_CONTROLS['VALUES'][1]['FILENAME']
+    Path(filename).write_text(
+        Path(filename).read_text().replace('xyz Text', 'new xyz Text'))
+    os.utime(filename, (time.time() + 10, time.time() + 10))
+
+    asyncio.run(nlg.NLGAppUpdater.refresh_async(app))
+    new_store = app.config.NLG_STORE
+    assert new_store is not store
+    assert new_store.generation == store.generation + 1
+    assert new_store.group_indexes['abc'] is store.group_indexes['abc']
+    assert new_store.index[('xyz', 'utter_response_1', 'collector')][0].payload == {
+        'text': 'new xyz Text from response 1'}
+    assert store.index[('xyz', 'utter_response_1', 'collector')][0].payload == {
+        'text': 'xyz Text from response 1'}
+    assert app.config.METRICS['nlg_reload_seconds']['count'] == 2
+
+
+@pytest.mark.nlg
+@pytest.mark.app_updater
+def test_find_stale_entries_for_filenames(tmp_configured_app):
+    app = tmp_configured_app
+    filenames = [v['FILENAME'] for v in app.config.NLG_CONTROLS['VALUES']]
+    for filename in filenames:
+        with open(filename, 'a') as f:
+            f.write('# changed')
+        os.utime(filename, (time.time() + 10, time.time() + 10))
+
+    stale = nlg.NLGAppUpdater._find_stale_entries(
+        app, 'NLG', filenames={os.path.abspath(filenames[1])})
+    assert [entry[1] for entry in stale] == ['xyz']
+    assert len(nlg.NLGAppUpdater._find_stale_entries(app, 'NLG')) == 2
+
+
+@pytest.mark.nlg
+@pytest.mark.app_updater
+def test_nlg_refresh_skips_identical_contents(tmp_configured_app):
+    app = tmp_configured_app
+    store = app.config.NLG_STORE
+    value = app.config.NLG_CONTROLS['VALUES'][0]
+    size, timestamp, digest = value['FINGERPRINT']
+
+    Path(value['FILENAME']).write_text(Path(value['FILENAME']).read_text())
+    os.utime(value['FILENAME'], (timestamp + 10, timestamp + 10))
+    nlg.NLGAppUpdater.refresh(app)
+
+    assert app.config.NLG_STORE is store
+    assert value['TIMESTAMP'] == timestamp + 10
+    assert value['FINGERPRINT'] == (size, timestamp + 10, digest)
+
+
+@pytest.mark.nlg
+@pytest.mark.app_updater
+def test_nlg_compile_bundle(tmp_config, monkeypatch):
+    filename = nlg.NLGAppUpdater.compile(tmp_config)
+    assert filename == str(tmp_config.with_suffix('.bundle'))
+
+    def parse_fails(*args, **kwargs):
+        raise AssertionError('Response files should not be parsed')
+
+    with monkeypatch.context() as m:
+        m.setattr(nlg.NLGAppUpdater, '_load_updated_data', parse_fails)
+        app = sanic.Sanic('Test NLG server bundle', register=False)
+        nlg.NLGAppUpdater.configure(app, tmp_config)
+
+    assert app.config.NLG_STORE.index[('xyz', 'utter_response_1', 'collector')][0].encoded
+    assert app.config.RESPONSES['unk'] is app.config.RESPONSES['abc']
+    assert app.config.NLG_CONTROLS['VALUES'][0]['FINGERPRINT']
+    request = {
+        'tracker': {'slots': {'test_slot': 'xyz'}, 'events': []},
+        'response': 'utter_response_1',
+        'arguments': {}
+    }
+    assert nlg.ResponseFetcher.construct_response(app, request) == {
+        'text': 'xyz Text from response 1'}
+
+    # Bundles older than their sources are ignored
+    response_filename = app.config.NLG_CONTROLS['VALUES'][1]['FILENAME']
+    with open(response_filename, 'a') as f:
+        f.write('    utter_response_3:\n      - text: xyz Text from response 3\n')
+    os.utime(response_filename, (time.time() + 10, time.time() + 10))
+
+    app = sanic.Sanic('Test NLG server bundle 2', register=False)
+    nlg.NLGAppUpdater.configure(app, tmp_config)
+    assert ('xyz', 'utter_response_3', 'collector') in app.config.NLG_STORE.index
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+def test_nlg_configure_dimensions(tmp_path):
+    tests_dir = Path(__file__).parent
+    config_path = Path(tmp_path, 'config.yml')
+    config_path.write_text(f"""
+NLG_CONTROLS:
+    DIMENSIONS:
+        - METHOD: slot
+          NAME: language
+        - METHOD: slot
+          NAME: country
+    VALUES:
+        - NAME: fr/CA
+          FILENAME: {Path(tests_dir, 'abc_responses.yml')}
+        - NAME: fr/*
+          FILENAME: {Path(tests_dir, 'xyz_responses.yml')}
+    REFRESH: 1
+    DEFAULT_RESPONSE: 'default answer'
+    DEFAULT_VALUE: fr/*
+
+NETWORK:
+    HOST: '0.0.0.0'
+    PORT: 6001
+""")
+    app = sanic.Sanic('Test NLG server dimensions', register=False)
+    nlg.NLGAppUpdater.configure(app, config_path)
+
+    for slots, expected in [
+            ({'language': 'fr', 'country': 'CA'}, 'abc Text from response 1'),
+            ({'language': 'fr', 'country': 'BE'}, 'xyz Text from response 1'),
+            ({}, 'xyz Text from response 1')]:
+        request = {
+            'tracker': {'slots': slots, 'events': []},
+            'response': 'utter_response_1',
+            'arguments': {}
+        }
+        assert nlg.ResponseFetcher.construct_response(app, request) == {'text': expected}
+
+
+@pytest.mark.nlg
+@pytest.mark.app_updater
+def test_nlg_shares_identical_variants(tmp_config):
+    xyz_filename = Path(tmp_config.parent, 'xyz_responses.yml')
+    xyz_filename.write_text(
+        xyz_filename.read_text().replace('xyz Text from response 1', 'abc Text from response 1'))
+
+    app = sanic.Sanic('Test NLG server shared variants', register=False)
+    nlg.NLGAppUpdater.configure(app, tmp_config)
+    index = app.config.NLG_STORE.index
+
+    abc = index[('abc', 'utter_response_1', 'collector')][0]
+    assert index[('xyz', 'utter_response_1', 'collector')][0] is abc
+    assert app.config.RESPONSES['xyz']['utter_response_1'][0] is abc.payload
+    # Same text, but different buttons
+    assert (index[('xyz', 'utter_response_2', 'collector')][0]
+            is not index[('abc', 'utter_response_2', 'collector')][0])
+
+    assert app.config.NLG_STORE.stats['shared_variants'] == 1
+    assert app.config.NLG_STORE.stats['bytes_saved'] > 0
+    assert app.config.METRICS['nlg_bytes_saved']['last'] > 0
+
+    # Reloaded groups share variants with the groups left untouched
+    xyz_filename.write_text(xyz_filename.read_text() + '\n')
+    os.utime(xyz_filename, (time.time() + 10, time.time() + 10))
+    nlg.NLGAppUpdater.refresh(app)
+    assert app.config.NLG_STORE.generation == 2
+    assert app.config.NLG_STORE.index[('xyz', 'utter_response_1', 'collector')][0] is abc
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+def test_nlg_missing_keys_from_default_group(tmp_config, caplog):
+    xyz_filename = Path(tmp_config.parent, 'xyz_responses.yml')
+    xyz_filename.write_text(
+        'responses:\n'
+        '    utter_response_2:\n'
+        '      - text: xyz Text from response 2\n')
+
+    app = sanic.Sanic('Test NLG server default overlay', register=False)
+    with caplog.at_level('INFO'):
+        nlg.NLGAppUpdater.configure(app, tmp_config)
+    assert app.config.NLG_STORE.stats['keys_from_default'] == {'xyz': ['utter_response_1']}
+    assert 'responses missing from `xyz`' in caplog.text
+
+    caplog.clear()
+    for key, expected in [
+            ('utter_response_1', {'text': 'abc Text from response 1'}),
+            ('not_a_response', [{'text': 'default answer'}])]:
+        request = {
+            'tracker': {'slots': {'test_slot': 'xyz'}, 'events': []},
+            'response': key,
+            'arguments': {},
+            'channel': {'name': 'facebook'}
+        }
+        assert nlg.ResponseFetcher.construct_response(app, request) == expected
+    assert app.config.METRICS['nlg_missing_responses'] == 1
+    assert not [r for r in caplog.records if r.levelname == 'WARNING']
+
+
+@pytest.mark.nlg
+@pytest.mark.app_updater
+def test_nlg_readiness(tmp_configured_app):
+    app = tmp_configured_app
+    report = nlg.NLGAppUpdater.readiness(app)
+    assert report['ready']
+    assert report['generation'] == app.config.NLG_STORE.generation
+    assert report['reload_seconds'] >= 0
+    assert set(report['responses']) == {'abc', 'xyz'}
+    value = app.config.NLG_CONTROLS['VALUES'][0]
+    assert report['responses']['abc']['fingerprint'] == value['FINGERPRINT'][2]
+    json.dumps(report)
+
+    app.config['NLG_STORE'] = None
+    assert not nlg.NLGAppUpdater.readiness(app)['ready']
@@ -1,11 +1,15 @@
 import pytest
 import rasa_helpers.nlu as nlu
+from rasa_helpers.parse_cache import ParseCache
 import sanic
 import time
 import os
 import shutil
 import inspect
 import asyncio
+import threading
+import re
+from types import SimpleNamespace
 from pathlib import Path
 
 
@@ -57,6 +61,29 @@ def test_predict_intent(agent):
     assert r['intent']['name'] in labels
 
 
+@pytest.mark.nlu
+@pytest.mark.slow
+@pytest.mark.models_needed
+def test_predict_intents_matches_predict_intent(agent):
+    if agent.predict_intents is None:
+        pytest.skip('Batch parsing needs Rasa 3')
+
+    messages = ['Hello world!', 'goodbye', 'hi there', '/greet']
+    batched = agent.predict_intents(messages)
+    single = [asyncio.run(agent.predict_intent(message=m)) for m in messages]
+    assert len(batched) == len(single)
+    for b, s in zip(batched, single):
+        # Padding the batch may change the confidences by rounding errors
+        assert b['intent']['confidence'] == pytest.approx(
+            s['intent']['confidence'], abs=1e-4)
+        for r in (b, s):
+            r['intent'].pop('confidence')
+            r.pop('intent_ranking', None)
+            for entity in r['entities']:
+                entity.pop('confidence_entity', None)
+        assert b == s
+
+
 
 
 # ----- Integration tests -----
@@ -121,3 +148,360 @@ def test_predict_intent(agent):
 #     #     configured_app.config.RESPONSES['abc'] == configured_app.config.RESPONSES['xyz']
 #     # )
 #     #
+
+
+# ----- Executors -----
+
+def fake_nlu_app(controls):
+    async def predict_intent(message):
+        return {'text': message, 'intent': {'name': 'greet'}, 'entities': []}
+
+    app = sanic.Sanic('Test NLU executors', register=False)
+    app.config['NLU_CONTROLS'] = dict({
+        'NAME': 'detected_lang',
+        'MODEL_CHOOSER': {
+            'FILEPATH': str(Path(Path(__file__).parent, 'chooser_code.py')),
+            'FUNCTION': 'chooser'}
+    }, **controls)
+    app.config['NLU_EXECUTORS'] = {}
+    app.config['NLU_BATCHERS'] = {}
+    app.config['NLU_CACHE'] = ParseCache.from_controls(app.config['NLU_CONTROLS'])
+    app.config['NLU_GENERATION'] = 'gen1'
+    app.config['NLU_CHOOSER'] = lambda message: ('eng', 1)
+    app.config['NLU_CHOOSER_BYPASSER'] = re.compile('/(greet)')
+    app.config['MODELS'] = {
+        'eng': SimpleNamespace(predict_intent=predict_intent),
+        nlu.DEFAULT_VALUE_FLAG: SimpleNamespace(predict_intent=predict_intent)
+    }
+    return app
+
+
+@pytest.mark.nlu
+@pytest.mark.parametrize("chooser_executor", ['none', 'thread'])
+@pytest.mark.parametrize("inference_executor", ['none', 'thread'])
+def test_run_with_executors(chooser_executor, inference_executor):
+    app = fake_nlu_app({
+        'CHOOSER_EXECUTOR': chooser_executor,
+        'INFERENCE_EXECUTOR': inference_executor,
+        'INFERENCE_WORKERS': 2})
+    request = SimpleNamespace(json={'text': 'Hello world!'})
+
+    async def run_all():
+        return await asyncio.gather(*[nlu.NLURunner.run(app, request) for _ in range(8)])
+
+    for res in asyncio.run(run_all()):
+        assert res['intent']['name'] == 'greet'
+        assert res['entities'] == [{
+            'start': 0, 'end': 0, 'value': 'eng',
+            'entity': 'detected_lang', 'confidence': 1}]
+
+    executor = app.config.NLU_EXECUTORS['INFERENCE']
+    assert (executor is None) == (inference_executor == 'none')
+
+
+@pytest.mark.nlu
+@pytest.mark.slow
+def test_run_chooser_in_process():
+    pytest.importorskip('langid')
+    app = fake_nlu_app({'CHOOSER_EXECUTOR': 'process', 'CHOOSER_WORKERS': 1})
+
+    label, confidence = asyncio.run(
+        nlu.NLURunner.run_chooser_async(app, 'Bonjour tout le monde, comment allez-vous ?'))
+    assert label == 'fra'
+    # Bypassed messages never reach the chooser
+    assert asyncio.run(nlu.NLURunner.run_chooser_async(app, '/greet')) == (
+        nlu.DEFAULT_VALUE_FLAG, 1)
+    app.config.NLU_EXECUTORS['CHOOSER'].shutdown()
+
+
+@pytest.mark.nlu
+@pytest.mark.parametrize("inference_executor", ['none', 'thread'])
+@pytest.mark.parametrize("batch_parse", [True, False])
+def test_run_with_batching(inference_executor, batch_parse):
+    app = fake_nlu_app({
+        'BATCH_SIZE': 4,
+        'BATCH_WAIT': 5,
+        'INFERENCE_EXECUTOR': inference_executor})
+    batches = []
+
+    def predict_intents(messages):
+        batches.append(messages)
+        return [
+            {'text': message, 'intent': {'name': 'greet'}, 'entities': []}
+            for message in messages]
+
+    if batch_parse:
+        app.config.MODELS['eng'].predict_intents = predict_intents
+    requests = [SimpleNamespace(json={'text': f'Hello {idx}'}) for idx in range(6)]
+
+    async def run_all():
+        return await asyncio.gather(*[nlu.NLURunner.run(app, r) for r in requests])
+
+    results = asyncio.run(run_all())
+    assert [res['text'] for res in results] == [f'Hello {idx}' for idx in range(6)]
+    if batch_parse:
+        # One full batch, the rest flushed after BATCH_WAIT
+        assert [len(batch) for batch in batches] == [4, 2]
+
+    # Intents given directly are not batched
+    res = asyncio.run(nlu.NLURunner.run(app, SimpleNamespace(json={'text': '/greet'})))
+    assert res['text'] == '/greet'
+    assert sum(len(batch) for batch in batches) == (6 if batch_parse else 0)
+
+
+@pytest.mark.nlu
+def test_run_with_cache():
+    app = fake_nlu_app({'CACHE_SIZE': 10})
+    calls = []
+    app.config['NLU_CHOOSER'] = lambda message: calls.append(message) or ('eng', 1)
+
+    for text in ['Hello', ' Hello ', 'Hello']:
+        res = asyncio.run(nlu.NLURunner.run(app, SimpleNamespace(json={'text': text})))
+        assert res['text'] == text
+        assert len(res['entities']) == 1
+    assert calls == ['Hello']
+    assert app.config.METRICS == {'nlu_cache_hits': 2, 'nlu_cache_misses': 1}
+
+    app.config['NLU_GENERATION'] = 'gen2'
+    asyncio.run(nlu.NLURunner.run(app, SimpleNamespace(json={'text': 'Hello'})))
+    assert calls == ['Hello', 'Hello']
+
+
+@pytest.fixture
+def fake_models_app(tmp_path, monkeypatch):
+    """ Build NLU apps loading fake models, of 100 MB each"""
+    loads = []
+
+    def load(cls, filename):
+        name = Path(filename).name.split('.')[0]
+        loads.append(name)
+        model = SimpleNamespace(
+            name=name, version=Path(filename).read_text(), parsed=[])
+
+        async def predict_intent(message):
+            model.parsed.append(message)
+            return {'text': message, 'intent': {'name': f'greet_{name}'}, 'entities': []}
+        model.predict_intent = predict_intent
+        return model
+
+    monkeypatch.setattr(nlu.NLUAppUpdater, '_load_updated_data', classmethod(load))
+    monkeypatch.setattr(
+        nlu.NLUAppUpdater, '_extract_labels_from_model',
+        classmethod(lambda cls, model: {f'greet_{model.name}'}))
+
+    Path(tmp_path, 'chooser.py').write_text(
+        'def chooser(message):\n    return (message.split(":")[0], 1)\n')
+    values = ''
+    for name in ['eng', 'fra', 'deu']:
+        Path(tmp_path, f'{name}.tar.gz').write_text('v1')
+        values += (
+            f'        - NAME: {name}\n'
+            f'          FILENAME: {Path(tmp_path, name + ".tar.gz")}\n'
+            f'          MEMORY: 100\n')
+
+    def make(controls='', load=True):
+        config = Path(tmp_path, 'config.yml')
+        config.write_text(
+            'NLU_CONTROLS:\n'
+            '    MODEL_CHOOSER:\n'
+            f'        FILEPATH: {Path(tmp_path, "chooser.py")}\n'
+            '        FUNCTION: chooser\n'
+            '    NAME: detected_lang\n'
+            f'{controls}'
+            '    VALUES:\n'
+            f'{values}'
+            '    REFRESH: 10\n'
+            '    DEFAULT_VALUE: eng\n'
+            'NETWORK:\n'
+            "    HOST: '0.0.0.0'\n"
+            '    PORT: 6001\n')
+
+        app = sanic.Sanic('Test_NLU_fake_models', register=False)
+        nlu.NLUAppUpdater.configure(app, str(config), load=load)
+        return app, loads
+
+    return make
+
+
+@pytest.mark.nlu
+def test_lazy_loading(fake_models_app):
+    app, loads = fake_models_app('    LAZY_LOADING: true\n    MEMORY_BUDGET: 250\n')
+    assert loads == ['eng']
+    assert set(app.config.MODELS) == {'eng', nlu.DEFAULT_VALUE_FLAG}
+    assert app.config.NLU_LABELS == {'greet_eng'}
+
+    def request(text):
+        return nlu.NLURunner.run(app, SimpleNamespace(json={'text': text}))
+
+    async def run_all(texts):
+        return await asyncio.gather(*[request(text) for text in texts])
+
+    # A single load for concurrent requests
+    results = asyncio.run(run_all(['fra: salut'] * 3))
+    assert [res['intent']['name'] for res in results] == ['greet_fra'] * 3
+    assert loads == ['eng', 'fra']
+    assert app.config.NLU_LABELS == {'greet_eng', 'greet_fra'}
+
+    # Over budget: the least recently used model goes, the default one stays
+    asyncio.run(run_all(['deu: hallo']))
+    assert set(app.config.MODELS) == {'eng', 'deu', nlu.DEFAULT_VALUE_FLAG}
+    assert list(app.config.NLU_RESIDENT) == ['eng', 'deu']
+    assert app.config.NLU_CHOOSER_BYPASSER.match('/greet_fra')
+
+    assert asyncio.run(request('fra: salut'))['intent']['name'] == 'greet_fra'
+    assert loads == ['eng', 'fra', 'deu', 'fra']
+    assert set(app.config.MODELS) == {'eng', 'fra', nlu.DEFAULT_VALUE_FLAG}
+
+
+@pytest.mark.nlu
+def test_refresh_async_swaps_models(fake_models_app, tmp_path):
+    app, loads = fake_models_app()
+    assert loads == ['eng', 'fra', 'deu']
+    previous = app.config.MODELS['eng']
+    generation = app.config.NLU_GENERATION
+
+    asyncio.run(nlu.NLUAppUpdater.refresh_async(app))
+    assert len(loads) == 3
+
+    time.sleep(0.01)
+    Path(tmp_path, 'eng.tar.gz').write_text('v2')
+    asyncio.run(nlu.NLUAppUpdater.refresh_async(app))
+    assert loads == ['eng', 'fra', 'deu', 'eng']
+
+    model = app.config.MODELS['eng']
+    assert model.version == 'v2'
+    assert app.config.MODELS[nlu.DEFAULT_VALUE_FLAG] is model
+    # Warmed up before being swapped in
+    assert model.parsed == ['greet eng']
+    assert previous.version == 'v1'
+    assert app.config.NLU_GENERATION != generation
+
+
+@pytest.mark.nlu
+@pytest.mark.parametrize("workers", [1, 2])
+def test_models_loaded_concurrently(fake_models_app, monkeypatch, workers):
+    load = nlu.NLUAppUpdater._load_updated_data
+    running = []
+    concurrency = []
+
+    def slow_load(cls, filename):
+        running.append(filename)
+        concurrency.append(len(running))
+        time.sleep(0.1)
+        running.remove(filename)
+        return load(filename)
+
+    monkeypatch.setattr(nlu.NLUAppUpdater, '_load_updated_data', classmethod(slow_load))
+    app, loads = fake_models_app(f'    LOAD_WORKERS: {workers}\n')
+
+    assert sorted(loads) == ['deu', 'eng', 'fra']
+    assert max(concurrency) == workers
+    assert app.config.MODELS[nlu.DEFAULT_VALUE_FLAG] is app.config.MODELS['eng']
+    assert app.config.NLU_LABELS == {'greet_eng', 'greet_fra', 'greet_deu'}
+
+
+@pytest.mark.nlu
+def test_warm_up_messages(fake_models_app, tmp_path):
+    Path(tmp_path, 'warm_up.txt').write_text('Hello\n\nHow are you?\n')
+    app, loads = fake_models_app(f'    WARM_UP_FILE: {Path(tmp_path, "warm_up.txt")}\n')
+    assert app.config.MODELS['fra'].parsed == ['Hello', 'How are you?']
+
+    app, loads = fake_models_app('    WARM_UP_SIZE: 0\n')
+    assert app.config.MODELS['fra'].parsed == []
+
+    app, loads = fake_models_app()
+    assert app.config.MODELS['fra'].parsed == ['greet fra']
+
+
+@pytest.mark.nlu
+def test_warm_up_closes_event_loop():
+    loops = []
+
+    async def predict_intent(message):
+        loops.append(asyncio.get_running_loop())
+        return {'text': message, 'intent': {'name': 'greet'}, 'entities': []}
+
+    # As in a loader thread, which ends once the model is loaded
+    model = SimpleNamespace(predict_intent=predict_intent)
+    thread = threading.Thread(
+        target=nlu.NLUAppUpdater._warm_up, args=(model, ['Hello', 'Hi']))
+    thread.start()
+    thread.join()
+    assert len(loops) == 2
+    assert loops[0] is loops[1]
+    assert loops[0].is_closed()
+
+
+@pytest.mark.nlu
+def test_readiness(fake_models_app):
+    app, loads = fake_models_app('    LAZY_LOADING: true\n    MEMORY_BUDGET: 150\n')
+    report = nlu.NLUAppUpdater.readiness(app)
+    assert report['ready']
+    assert report['generation'] == app.config.NLU_GENERATION
+    assert report['models']['eng']['state'] == 'ready'
+    assert report['models']['eng']['load_seconds'] >= 0
+    assert report['models']['eng']['warm_up_seconds'] >= 0
+    assert report['models']['fra'] == {'state': 'unloaded', 'loaded': False}
+
+    asyncio.run(nlu.NLUAppUpdater.ensure_loaded(app, 'fra'))
+    asyncio.run(nlu.NLUAppUpdater.ensure_loaded(app, 'deu'))
+    report = nlu.NLUAppUpdater.readiness(app)
+    assert report['models']['fra']['state'] == 'unloaded'
+    assert report['models']['deu']['state'] == 'ready'
+    assert report['models']['deu']['loaded']
+
+    del app.config.MODELS['eng']
+    assert not nlu.NLUAppUpdater.readiness(app)['ready']
+
+
+@pytest.mark.nlu
+def test_load_async(fake_models_app):
+    # Nothing is loaded yet, not even the pinned models
+    app, loads = fake_models_app('    LAZY_LOADING: true\n', load=False)
+    assert loads == []
+    report = nlu.NLUAppUpdater.readiness(app)
+    assert not report['ready']
+    assert report['models']['eng'] == {'state': 'unloaded', 'loaded': False}
+
+    asyncio.run(nlu.NLUAppUpdater.load_async(app))
+    assert loads == ['eng']
+    report = nlu.NLUAppUpdater.readiness(app)
+    assert report['ready']
+    assert report['generation'] == app.config.NLU_GENERATION
+    assert report['models']['eng']['state'] == 'ready'
+
+
+@pytest.mark.nlu
+def test_lazy_loading_keeps_requested_model(fake_models_app):
+    # Only the default model fits in the budget
+    app, loads = fake_models_app('    LAZY_LOADING: true\n    MEMORY_BUDGET: 150\n')
+    res = asyncio.run(nlu.NLURunner.run(app, SimpleNamespace(json={'text': 'fra: salut'})))
+    assert res['intent']['name'] == 'greet_fra'
+    assert 'fra' in app.config.MODELS
+
+
+@pytest.mark.nlu
+def test_lazy_loading_concurrent_loads_over_budget(fake_models_app, monkeypatch):
+    app, loads = fake_models_app('    LAZY_LOADING: true\n    MEMORY_BUDGET: 250\n')
+    load = nlu.NLUAppUpdater._load_and_warm_up
+    # Both loads finish together: `deu` is swapped in (evicting the least
+    # recently used model) before the `fra` requests resume
+    barrier = threading.Barrier(2, timeout=5)
+
+    def staggered_load(cls, app, label, filename):
+        barrier.wait()
+        return load(app, label, filename)
+
+    monkeypatch.setattr(
+        nlu.NLUAppUpdater, '_load_and_warm_up', classmethod(staggered_load))
+
+    async def run_all():
+        return await asyncio.gather(*[
+            nlu.NLURunner.run(app, SimpleNamespace(json={'text': text}))
+            for text in ['fra: a', 'fra: b', 'deu: c']])
+
+    results = asyncio.run(run_all())
+    assert [res['intent']['name'] for res in results] == [
+        'greet_fra', 'greet_fra', 'greet_deu']
+    assert sum(app.config.NLU_RESIDENT.values()) <= 300
+    assert not any(app.config.NLU_IN_USE.values())
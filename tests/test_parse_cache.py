@@ -0,0 +1,102 @@
+import pytest
+import time
+import asyncio
+import sqlite3
+from pathlib import Path
+from rasa_helpers.parse_cache import ParseCache
+
+
+def parse(text, value='Paris', start=None):
+    start = text.index(value) if start is None else start
+    return {
+        'text': text,
+        'intent': {'name': 'travel', 'confidence': 0.9},
+        'entities': [{
+            'entity': 'city', 'value': value,
+            'start': start, 'end': start + len(value)}]
+    }
+
+
+@pytest.mark.nlu
+def test_parse_cache_normalises_text():
+    cache = ParseCache(10, lowercase=True)
+    assert cache.get('  To Paris', 'gen1') is None
+    cache.put('  To Paris', 'gen1', 'eng', 1, parse('  To Paris'))
+
+    label, confidence, response = cache.get('to paris ', 'gen1')
+    assert (label, confidence) == ('eng', 1)
+    assert response['text'] == 'to paris '
+    assert response['entities'][0]['value'] == 'paris'
+    assert (response['entities'][0]['start'], response['entities'][0]['end']) == (3, 8)
+
+    # Entries are copies, amending a response does not change the cache
+    response['entities'].append({'entity': 'detected_lang'})
+    assert len(cache.get('To Paris', 'gen1')[2]['entities']) == 1
+    assert cache.get('To paris', 'gen1')[2]['entities'][0]['start'] == 3
+
+    assert ParseCache(10).get('to paris', 'gen1') is None
+
+
+@pytest.mark.nlu
+def test_parse_cache_bounded_and_generations():
+    cache = ParseCache(2)
+    for text in ['yes', 'no', 'menu']:
+        cache.get(text, 'gen1')
+        cache.put(text, 'gen1', 'eng', 1, parse(text, value=''))
+    assert list(cache.entries) == ['no', 'menu']
+
+    # Parsed with the previous models: not stored
+    assert cache.get('no', 'gen2') is None
+    cache.put('no', 'gen1', 'eng', 1, parse('no', value=''))
+    assert not cache.entries
+
+
+@pytest.mark.nlu
+def test_parse_cache_persistent(tmp_path):
+    path = str(Path(tmp_path, 'cache.sqlite'))
+    cache = ParseCache(10, path=path)
+    cache.get('To Paris', 'gen1')
+    cache.put('To Paris', 'gen1', 'eng', 1, parse('To Paris'))
+
+    restarted = ParseCache(10, path=path)
+    assert restarted.get('To Paris', 'gen1')[2]['entities'][0]['value'] == 'Paris'
+    assert restarted.get('To Paris', 'gen2') is None
+
+    assert ParseCache(10, path=path).get('To Paris', 'gen1') is None
+
+
+@pytest.mark.nlu
+def test_parse_cache_writes_off_the_event_loop(tmp_path):
+    path = str(Path(tmp_path, 'cache.sqlite'))
+    cache = ParseCache(10, path=path)
+    cache.flush_delay = 0.01
+
+    def rows():
+        with sqlite3.connect(path) as db:
+            db.execute('CREATE TABLE IF NOT EXISTS parses '
+                       '(key TEXT PRIMARY KEY, generation TEXT, entry TEXT)')
+            return db.execute('SELECT key, generation FROM parses').fetchall()
+
+    async def parse_messages():
+        for text in ['To Paris', 'To Rome']:
+            cache.get(text, 'gen1')
+            cache.put(text, 'gen1', 'eng', 1, parse(text, value='To'))
+        # Queued, and written in a single transaction later
+        assert rows() == []
+        assert len(cache.pending) == 3
+
+        deadline = time.monotonic() + 5
+        while len(rows()) < 2 and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(parse_messages())
+    assert sorted(rows()) == [('To Paris', 'gen1'), ('To Rome', 'gen1')]
+    assert cache.get('To Rome', 'gen1')[2]['text'] == 'To Rome'
+    assert ParseCache(10, path=path).get('To Rome', 'gen1') is not None
+
+
+@pytest.mark.nlu
+def test_parse_cache_from_controls():
+    assert ParseCache.from_controls({}) is None
+    cache = ParseCache.from_controls({'CACHE_SIZE': 5, 'CACHE_LOWERCASE': True})
+    assert (cache.size, cache.lowercase, cache.path) == (5, True, None)
@@ -5,6 +5,8 @@ import time
 import os
 import shutil
 from pathlib import Path
+from rasa_helpers.response_router import (
+    ResponseRouter, EntityRouter, history_fallback, latest_events)
 
 valid_req = {
     'tracker': {
@@ -105,9 +107,9 @@ test_responses = {
          'test_entity', ['abcd', 'abcd'])
     ])
 def test_extract_entity_from_events(events, entity_name, expected):
-    assert (
-        nlg.ResponseFetcher._extract_entities(events, entity_name) == expected
-    )
+    router = EntityRouter({'abc'}, 'xyz', 1, entity_name)
+    events = [events] if isinstance(events, dict) else events
+    assert [router.extract(event) for event in events] == expected
 
 @pytest.mark.nlg
 @pytest.mark.response_fetcher
@@ -119,62 +121,62 @@ def test_extract_entity_from_events(events, entity_name, expected):
           'NAME': 'test_slot',
           'VALUES': [{'NAME': 'abc'}],
           'HISTORY': 1},
-         ['abc']),
+         'abc'),
         (valid_req,
          {'METHOD': 'entity',
           'NAME': 'test_entity',
           'VALUES': [{'NAME': 'abc'}],
           'HISTORY': 1},
-         ['abc']),
+         'abc'),
         (valid_req,
          {'METHOD': 'suffix',
           'SEPARATOR': '_',
           'VALUES': [{'NAME': 'abc'}],
           'HISTORY': 1},
-         ['abc']),
+         'abc'),
         (valid_req,
          {'METHOD': 'last_intent_suffix',
           'SEPARATOR': '_',
           'VALUES': [{'NAME': 'abc'}],
           'HISTORY': 1},
-         ['abc']),
+         'abc'),
         (valid_req,
          {'METHOD': 'pooled',
           'VALUES': [{'NAME': 'abc'}],
           'HISTORY': 1},
-         [nlg.POOLED_FLAG]),
+         nlg.POOLED_FLAG),
         (invalid_req,
          {'METHOD': 'slot',
           'NAME': 'test_slot',
           'VALUES': [{'NAME': 'abc'}],
           'HISTORY': 1},
-         ['abcd']),
+         'xyz'),
         (invalid_req,
          {'METHOD': 'entity',
           'NAME': 'test_entity',
           'VALUES': [{'NAME': 'abc'}],
           'HISTORY': 1},
-         ['abcd']),
+         'xyz'),
         (invalid_req,
          {'METHOD': 'suffix',
           'SEPARATOR': '_',
           'VALUES': [{'NAME': 'abc'}],
           'HISTORY': 1},
-         ['abcd']),
+         'xyz'),
         (invalid_req,
          {'METHOD': 'last_intent_suffix',
           'SEPARATOR': '_',
           'VALUES': [{'NAME': 'abc'}],
           'HISTORY': 1},
-         ['abcd'])
+         'xyz')
     ])
-def test_extract_groups(req, config, expected):
-    # allowed_groups = (
-    #     [k['NAME'] for k in config.pop('VALUES')]
-    #     + [nlg.DEFAULT_VALUE_FLAG, nlg.POOLED_FLAG]
-    # )
-    assert nlg.ResponseFetcher._extract_groups(
-        req, config) == expected
+def test_router_groups(req, config, expected):
+    allowed_groups = (
+        [k['NAME'] for k in config['VALUES']]
+        + [nlg.DEFAULT_VALUE_FLAG, nlg.POOLED_FLAG]
+    )
+    router = ResponseRouter.compile(config, allowed_groups, 'xyz', nlg.POOLED_FLAG)
+    assert router.route(req) == expected
 
 
 @pytest.mark.nlg
@@ -190,10 +192,9 @@ def test_extract_groups(req, config, expected):
                  'VALUES': [{'NAME': 'abc'}],
                  'HISTORY': 1},
              'NLG_LABELS': ['abc', 'xyz'],
-             'RESPONSES': {'abc': {'res1': 'my response'}},
              'NLG_DEFAULT_VALUE': 'xyz'
             },
-         {'res1': 'my response'})
+         'abc')
         # (valid_req,
         #  {'METHOD': 'entity',
         #   'NAME': 'test_entity',
@@ -242,16 +243,13 @@ def test_extract_groups(req, config, expected):
         #   'HISTORY': 1},
         #  ['abcd'])
     ])
-def test_fetch_group_responses(req, config, expected):
-    # allowed_groups = (
-    #     [k['NAME'] for k in config.pop('VALUES')]
-    #     + [nlg.DEFAULT_VALUE_FLAG, nlg.POOLED_FLAG]
-    # )
-    # print(app)
-    # print(app.config)
+def test_find_response_group(req, config, expected):
     app = sanic.Sanic('Test_app_response_fetcher')
     app.config.update(config)
-    assert nlg.ResponseFetcher._fetch_group_responses(
+    app.config['NLG_ROUTER'] = ResponseRouter.compile(
+        config['NLG_CONTROLS'], config['NLG_LABELS'],
+        config['NLG_DEFAULT_VALUE'], nlg.POOLED_FLAG)
+    assert nlg.ResponseFetcher._find_response_group(
         app, req) == expected
 
 
@@ -268,8 +266,7 @@ def test_fetch_group_responses(req, config, expected):
         ([None, None], None),
     ])
 def test_history_fallback(groups, expected):
-    assert nlg.ResponseFetcher._history_fallback(
-        groups) == expected
+    assert history_fallback(groups) == expected
 
 
 @pytest.mark.nlg
@@ -284,43 +281,75 @@ def test_history_fallback(groups, expected):
     ])
 def test_select_response_group(
     groups, allowed_groups, default_group, expected):
+    # Latest group first, as found in the tracker events
+    events = [
+        {'event': 'user', 'parse_data': {'entities': [
+            {'entity': 'test_entity', 'value': group, 'start': 0, 'end': 0}]}}
+        for group in reversed(groups)]
+    router = EntityRouter(allowed_groups, default_group, len(groups), 'test_entity')
 
-    assert nlg.ResponseFetcher._select_response_group(
-        groups, allowed_groups, default_group) == expected
+    assert router.route({'tracker': {'events': events}}) == expected
 
 
 @pytest.mark.nlg
 @pytest.mark.response_fetcher
 @pytest.mark.parametrize(
-    "responses,response_key,channel,expected",
+    "response_key,channel,expected",
     [
-        (test_responses, 'res1', 'collector', [
-            {'text': 'text res1 default channel'}
-        ]),
-        (test_responses, 'res1', 'facebook', [
-            {'text': 'text res1 facebook channel', 'channel': 'facebook'}
-        ]),
-        (test_responses, 'not_a_res', 'faceboo', []),
-        (test_responses, 'utter_restart', 'collector', [{'text': ''}]),
-        (test_responses, 'res2', 'facebook', [
-            {
-                'text': 'text res2 buttons facebook channel',
-                'buttons': [
-                    {'payload': 'button1', 'text': 'text facebook button1'},
-                    {'payload': 'button2', 'text': 'text facebook button2'}
-                ],
-                'channel': 'facebook'
-            }
-        ]),
-        (test_responses, 'res3', 'coll', [
+        ('res1', 'collector', ({'text': 'text res1 default channel'},)),
+        ('res1', 'facebook', (
+            {'text': 'text res1 facebook channel', 'channel': 'facebook'},)),
+        ('res2', 'whatsapp', ({
+            'text': 'text res2 buttons default channel',
+            'buttons': [
+                {'payload': 'button1', 'text': 'text button1'},
+                {'payload': 'button2', 'text': 'text button2'}
+            ]},)),
+        ('res3', 'coll', (
             {'text': 'text res3 default channel variation 1'},
-            {'text': 'text res3 default channel variation 2'},
-        ]),
-        (test_responses, 'res3', 'whatsapp', [
+            {'text': 'text res3 default channel variation 2'})),
+        ('res2', 'facebook', ({
+            'text': 'text res2 buttons facebook channel',
+            'buttons': [
+                {'payload': 'button1', 'text': 'text facebook button1'},
+                {'payload': 'button2', 'text': 'text facebook button2'}
+            ],
+            'channel': 'facebook'},)),
+        ('res3', 'whatsapp', (
             {'text': 'text res3 whatsapp channel variation 1', 'channel': 'whatsapp'},
-            {'text': 'text res3 whatsapp channel variation 2', 'channel': 'whatsapp'}
-        ])
+            {'text': 'text res3 whatsapp channel variation 2', 'channel': 'whatsapp'})),
+        ('not_a_res', 'faceboo', ()),
+        ('utter_restart', 'collector', ({'text': ''},))
+    ])
+def test_lookup_responses(response_key, channel, expected):
+    index = nlg.NLGAppUpdater._build_response_index(
+        {'abc': nlg.NLGAppUpdater._build_group_index(test_responses)})
+    assert tuple(
+        t.payload for t in nlg.ResponseFetcher._lookup_responses(
+            index, 'abc', response_key, channel)) == expected
+    assert tuple(
+        t.payload for t in nlg.ResponseFetcher._lookup_responses(
+            index, 'xyz', response_key, channel)) == (
+                expected if response_key == 'utter_restart' else ())
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+@pytest.mark.parametrize(
+    "n,event_type,expected",
+    [
+        (1, 'user', ['u3']),
+        (2, 'user', ['u3', 'u2']),
+        (10, 'user', ['u3', 'u2', 'u1']),
+        (1, 'action', ['a2']),
+        (3, 'action', ['a2', 'a1'])
     ])
-def test_filter_wanted_responses(responses, response_key, channel, expected):
-    assert nlg.ResponseFetcher._filter_wanted_responses(
-        responses, response_key, channel) == expected
+def test_latest_events(n, event_type, expected):
+    events = [
+        {'event': 'user', 'name': 'u1'},
+        {'event': 'action', 'name': 'a1'},
+        {'event': 'user', 'name': 'u2'},
+        {'event': 'action', 'name': 'a2'},
+        {'event': 'user', 'name': 'u3'}
+    ]
+    assert [ev['name'] for ev in latest_events(events, event_type, n)] == expected
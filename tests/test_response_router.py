@@ -0,0 +1,240 @@
+import pytest
+import time
+import json
+import rasa_helpers.nlg as nlg
+from rasa_helpers.response_router import (
+    ResponseRouter, SuffixRouter, StickyRouter, CompositeRouter)
+
+
+def build_request(values, response='utter_response_abc'):
+    events = []
+    for value in values:
+        events.append({
+            'event': 'user',
+            'intent': {'name': f'affirm_{value}'},
+            'parse_data': {'entities': [
+                {'entity': 'test_entity', 'value': value, 'start': 0, 'end': 0}
+            ]}
+        })
+        events.append({'event': 'action', 'name': f'utter_other_{value}'})
+    return {
+        'tracker': {'slots': {'test_slot': values[-1] if values else None}, 'events': events},
+        'response': response
+    }
+
+
+LABELS = {'abc', 'xyz', 'ijk', nlg.DEFAULT_VALUE_FLAG, nlg.POOLED_FLAG}
+REQUESTS = [
+    build_request(['abc']),
+    build_request(['xyz', 'abc'], response='utter_response_xyz'),
+    build_request(['abcd']),
+    build_request(['xyz', 'xyz', 'abcd'], response='utter_response'),
+    build_request(['ijk', 'xyz', 'abcd', 'abcd'], response='utter_response_aaa'),
+    build_request([]),
+]
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+@pytest.mark.parametrize("method,expected", [
+    ('slot', ['abc', 'abc', 'xyz', 'xyz', 'xyz', 'xyz']),
+    ('entity', ['abc', 'abc', 'xyz', 'xyz', 'xyz', 'xyz']),
+    # The response being requested comes first
+    ('suffix', ['abc', 'xyz', 'abc', 'xyz', 'xyz', 'abc']),
+    ('last_intent_suffix', ['abc', 'abc', 'xyz', 'xyz', 'xyz', 'xyz']),
+    ('pooled', [nlg.POOLED_FLAG] * len(REQUESTS)),
+])
+@pytest.mark.parametrize("history", [1, 3])
+def test_router_routes_requests(method, expected, history):
+    controls = {
+        'METHOD': method,
+        'NAME': 'test_slot' if method == 'slot' else 'test_entity',
+        'SEPARATOR': '_',
+        'HISTORY': history
+    }
+    router = ResponseRouter.compile(controls, LABELS, 'xyz', nlg.POOLED_FLAG)
+    assert [router.route(request) for request in REQUESTS] == expected
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+@pytest.mark.parametrize("method", ['entity', 'suffix', 'last_intent_suffix'])
+def test_router_history_fallback(method):
+    controls = {
+        'METHOD': method,
+        'NAME': 'test_entity',
+        'SEPARATOR': '_',
+        'HISTORY': 3
+    }
+    router = ResponseRouter.compile(controls, LABELS, 'xyz', nlg.POOLED_FLAG)
+    # Latest value invalid: the likeliest of the older ones
+    request = build_request(['ijk', 'abc', 'abc', 'abcd'], response='utter_response')
+    assert router.route(request) == 'abc'
+    request = build_request(['abc', 'abcd', 'abcd', 'abcd'], response='utter_response')
+    assert router.route(request) == 'xyz'
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+@pytest.mark.parametrize(
+    "separator,name,expected",
+    [
+        ('_', 'utter_response_abc', 'abc'),
+        ('_', 'abc', 'abc'),
+        (None, 'utter response abc', 'abc'),
+        (None, '', None),
+        ('_', None, None),
+    ])
+def test_suffix_router_suffix(separator, name, expected):
+    router = SuffixRouter(LABELS, 'xyz', 1, separator)
+    assert router._suffix(name) == expected
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+def test_router_compile_unknown_method():
+    with pytest.raises(ValueError):
+        ResponseRouter.compile({'METHOD': 'nope'}, LABELS, 'xyz', nlg.POOLED_FLAG)
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+@pytest.mark.parametrize("method", ['entity', 'suffix', 'last_intent_suffix'])
+@pytest.mark.parametrize("history", [1, 3])
+def test_sticky_router_matches_router(method, history):
+    controls = {
+        'METHOD': method,
+        'NAME': 'test_entity',
+        'SEPARATOR': '_',
+        'HISTORY': history
+    }
+    router = ResponseRouter.compile(controls, LABELS, 'xyz', nlg.POOLED_FLAG)
+    sticky = ResponseRouter.compile(
+        dict(controls, STICKY_CACHE=2), LABELS, 'xyz', nlg.POOLED_FLAG)
+    assert isinstance(sticky, StickyRouter)
+
+    values = ['abcd', 'ijk', 'abcd', 'abcd', 'xyz', 'abc', 'ijk', 'abcd']
+    for end in range(len(values) + 1):
+        request = build_request(values[:end], response=f'utter_response_{values[end - 1]}')
+        request['tracker']['sender_id'] = 'user1'
+        assert sticky.route(request) == router.route(request)
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+def test_sticky_router_only_scans_new_events(monkeypatch):
+    controls = {'METHOD': 'entity', 'NAME': 'test_entity', 'HISTORY': 5, 'STICKY_CACHE': 2}
+    sticky = ResponseRouter.compile(controls, LABELS, 'xyz', nlg.POOLED_FLAG)
+    extracted = []
+    extract = sticky.router.extract
+    monkeypatch.setattr(
+        sticky.router.__class__, 'extract',
+        lambda self, event: extracted.append(event) or extract(event))
+
+    request = build_request(['abcd', 'abc', 'ijk'])
+    request['tracker']['sender_id'] = 'user1'
+    assert sticky.route(request) == 'ijk'
+    assert len(extracted) == 3
+
+    request['tracker']['events'] += build_request(['abcd'])['tracker']['events']
+    assert sticky.route(request) == 'ijk'
+    assert len(extracted) == 4
+
+    # Conversation restarted: the tracker no longer extends the cached one
+    request = build_request(['abc'])
+    request['tracker']['sender_id'] = 'user1'
+    assert sticky.route(request) == 'abc'
+    assert len(extracted) == 5
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+def test_sticky_router_bounded(monkeypatch):
+    sticky = StickyRouter(
+        ResponseRouter.compile(
+            {'METHOD': 'entity', 'NAME': 'test_entity', 'HISTORY': 1},
+            LABELS, 'xyz', nlg.POOLED_FLAG),
+        size=2, ttl=60)
+
+    for sender_id in ['user1', 'user2', 'user3']:
+        request = build_request(['abc'])
+        request['tracker']['sender_id'] = sender_id
+        sticky.route(request)
+    assert list(sticky.entries) == ['user2', 'user3']
+
+    monkeypatch.setattr(time, 'monotonic', lambda: time.time() + 120)
+    assert sticky._get_entry('user3', len(request['tracker']['events'])) is None
+
+    sticky.clear()
+    assert not sticky.entries
+
+
+COMPOSITE_CONTROLS = {
+    'DIMENSIONS': [
+        {'METHOD': 'slot', 'NAME': 'language'},
+        {'METHOD': 'entity', 'NAME': 'country'}
+    ],
+    'HISTORY': 2
+}
+COMPOSITE_LABELS = {
+    'fr/CA', 'fr/*', '*/CA', 'en/*', 'de/DE', nlg.DEFAULT_VALUE_FLAG, nlg.POOLED_FLAG}
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+@pytest.mark.parametrize(
+    "language,countries,expected",
+    [
+        ('fr', ['CA'], 'fr/CA'),
+        ('fr', ['BE'], 'fr/*'),
+        ('fr', [], 'fr/*'),
+        ('en', ['CA'], 'en/*'),
+        ('es', ['CA'], '*/CA'),
+        (None, ['XX', 'CA'], '*/CA'),
+        ('de', ['DE'], 'de/DE'),
+        ('de', ['AT'], 'en/*'),
+        (None, [], 'en/*'),
+    ])
+def test_composite_router(language, countries, expected):
+    router = ResponseRouter.compile(
+        COMPOSITE_CONTROLS, COMPOSITE_LABELS, 'en/*', nlg.POOLED_FLAG)
+    assert isinstance(router, CompositeRouter)
+    assert len(router.index) == 4 * 3
+
+    request = {
+        'tracker': {
+            'slots': {'language': language},
+            'events': [
+                {'event': 'user', 'parse_data': {'entities': [
+                    {'entity': 'country', 'value': country}]}}
+                for country in countries
+            ]
+        },
+        'response': 'utter_response'
+    }
+    assert router.route(request) == expected
+
+
+@pytest.mark.nlg
+@pytest.mark.response_fetcher
+@pytest.mark.parametrize("method", ['entity', 'suffix', 'last_intent_suffix'])
+@pytest.mark.parametrize("sticky", [False, True])
+def test_router_lazily_decoded_events(method, sticky):
+    simdjson = pytest.importorskip('simdjson')
+    controls = {
+        'METHOD': method,
+        'NAME': 'test_entity',
+        'SEPARATOR': '_',
+        'HISTORY': 3,
+        'STICKY_CACHE': 2 if sticky else None
+    }
+    router = ResponseRouter.compile(controls, LABELS, 'xyz', nlg.POOLED_FLAG)
+    plain_router = ResponseRouter.compile(controls, LABELS, 'xyz', nlg.POOLED_FLAG)
+
+    values = ['abcd', 'ijk', 'abcd', 'abcd', 'xyz', 'abc', 'ijk', 'abcd']
+    for end in range(len(values) + 1):
+        request = build_request(values[:end], response=f'utter_response_{values[end - 1]}')
+        request['tracker']['sender_id'] = 'user1'
+        document = simdjson.Parser().parse(json.dumps(request).encode())
+        lazy_request = {'tracker': document['tracker'], 'response': document['response']}
+        assert router.route(lazy_request) == plain_router.route(request)
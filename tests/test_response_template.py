@@ -0,0 +1,109 @@
+import pytest
+import json
+from rasa_helpers.response_template import ResponseTemplate
+
+
+@pytest.mark.nlg
+@pytest.mark.parametrize(
+    "variant,fields,is_static",
+    [
+        ({'text': 'no placeholder'}, set(), True),
+        ({'text': 'escaped {{braces}}'}, set(), True),
+        ({'text': 'hello {name}'}, {'name'}, False),
+        ({'text': '{a.b} and {c[0]:>{width}}'}, {'a', 'c', 'width'}, False),
+        ({'text': 'hi',
+          'buttons': [{'title': 'yes {name}', 'payload': '/affirm'}]},
+         {'name'}, False),
+        ({'custom': {'data': '{"json": "not a template"}'}}, set(), True),
+        ({'text': 'positional {}'}, set(), True)
+    ])
+def test_compile_template(variant, fields, is_static):
+    template = ResponseTemplate(variant)
+    assert template.fields == fields
+    assert template.is_static == is_static
+
+
+@pytest.mark.nlg
+@pytest.mark.parametrize(
+    "variant,arguments,expected",
+    [
+        ({'text': 'no placeholder'}, {}, {'text': 'no placeholder'}),
+        ({'text': 'escaped {{braces}}'}, {}, {'text': 'escaped {braces}'}),
+        ({'text': 'hello {name}', 'channel': 'facebook'}, {'name': 'Ann'},
+         {'text': 'hello Ann', 'channel': 'facebook'}),
+        ({'text': 'hi',
+          'buttons': [{'title': 'yes {name}', 'payload': '/affirm'},
+                      {'title': 'no', 'payload': '/deny'}],
+          'custom': {'greeting': 'hi {name}', 'ids': [1, 2]}},
+         {'name': 'Ann', 'unused': 0},
+         {'text': 'hi',
+          'buttons': [{'title': 'yes Ann', 'payload': '/affirm'},
+                      {'title': 'no', 'payload': '/deny'}],
+          'custom': {'greeting': 'hi Ann', 'ids': [1, 2]}})
+    ])
+def test_render_template(variant, arguments, expected):
+    assert ResponseTemplate(variant).render(arguments) == expected
+
+
+@pytest.mark.nlg
+def test_render_does_not_modify_template():
+    template = ResponseTemplate(
+        {'text': 'hello {name}', 'buttons': [{'title': '{name}'}]})
+    template.render({'name': 'Ann'})
+    assert template.render({'name': 'Bob'}) == {
+        'text': 'hello Bob', 'buttons': [{'title': 'Bob'}]}
+
+
+@pytest.mark.nlg
+@pytest.mark.parametrize(
+    "variant",
+    [
+        {'text': 'hello', 'buttons': [{'title': 'yes', 'payload': '/affirm'}]},
+        {'text': 'hello {name}', 'buttons': [{'title': 'yes', 'payload': '/affirm'}]}
+    ])
+def test_render_returns_copy(variant):
+    template = ResponseTemplate(variant)
+    response = template.render({'name': 'Ann'})
+    response['text'] = 'changed'
+    response['buttons'][0]['title'] = 'changed'
+    response['buttons'].append({'title': 'no'})
+
+    response = template.render({'name': 'Ann'})
+    assert response['buttons'] == [{'title': 'yes', 'payload': '/affirm'}]
+    assert response['text'] in ('hello', 'hello Ann')
+    assert json.loads(template.encode({'name': 'Ann'})) == response
+
+
+@pytest.mark.nlg
+def test_render_missing_arguments_raises_key_error():
+    with pytest.raises(KeyError):
+        ResponseTemplate({'text': 'hello {name} {surname}'}).render({'name': 'Ann'})
+
+
+@pytest.mark.nlg
+@pytest.mark.parametrize(
+    "variant,arguments,expected",
+    [
+        ({'text': 'no placeholder', 'buttons': [{'payload': '/affirm'}]}, {},
+         {'text': 'no placeholder', 'buttons': [{'payload': '/affirm'}]}),
+        ({'text': 'hello {name}'}, {'name': 'Ann'}, {'text': 'hello Ann'})
+    ])
+def test_encode_template(variant, arguments, expected):
+    template = ResponseTemplate(variant)
+    assert (template.encoded is not None) == template.is_static
+    assert json.loads(template.encode(arguments)) == expected
+
+
+@pytest.mark.nlg
+@pytest.mark.parametrize(
+    "variant,other,same",
+    [
+        ({'text': 'a', 'buttons': [{'payload': '/affirm'}]},
+         {'text': 'a', 'buttons': [{'payload': '/affirm'}]}, True),
+        ({'text': 'a', 'value': 1}, {'text': 'a', 'value': '1'}, False),
+        ({'text': 'a', 'value': 1}, {'text': 'a', 'value': True}, False),
+        ({'text': 'a', 'buttons': []}, {'text': 'a', 'buttons': {}}, False),
+    ])
+def test_template_fingerprint(variant, other, same):
+    assert (ResponseTemplate.compute_fingerprint(variant)
+            == ResponseTemplate.compute_fingerprint(other)) == same
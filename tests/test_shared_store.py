@@ -0,0 +1,114 @@
+import pytest
+import sanic
+import time
+import os
+import json
+import shutil
+from pathlib import Path
+import rasa_helpers.nlg as nlg
+from rasa_helpers.shared_store import SharedResponseStore
+
+
+@pytest.fixture
+def tmp_config(tmp_path):
+    """ Config using copies of the test response files, safe to modify"""
+    tests_dir = Path(__file__).parent
+    config = Path(tests_dir, 'nlg_test_config.yml').read_text()
+    for name in ['abc', 'xyz']:
+        shutil.copy(
+            Path(tests_dir, f'{name}_responses.yml'),
+            Path(tmp_path, f'{name}_responses.yml'))
+        config = config.replace(
+            f'tests/{name}_responses.yml', str(Path(tmp_path, f'{name}_responses.yml')))
+    config_path = Path(tmp_path, 'config.yml')
+    config_path.write_text(config)
+    return config_path
+
+
+@pytest.fixture
+def shared_app(tmp_config, tmp_path):
+    app = sanic.Sanic('Test NLG shared store', register=False)
+    nlg.NLGAppUpdater.configure(app, tmp_config)
+    app.config['NLG_SHARED_STORE'] = str(Path(tmp_path, 'nlg_store'))
+    return app
+
+
+def test_shared_index_matches_store(shared_app):
+    store = shared_app.config.NLG_STORE
+    path = shared_app.config.NLG_SHARED_STORE
+    assert SharedResponseStore.publish(store, path) == 1
+
+    index = SharedResponseStore(path).index
+    for key, templates in store.index.items():
+        variants = index[key]
+        assert len(variants) == len(templates)
+        for variant, template in zip(variants, templates):
+            assert variant.encode({'name': 'x'}) == template.encode({'name': 'x'})
+            assert variant.render({'name': 'x'}) == template.render({'name': 'x'})
+
+    assert ('abc', 'not_a_response', 'collector') not in index
+    assert index.get(('abc', 'not_a_response', None)) is None
+
+
+def test_construct_response_from_shared_store(shared_app):
+    SharedResponseStore.publish(
+        shared_app.config.NLG_STORE, shared_app.config.NLG_SHARED_STORE)
+    SharedResponseStore.attach(shared_app)
+    assert shared_app.config.RESPONSES == {}
+
+    for slot, channel, expected in [
+            ('xyz', 'facebook', 'xyz Text from response 2'),
+            ('ijk', 'collector', 'Text from response 2')]:
+        request = {
+            'tracker': {'slots': {'test_slot': slot}, 'events': []},
+            'response': 'utter_response_2',
+            'arguments': {},
+            'channel': {'name': channel}
+        }
+        body = nlg.ResponseFetcher.construct_response_body(shared_app, request)
+        assert json.loads(body)['text'] == expected
+        body = nlg.ResponseFetcher.construct_responses_body(shared_app, [request] * 2)
+        assert [r['text'] for r in json.loads(body)] == [expected] * 2
+
+
+def test_shared_store_switches_generation(shared_app):
+    path = shared_app.config.NLG_SHARED_STORE
+    SharedResponseStore.publish(shared_app.config.NLG_STORE, path)
+    view = SharedResponseStore(path)
+    key = ('xyz', 'utter_response_1', 'collector')
+    assert view.index[key][0].render({}) == {'text': 'xyz Text from response 1'}
+
+    filename = shared_app.config.NLG_CONTROLS['VALUES'][1]['FILENAME']
+    for generation in [2, 3]:
+        Path(filename).write_text(
+            Path(filename).read_text().replace('xyz Text', 'new xyz Text'))
+        os.utime(filename, (time.time() + generation, time.time() + generation))
+        nlg.NLGAppUpdater.refresh(shared_app)
+        assert SharedResponseStore.publish(shared_app.config.NLG_STORE, path) == generation
+
+    assert view.index[key][0].render({}) == {'text': 'new new xyz Text from response 1'}
+    assert view.generation == 3
+    assert not os.path.exists(f'{path}.1')
+    assert os.path.exists(f'{path}.2')
+
+
+@pytest.mark.slow
+def test_shared_store_publisher(shared_app):
+    shared_app.config.NLG_CONTROLS['WATCH'] = 'poll'
+    stop_event = SharedResponseStore.start_publisher(shared_app, nlg.NLGAppUpdater.refresh)
+    SharedResponseStore.attach(shared_app)
+    key = ('xyz', 'utter_response_1', 'collector')
+    try:
+        filename = shared_app.config.NLG_CONTROLS['VALUES'][1]['FILENAME']
+        Path(filename).write_text(
+            Path(filename).read_text().replace('xyz Text', 'new xyz Text'))
+        os.utime(filename, (time.time() + 10, time.time() + 10))
+
+        deadline = time.time() + 5
+        while (shared_app.config.NLG_STORE.generation < 2
+               and time.time() < deadline):
+            time.sleep(0.1)
+        assert shared_app.config.NLG_STORE.index[key][0].render({}) == {
+            'text': 'new xyz Text from response 1'}
+    finally:
+        stop_event.set()